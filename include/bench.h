@@ -0,0 +1,62 @@
+#ifndef BENCH_H
+#define BENCH_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include "datautils.h"
+
+//Support for the bench_[version].c files generated with --bench. Each packet
+//gets a function filling it with random contents out of these, allocated the
+//same way a decode without an arena would so free_ can release it. The driver
+//times walk, size, enc, dec and free over a set of random instances per packet
+
+//Random arrays, strings and buffers are kept short
+#define MC_BENCH_MAX_COUNT 8
+#define MC_BENCH_MAX_LEN 32
+//Random instances timed per packet
+#define MC_BENCH_SAMPLES 64
+#define MC_BENCH_ITERATIONS 100000
+
+//xorshift64*, the same seed always gives the same instances
+void mc_bench_seed(uint64_t seed);
+uint64_t mc_bench_rand(void);
+
+void mc_bench_varlong(int64_t *dest);
+void mc_bench_position(mc_position *dest);
+void mc_bench_uuid(mc_uuid *dest);
+void mc_bench_string(sds *dest);
+void mc_bench_string_of(sds *dest, const char *str);
+void mc_bench_strview(mc_strview *dest);
+void mc_bench_strview_of(mc_strview *dest, const char *str);
+//len random bytes, malloc'd or pointing into a static pool for views
+char *mc_bench_bytes(size_t len);
+char *mc_bench_view(size_t len);
+void mc_bench_buffer(mc_buffer *dest);
+void mc_bench_bufview(mc_buffer *dest);
+void mc_bench_nbt(nbt_node **dest);
+void mc_bench_optnbt(nbt_node **dest);
+void mc_bench_slot(mc_slot *dest);
+void mc_bench_lazynbt(mc_lazy_nbt *dest);
+void mc_bench_lazyoptnbt(mc_lazy_nbt *dest);
+void mc_bench_lazyslot(mc_lazy_slot *dest);
+void mc_bench_smelting(mc_smelting *dest);
+//Left empty, there's nothing worth randomizing or no decoder to build them with
+void mc_bench_ingredient(mc_ingredient *dest);
+void mc_bench_metadata(mc_metadata *dest);
+void mc_bench_itemtag_array(mc_itemtag_array *dest);
+void mc_bench_particledata(mc_particle *dest);
+
+typedef struct {
+  const char *name;
+  int state;
+  int direction;
+  int32_t id;
+  void (*rand)(void *packet);
+} mc_bench_packet;
+
+//Usage: bench [iterations] [name filter], prints a line per packet
+int mc_bench_main(int argc, char **argv, const mc_bench_packet *packets,
+    size_t count,
+    const mc_packet_funcs *(*lookup)(int state, int direction, int32_t id));
+
+#endif
@@ -21,6 +21,7 @@ struct buffer {
     unsigned char* data; /* You can access the buffer's raw bytes through this pointer */
     size_t len;          /* Only accesses in the interval [data, data + len) are defined */
     size_t cap;          /* Internal use. The allocated size of the buffer. */
+    int fixed;           /* Internal use. Wraps caller memory, never grown or freed. */
 };
 
 /*
@@ -32,7 +33,13 @@ struct buffer {
  *   struct buffer b;
  *   b = BUFFER_INIT;
  */
-#define BUFFER_INIT (struct buffer) { NULL, 0, 0 }
+#define BUFFER_INIT (struct buffer) { NULL, 0, 0, 0 }
+
+/*
+ * Initialize a buffer over `size' bytes of memory you own instead. Appends that
+ * don't fit fail rather than reallocating, and buffer_free leaves it alone.
+ */
+#define BUFFER_FIXED(mem, size) (struct buffer) { (mem), 0, (size), 1 }
 
 /*
  * Frees all memory associated with the buffer. The same buffer may be freed
@@ -181,6 +181,22 @@ nbt_node* nbt_parse(const void* memory, size_t length);
 //Ghetto version to advance our memory pointer --nickelpro
 nbt_node* nbt_parse2(const void* memory, size_t length);
 
+/*
+ * Custom allocator for nbt_parse_with, alloc is called as alloc(aux, size).
+ */
+typedef struct {
+    void* (*alloc)(void* aux, size_t size);
+    void* aux;
+} nbt_allocator;
+
+/*
+ * Same as nbt_parse2, but every node, name and payload is allocated through
+ * `allocator' (malloc if it's NULL). cNBT never frees memory from a custom
+ * allocator, not even on errors, so the tree MUST NOT be passed to nbt_free.
+ * Release it all at once through whatever owns the allocator instead.
+ */
+nbt_node* nbt_parse_with(const void* memory, size_t length, const nbt_allocator* allocator);
+
 /*
  * Returns a NULL-terminated string as the ascii representation of the tree. If
  * an error occurs, NULL will be returned and errno will be set.
@@ -201,6 +217,13 @@ char* nbt_dump_ascii(const nbt_node* tree);
  */
 struct buffer nbt_dump_binary(const nbt_node* tree);
 
+/*
+ * Same as nbt_dump_binary, but writes straight into `dest' without allocating
+ * anything. Returns the number of bytes written, or 0 if an error occurs, in
+ * which case errno will be set. Running out of room is an NBT_EMEM.
+ */
+size_t nbt_dump_binary_to(const nbt_node* tree, void* dest, size_t len);
+
                    /***** Tree Manipulation Functions *****/
 
 /*
@@ -0,0 +1,76 @@
+#ifndef CAPTURE_H
+#define CAPTURE_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include "datautils.h"
+
+//Capture files hold raw packet frames for offline replay. All integers are
+//big endian, written with the datautils encoders:
+//
+//  header   "MCD2CCAP", u32 version, u32 reserved
+//  frame    u64 timestamp (ns), i32 id, u32 len, u8 state, u8 direction,
+//           len bytes of packet body, without the length or id prefix
+//  index    u64 offset of every frame, in capture order
+//  trailer  u64 index offset, u64 frame count, "MCD2CIDX"
+//
+//The index and trailer are written on mc_capture_finish. A capture that was
+//never finished is still readable, mc_capture_open rebuilds the index by
+//scanning the frames and drops a truncated last frame
+#define MC_CAPTURE_VERSION 1
+#define MC_CAPTURE_HEADER_SIZE 16
+#define MC_CAPTURE_FRAME_SIZE 18
+#define MC_CAPTURE_TRAILER_SIZE 24
+
+typedef struct {
+  FILE *fp;
+  uint64_t offset;
+  size_t count;
+  size_t cap;
+  uint64_t *offsets;
+} mc_capture_writer;
+
+//Returns 0 on success and -1 if the file couldn't be created or written
+int mc_capture_create(mc_capture_writer *writer, const char *path);
+int mc_capture_write(mc_capture_writer *writer, int state, int direction,
+    int32_t id, uint64_t timestamp, char *data, size_t len);
+//Writes the index and closes the file, the writer is released either way
+int mc_capture_finish(mc_capture_writer *writer);
+//CLOCK_REALTIME in nanoseconds, for timestamps
+uint64_t mc_capture_now(void);
+
+typedef struct {
+  char *base;
+  size_t size;
+  size_t count;
+  //be64 frame offsets, pointing into the mapping or at a rebuilt index
+  char *index;
+  char *rebuilt;
+} mc_capture;
+
+typedef struct {
+  uint64_t timestamp;
+  int state;
+  int direction;
+  int32_t id;
+  size_t len;
+  //Points into the mapping, private so decoding can't modify the file
+  char *data;
+} mc_capture_frame;
+
+//The file is mmap'd, frames stay valid until mc_capture_close
+int mc_capture_open(mc_capture *capture, const char *path);
+int mc_capture_get(const mc_capture *capture, size_t idx,
+    mc_capture_frame *frame);
+void mc_capture_close(mc_capture *capture);
+
+//Usage: replay [capture] [passes], pushes every frame through walk, dec and
+//enc, prints throughput and decode allocations per packet type followed by
+//the whole capture replayed in order. strings and max_ids are the generated
+//protocol_strings and protocol_max_ids
+int mc_replay_main(int argc, char **argv,
+    const mc_packet_funcs *(*lookup)(int state, int direction, int32_t id),
+    const char **(*strings)[2], const int (*max_ids)[2], int states);
+
+#endif
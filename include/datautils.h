@@ -1,18 +1,50 @@
 #ifndef DATAUTILS_H
 #define DATAUTILS_H
 
+#include <stddef.h>
 #include <stdint.h>
+#include <zlib.h>
 #include "sds.h"
 #include "cNBT/nbt.h"
 
 //Get the size of a member of a structure without instantiating it
 #define ssizeof(X, Y) sizeof(((X*)0)->Y)
 
+//Bump allocator for decoding. Every dec_ function takes an mc_arena *arena as
+//its last argument, if it's NULL memory comes from malloc as usual and must be
+//released with free_. Otherwise everything is carved out of the arena, free_
+//MUST NOT be called on the result and it's all released by mc_arena_reset or
+//mc_arena_free. Blocks are kept across resets, so a warmed up arena decodes
+//without touching malloc at all
+#define MC_ARENA_BLOCK_SIZE 65536
+
+typedef struct mc_arena_block mc_arena_block;
+
+typedef struct {
+  mc_arena_block *first;
+  mc_arena_block *cur;
+  size_t block_size;
+  //Allocations and bytes handed out since init, resets don't clear them
+  size_t allocs;
+  size_t allocated;
+} mc_arena;
+
+void mc_arena_init(mc_arena *arena, size_t block_size);
+void *mc_arena_alloc(mc_arena *arena, size_t size);
+void mc_arena_reset(mc_arena *arena);
+void mc_arena_free(mc_arena *arena);
+void *mc_alloc(mc_arena *arena, size_t size);
+void *mc_calloc(mc_arena *arena, size_t count, size_t size);
+
 typedef struct {
   size_t len;
   char *base;
 } mc_buffer;
 
+//dec_checked_ functions combine walk_ and dec_ in a single pass. They return
+//NULL if the type is invalid or doesn't fit in max_len, in which case dest is
+//left in a state the matching free_ function can safely release
+
 //ProtoDef Numeric Type
 char *enc_byte(char *dest, uint8_t source);
 char *dec_byte(uint8_t *dest, char *source);
@@ -36,11 +68,36 @@ char *enc_lef32(char *dest, float source);
 char *dec_lef32(float *dest, char *source);
 char *enc_lef64(char *dest, double source);
 char *dec_lef64(double *dest, char *source);
+//Bulk versions for arrays of count consecutive numerics
+char *enc_bytes(char *dest, uint8_t *source, size_t count);
+char *dec_bytes(uint8_t *dest, size_t count, char *source);
+char *enc_be16s(char *dest, uint16_t *source, size_t count);
+char *dec_be16s(uint16_t *dest, size_t count, char *source);
+char *enc_be32s(char *dest, uint32_t *source, size_t count);
+char *dec_be32s(uint32_t *dest, size_t count, char *source);
+char *enc_be64s(char *dest, uint64_t *source, size_t count);
+char *dec_be64s(uint64_t *dest, size_t count, char *source);
+char *enc_bef32s(char *dest, float *source, size_t count);
+char *dec_bef32s(float *dest, size_t count, char *source);
+char *enc_bef64s(char *dest, double *source, size_t count);
+char *dec_bef64s(double *dest, size_t count, char *source);
 
 char *enc_buffer(char *dest, mc_buffer source);
-char *dec_buffer(mc_buffer *dest, char *source, size_t len);
+char *dec_buffer(mc_buffer *dest, char *source, size_t len, mc_arena *arena);
 void free_buffer(mc_buffer buffer);
 
+//Zero-copy views, used instead of buffers and strings when generating with
+//--zero-copy. base points into the source buffer, so a view is only valid for
+//as long as that buffer is and is never freed. String views aren't null
+//terminated
+typedef mc_buffer mc_strview;
+
+#define enc_bufview enc_buffer
+char *dec_bufview(mc_buffer *dest, char *source, size_t len);
+
+//walk_ functions return the size of what they walked or one of these.
+//varnum_overrun means max_len ran out first and more data might complete it,
+//varnum_invalid means no amount of data will
 enum {
   varnum_invalid = -1,
   varnum_overrun = -2,
@@ -50,18 +107,47 @@ size_t size_varint(uint32_t varint);
 int walk_varint(char *source, size_t max_len);
 char *enc_varint(char *dest, uint32_t source);
 char *dec_varint(int32_t *dest, char *source);
+char *dec_checked_varint(int32_t *dest, char *source, size_t max_len);
+//Bulk versions for count consecutive varints
+int walk_varints(char *source, size_t count, size_t max_len);
+char *dec_checked_varints(int32_t *dest, size_t count, char *source,
+    size_t max_len);
 
 size_t size_varlong(uint64_t varint);
 int walk_varlong(char *source, size_t max_len);
 char *enc_varlong(char *dest, uint64_t source);
 char *dec_varlong(int64_t *dest, char *source);
+char *dec_checked_varlong(int64_t *dest, char *source, size_t max_len);
+int walk_varlongs(char *source, size_t count, size_t max_len);
+char *dec_checked_varlongs(int64_t *dest, size_t count, char *source,
+    size_t max_len);
 
 size_t size_string(sds string);
 int walk_string(char *source, size_t max_len);
 char *enc_string(char *dest, sds source);
-char *dec_string(sds *dest, char *source);
+char *dec_string(sds *dest, char *source, mc_arena *arena);
+char *dec_checked_string(sds *dest, char *source, size_t max_len,
+    mc_arena *arena);
 #define free_string(x) sdsfree(x)
 
+size_t size_strview(mc_strview string);
+#define walk_strview walk_string
+char *enc_strview(char *dest, mc_strview source);
+char *dec_strview(mc_strview *dest, char *source);
+char *dec_checked_strview(mc_strview *dest, char *source, size_t max_len);
+
+//String switches hash the string to a slot in a table of their case strings,
+//mc_strswitch returns that slot if the string matches the case in it, or -1
+uint32_t mc_strhash(const char *str, size_t len, uint32_t seed);
+int mc_strswitch(const char *str, size_t len, uint32_t seed,
+    const char *const *slots, uint32_t mask);
+
+//Hashing for the generated hash_ functions. Start from MC_HASH_INIT and mix
+//in every value, mc_hash_bytes mixes in len as well as the bytes
+#define MC_HASH_INIT 0xCBF29CE484222325ULL
+uint64_t mc_hash_u64(uint64_t hash, uint64_t val);
+uint64_t mc_hash_bytes(uint64_t hash, const void *data, size_t len);
+
 //Big Endian 128-bit uint
 typedef struct {
   uint64_t msb;
@@ -95,15 +181,50 @@ int walk_nbt_compound(char *source, size_t max_len);
 int walk_unnamed_nbt(char *source, nbt_type type, size_t max_len);
 int walk_nbt(char *source, size_t max_len);
 char *enc_nbt(char *dest, nbt_node *source);
-char *dec_nbt(nbt_node **dest, char *source);
+char *dec_nbt(nbt_node **dest, char *source, mc_arena *arena);
+char *dec_checked_nbt(nbt_node **dest, char *source, size_t max_len,
+    mc_arena *arena);
 #define free_nbt(x) nbt_free(x)
 
 int walk_optnbt(char *source, size_t max_len);
 size_t size_optnbt(nbt_node *nbt);
 char *enc_optnbt(char *dest, nbt_node *source);
-char *dec_optnbt(nbt_node **dest, char *source);
+char *dec_optnbt(nbt_node **dest, char *source, mc_arena *arena);
+char *dec_checked_optnbt(nbt_node **dest, char *source, size_t max_len,
+    mc_arena *arena);
 #define free_optnbt(x) nbt_free(x)
 
+//NBT kept as the raw bytes it was decoded from and only parsed when asked for,
+//so forwarding it unchanged is a bounds check and a memcpy. base points into
+//the decoded buffer like zero-copy views do. get_lazynbt parses it into node
+//on first use, allocating from the arena it was decoded with, and returns
+//NULL if there's no compound or parsing fails. Once parsed node is what gets
+//encoded, so changes to the tree are picked up. For NBT built from scratch
+//zero the struct and set node, free_ releases it unless arena is set
+typedef struct {
+  char *base;
+  size_t len;
+  nbt_node *node;
+  mc_arena *arena;
+} mc_lazy_nbt;
+
+nbt_node *get_lazynbt(mc_lazy_nbt *nbt);
+#define walk_lazynbt walk_nbt
+size_t size_lazynbt(mc_lazy_nbt nbt);
+char *enc_lazynbt(char *dest, mc_lazy_nbt source);
+char *dec_lazynbt(mc_lazy_nbt *dest, char *source, mc_arena *arena);
+char *dec_checked_lazynbt(mc_lazy_nbt *dest, char *source, size_t max_len,
+    mc_arena *arena);
+void free_lazynbt(mc_lazy_nbt nbt);
+
+#define walk_lazyoptnbt walk_optnbt
+#define size_lazyoptnbt size_lazynbt
+#define enc_lazyoptnbt enc_lazynbt
+char *dec_lazyoptnbt(mc_lazy_nbt *dest, char *source, mc_arena *arena);
+char *dec_checked_lazyoptnbt(mc_lazy_nbt *dest, char *source,
+    size_t max_len, mc_arena *arena);
+#define free_lazyoptnbt free_lazynbt
+
 //Inventory slot
 typedef struct {
   int16_t item;
@@ -115,9 +236,27 @@ typedef struct {
 int walk_slot(char *source, size_t max_len);
 size_t size_slot(mc_slot slot);
 char *enc_slot(char *dest, mc_slot source);
-char *dec_slot(mc_slot *dest, char *source);
+char *dec_slot(mc_slot *dest, char *source, mc_arena *arena);
+char *dec_checked_slot(mc_slot *dest, char *source, size_t max_len,
+    mc_arena *arena);
 void free_slot(mc_slot slot);
 
+//Slot with lazy NBT
+typedef struct {
+  int16_t item;
+  uint8_t count;
+  int16_t damage;
+  mc_lazy_nbt nbt;
+} mc_lazy_slot;
+
+#define walk_lazyslot walk_slot
+size_t size_lazyslot(mc_lazy_slot slot);
+char *enc_lazyslot(char *dest, mc_lazy_slot source);
+char *dec_lazyslot(mc_lazy_slot *dest, char *source, mc_arena *arena);
+char *dec_checked_lazyslot(mc_lazy_slot *dest, char *source, size_t max_len,
+    mc_arena *arena);
+#define free_lazyslot(x) free_lazynbt((x).nbt)
+
 //Varint prefixed array of slots
 typedef struct {
   int32_t count;
@@ -127,7 +266,9 @@ typedef struct {
 int walk_ingredient(char *source, size_t max_len);
 size_t size_ingredient(mc_ingredient ingredient);
 char *enc_ingredient(char *dest, mc_ingredient source);
-char *dec_ingredient(mc_ingredient *dest, char *source);
+char *dec_ingredient(mc_ingredient *dest, char *source, mc_arena *arena);
+char *dec_checked_ingredient(mc_ingredient *dest, char *source,
+    size_t max_len, mc_arena *arena);
 void free_ingredient(mc_ingredient ingredient);
 
 typedef struct {
@@ -141,7 +282,9 @@ typedef struct {
 int walk_smelting(char *source, size_t max_len);
 size_t size_smelting(mc_smelting smelting);
 char *enc_smelting(char *dest, mc_smelting source);
-char *dec_smelting(mc_smelting *dest, char *source);
+char *dec_smelting(mc_smelting *dest, char *source, mc_arena *arena);
+char *dec_checked_smelting(mc_smelting *dest, char *source, size_t max_len,
+    mc_arena *arena);
 void free_smelting(mc_smelting smelting);
 
 typedef enum {
@@ -214,13 +357,16 @@ typedef struct {
 int walk_particledata(char *source, size_t max_len, particle_type type);
 size_t size_particledata(mc_particle particle);
 char *enc_particledata(char *dest, mc_particle source);
-char *dec_particledata(mc_particle *dest, char *source, particle_type type);
+char *dec_particledata(mc_particle *dest, char *source, particle_type type,
+    mc_arena *arena);
+char *dec_checked_particledata(mc_particle *dest, char *source, size_t max_len,
+    particle_type type, mc_arena *arena);
 void free_particledata(mc_particle particle);
 
 int walk_particle(char *source, size_t max_len);
 size_t size_particle(mc_particle particle);
 char *enc_particle(char *dest, mc_particle source);
-char *dec_particle(mc_particle *dest, char *source);
+char *dec_particle(mc_particle *dest, char *source, mc_arena *arena);
 #define free_particle free_particledata
 
 
@@ -268,7 +414,9 @@ size_t count_metatags(char *source);
 int walk_metadata(char *source, size_t max_len);
 size_t size_metadata(mc_metadata metadata);
 char *enc_metadata(char *dest, mc_metadata source);
-char *dec_metadata(mc_metadata *dest, char *source);
+char *dec_metadata(mc_metadata *dest, char *source, mc_arena *arena);
+char *dec_checked_metadata(mc_metadata *dest, char *source, size_t max_len,
+    mc_arena *arena);
 void free_metadata(mc_metadata metadata);
 
 typedef struct {
@@ -285,13 +433,242 @@ typedef struct {
 int walk_itemtag_array(char *source, size_t max_len);
 size_t size_itemtag_array(mc_itemtag_array itemtag_array);
 char *enc_itemtag_array(char *dest, mc_itemtag_array source);
-char *dec_itemtag_array(mc_itemtag_array *dest, char *source);
+char *dec_itemtag_array(mc_itemtag_array *dest, char *source,
+    mc_arena *arena);
+char *dec_checked_itemtag_array(mc_itemtag_array *dest, char *source,
+    size_t max_len, mc_arena *arena);
 void free_itemtag_array(mc_itemtag_array array);
 
+//Unframed packet, for batch encoding len is set to the size of the body
 typedef struct {
   int id;
   size_t len;
   void *data;
 } mc_packet;
 
+//A frame is a varint length, then the varint packet id and the packet body.
+//The length covers the id and body and is at most 3 bytes on the wire
+#define MC_MAX_FRAME_LEN 2097151
+
+typedef struct {
+  int32_t id;
+  size_t len;
+  char *body;
+} mc_frame;
+
+//Finds the frame at the start of source, body points into source, nothing is
+//copied. Returns the size of the whole frame, varnum_overrun if source doesn't
+//hold all of it yet or varnum_invalid if it's malformed
+int dec_frame(mc_frame *frame, char *source, size_t max_len);
+size_t size_frame(int32_t id, size_t body_len);
+char *enc_frame_header(char *dest, int32_t id, size_t body_len);
+
+//Splits a byte stream read into a caller owned buffer into frames:
+//  while((dest = mc_stream_space(&stream, &avail))) {
+//    mc_stream_commit(&stream, read(fd, dest, avail));
+//    while(mc_stream_next(&stream, &frame) > 0)
+//      handle(frame);
+//  }
+//Frames point into the buffer and are only valid until the next
+//mc_stream_space call, which moves unconsumed data to the front. It returns
+//NULL once the buffer is full, ie: the pending frame is bigger than it
+typedef struct {
+  char *buf;
+  size_t size;
+  size_t start;
+  size_t end;
+} mc_stream;
+
+void mc_stream_init(mc_stream *stream, char *buf, size_t size);
+char *mc_stream_space(mc_stream *stream, size_t *avail);
+void mc_stream_commit(mc_stream *stream, size_t len);
+int mc_stream_next(mc_stream *stream, mc_frame *frame);
+
+//Once compression is enabled a frame is a varint length, then the varint
+//length of the uncompressed id and body, or 0 if they're sent as is. Packets
+//of at least threshold bytes get compressed, the uncompressed length is capped
+//at MC_MAX_DATA_LEN
+#define MC_MAX_DATA_LEN 8388608
+
+//Per-connection zlib state, the streams are reset rather than reinitialized
+//for every frame so the window and hash tables are only allocated once
+typedef struct {
+  z_stream deflate;
+  z_stream inflate;
+  size_t threshold;
+} mc_compression;
+
+//level is a zlib compression level, ie: Z_DEFAULT_COMPRESSION. Returns 0 on
+//success, anything else is a zlib error
+int mc_compression_init(mc_compression *comp, size_t threshold, int level);
+void mc_compression_free(mc_compression *comp);
+
+//dec_frame for compressed connections. Uncompressed bodies point into source,
+//compressed ones are inflated into dest if dest_len is enough for the
+//uncompressed length, otherwise into a buffer from arena. With no arena that's
+//a failure, a dest of MC_MAX_DATA_LEN bytes never needs one. Bodies in dest
+//are overwritten by the next frame. Returns the size of the whole frame in
+//source or one of varnum_errors
+int dec_compressed_frame(mc_compression *comp, mc_frame *frame, char *source,
+    size_t max_len, char *dest, size_t dest_len, mc_arena *arena);
+//Upper bound on the size of a frame, compressed or not
+size_t size_compressed_frame(mc_compression *comp, int32_t id,
+    size_t body_len);
+//Writes a whole frame, compressing id and body if they reach the threshold.
+//body must not overlap dest. Returns the end of the frame or NULL if it
+//doesn't fit in max_len
+char *enc_compressed_frame(mc_compression *comp, char *dest, size_t max_len,
+    int32_t id, char *body, size_t body_len);
+//mc_stream_next for compressed connections, dest and arena are passed on to
+//dec_compressed_frame
+int mc_stream_next_compressed(mc_stream *stream, mc_compression *comp,
+    mc_frame *frame, char *dest, size_t dest_len, mc_arena *arena);
+
+//Output buffer for enc_grow_ functions that's realloc'd as needed. Zero
+//initialize it, encoded packets are appended at len
+#define MC_GROWBUF_MIN_SIZE 256
+
+typedef struct {
+  char *base;
+  size_t len;
+  size_t cap;
+} mc_growbuf;
+
+//Makes room for at least size more bytes, returns non-zero if realloc fails
+int mc_growbuf_reserve(mc_growbuf *buf, size_t size);
+void mc_growbuf_free(mc_growbuf *buf);
+
+//Resizes the first old_len of the len bytes at buf to new_len bytes, moving
+//the rest along, for patch_ functions writing a varint of a different size.
+//Returns the new len, or varnum_overrun if that's more than cap. The resized
+//bytes are left for the caller to overwrite
+int mc_splice(char *buf, size_t len, size_t cap, size_t old_len,
+    size_t new_len);
+
+//Progress of a packet body walk that ran out of bytes, so it can pick up
+//where it left off once more arrive instead of starting over. Zero initialize
+//one per packet and pass walk_resume_ the whole body received so far. offset
+//and step mark the last completed field, need is the least body length the
+//walk could complete with, anything shorter returns varnum_overrun up front.
+//Walking stops checkpointing at the first field a later switch depends on
+typedef struct {
+  size_t offset;
+  int step;
+  size_t need;
+} mc_walk_cursor;
+
+//Type-erased packet functions, generated code builds per-state/direction
+//tables of these indexed by packet id. Fieldless packets have all-NULL entries.
+//min_size and max_size bound the encoded size, max_size is SIZE_MAX if the
+//packet has no upper bound and equal to min_size if it's fixed size. hash and
+//eq are NULL for packets with fields that can't be compared, ie: NBT
+typedef struct {
+  size_t packet_size;
+  size_t min_size;
+  size_t max_size;
+  int (*walk)(char *source, size_t max_len);
+  int (*walk_resume)(mc_walk_cursor *cursor, char *source, size_t max_len);
+  size_t (*size)(void *packet);
+  char *(*enc)(char *dest, void *packet);
+  char *(*dec)(void *dest, char *source, size_t len, mc_arena *arena);
+  char *(*dec_checked)(void *dest, char *source, size_t max_len,
+      mc_arena *arena);
+  void (*free)(void *packet);
+  uint64_t (*hash)(void *packet);
+  int (*eq)(void *a, void *b);
+} mc_packet_funcs;
+
+//Encode-once cache for packets sent to many connections, ie: the same block
+//change going to every player in range. mc_frame_cache_get returns the frame
+//for a packet, encoding it only if no equal packet of the same id is cached:
+//  mc_cached_frame *frame = mc_frame_cache_get(&cache, funcs, id, &packet);
+//  for(size_t i = 0; i < count; i++)
+//    queue(players[i], frame->frame, frame->len);
+//  mc_frame_cache_release(&cache, frame);
+//Every get must be matched by a release, and so must every mc_frame_cache_ref
+//for holders that outlive the call, ie: per-connection send queues. Released
+//frames stay cached until more than max_frames are, then the least recently
+//released go. Frames aren't compressed, body and body_len are the packet body
+//to pass enc_compressed_frame instead. The cache isn't thread safe
+typedef struct mc_cached_frame mc_cached_frame;
+
+struct mc_cached_frame {
+  char *frame;
+  size_t len;
+  char *body;
+  size_t body_len;
+  size_t refs;
+  //The rest is for the cache, the packet is decoded back out of the frame
+  //so it doesn't depend on the caller's
+  uint64_t hash;
+  int32_t id;
+  const mc_packet_funcs *funcs;
+  void *packet;
+  int cached;
+  mc_cached_frame *next;
+  mc_cached_frame *lru_prev;
+  mc_cached_frame *lru_next;
+};
+
+typedef struct {
+  mc_cached_frame **buckets;
+  size_t mask;
+  //Unreferenced frames, least recently released first
+  mc_cached_frame *lru_head;
+  mc_cached_frame *lru_tail;
+  size_t count;
+  size_t max_frames;
+  uint64_t hits;
+  uint64_t misses;
+} mc_frame_cache;
+
+//Returns non-zero if allocating the buckets fails
+int mc_frame_cache_init(mc_frame_cache *cache, size_t max_frames);
+//Returns NULL if the packet has no hash and eq or encoding it fails
+mc_cached_frame *mc_frame_cache_get(mc_frame_cache *cache,
+    const mc_packet_funcs *funcs, int32_t id, void *packet);
+void mc_frame_cache_release(mc_frame_cache *cache, mc_cached_frame *frame);
+//Frees every frame, including ones that are still referenced
+void mc_frame_cache_free(mc_frame_cache *cache);
+
+static inline void mc_frame_cache_ref(mc_cached_frame *frame) {
+  frame->refs++;
+}
+
+//Counters kept for every packet by code generated with --instrument, exported
+//as protocol_counters. ticks is only collected when the generated code is
+//built with MC_INSTRUMENT_TIME, in TSC cycles on x86-64 and nanoseconds
+//elsewhere. Counters aren't atomic, read them from the thread doing the work
+typedef struct {
+  uint64_t calls;
+  uint64_t bytes;
+  uint64_t failures;
+  uint64_t ticks;
+} mc_op_counters;
+
+typedef struct {
+  mc_op_counters walk;
+  mc_op_counters dec;
+  mc_op_counters enc;
+  mc_op_counters free;
+} mc_packet_counters;
+
+uint64_t mc_instrument_clock(void);
+#ifdef MC_INSTRUMENT_TIME
+#define mc_instrument_now() mc_instrument_clock()
+#else
+#define mc_instrument_now() 0
+#endif
+
+//bytes is what the call consumed or produced, negative if it failed
+static inline void mc_count(mc_op_counters *counters, uint64_t start,
+    int64_t bytes) {
+  counters->ticks += mc_instrument_now() - start;
+  counters->calls++;
+  if(bytes < 0)
+    counters->failures++;
+  else
+    counters->bytes += bytes;
+}
+
 #endif
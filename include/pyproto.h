@@ -0,0 +1,70 @@
+#ifndef PYPROTO_H
+#define PYPROTO_H
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stddef.h>
+#include <stdint.h>
+#include "datautils.h"
+
+//Support for the py_[version].c CPython extension modules generated with
+//--python. Each packet gets a pair of functions converting it to and from a
+//dict keyed by field name, the module functions are all in pyproto.c:
+//
+//  decode(state, direction, id, data) -> dict
+//  encode(state, direction, id, packet) -> bytes
+//  decode_frames(state, direction, data) -> ([(id, dict), ...], consumed)
+//  packet_name(state, direction, id) -> str
+//
+//data is anything supporting the buffer protocol. Packet bodies are what
+//dec_[packet_name] takes, without the length or id prefix
+
+typedef struct {
+  //New reference to a dict holding the packet, NULL with an exception set
+  PyObject *(*topy)(void *packet);
+  //Fills a zeroed packet, returns -1 with an exception set on failure. The
+  //packet is always left in a state free_[packet_name] can release
+  int (*frompy)(PyObject *dict, void *packet);
+} mc_py_packet;
+
+typedef struct {
+  const char *name;
+  const mc_packet_funcs *(*lookup)(int state, int direction, int32_t id);
+  const mc_py_packet *(*packets)[2];
+  const char **(*strings)[2];
+  const int (*max_ids)[2];
+  int states;
+} mc_py_protocol;
+
+//Called from the generated PyInit_ function, protocol has to outlive the
+//module. packets is indexed like protocol_funcs
+PyObject *mc_py_module(const mc_py_protocol *protocol);
+
+//Helpers for the generated conversions. The setters take a new reference to
+//val, or NULL for a failed conversion, and steal it. All of them return -1
+//with an exception set on failure
+int mc_py_set(PyObject *dict, const char *key, PyObject *val);
+int mc_py_item(PyObject *list, Py_ssize_t idx, PyObject *val);
+//Borrowed reference, KeyError if the field is missing
+PyObject *mc_py_get(PyObject *dict, const char *key);
+PyObject *mc_py_none(void);
+//Integers narrower than 64 bits, OverflowError if obj is outside min to max.
+//Check PyErr_Occurred for failure, same as PyLong_AsLongLong
+int64_t mc_py_int(PyObject *obj, int64_t min, int64_t max);
+uint64_t mc_py_uint(PyObject *obj, uint64_t max);
+//Checks obj is a list, and of exactly len items unless len is negative
+int mc_py_list(PyObject *obj, Py_ssize_t len);
+//Points dest at the contents of a bytes object, nothing is copied
+int mc_py_bytes(PyObject *obj, mc_buffer *dest);
+//malloc'd copy of a bytes object, for owning buffers
+int mc_py_buffer(PyObject *obj, mc_buffer *dest);
+int mc_py_string(PyObject *obj, sds *dest);
+//Points into the str's UTF-8 representation, which lives as long as it does
+int mc_py_strview(PyObject *obj, mc_strview *dest);
+//UUIDs are 16 big endian bytes, uuid.UUID(bytes=...) takes them as is
+PyObject *mc_py_from_uuid(mc_uuid uuid);
+int mc_py_uuid(PyObject *obj, mc_uuid *dest);
+//Sets ValueError for bytes that aren't a valid encoding of type
+int mc_py_invalid(const char *type);
+
+#endif
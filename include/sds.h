@@ -216,6 +216,8 @@ static inline void sdssetalloc(sds s, size_t newlen) {
 }
 
 sds sdsnewlen(const void *init, size_t initlen);
+sds sdsnewlenwith(const void *init, size_t initlen,
+        void *(*alloc)(void *ctx, size_t size), void *ctx);
 sds sdsnew(const char *init);
 sds sdsempty(void);
 sds sdsdup(const sds s);
@@ -1,6 +1,35 @@
-import sys
-version = sys.argv[1]
-print('Generating version', version)
+import argparse
+parser = argparse.ArgumentParser(
+    description = 'Generate C code from the minecraft-data protocol spec'
+)
+parser.add_argument('version')
+parser.add_argument('--zero-copy', action = 'store_true',
+    help = 'decode strings and buffers as views into the source buffer')
+parser.add_argument('--lazy-nbt', action = 'store_true',
+    help = 'decode nbt as raw bytes in the source buffer, parsed on access')
+parser.add_argument('--bench', action = 'store_true',
+    help = 'also generate a benchmark of every packet, see bench.h')
+parser.add_argument('--replay', action = 'store_true',
+    help = 'also generate a capture file replay tool, see capture.h')
+parser.add_argument('--instrument', action = 'store_true',
+    help = 'count calls, bytes and failures per packet in protocol_counters')
+parser.add_argument('--python', action = 'store_true',
+    help = 'also generate a CPython extension module, see pyproto.h')
+parser.add_argument('--pure-python', action = 'store_true',
+    help = 'also generate a pure Python codec module, see datautils.py')
+parser.add_argument('--peek', action = 'append', default = [],
+    metavar = 'PACKET/FIELD',
+    help = 'generate a function decoding only this field, can be repeated')
+parser.add_argument('--patch', action = 'append', default = [],
+    metavar = 'PACKET/FIELD',
+    help = 'generate a function overwriting this field in place, can be '
+    'repeated')
+args = parser.parse_args()
+print('Generating version', args.version)
 
 import mcd2c
-mcd2c.run(version)
+mcd2c.run(args.version, zero_copy = args.zero_copy, lazy_nbt = args.lazy_nbt,
+    bench = args.bench, replay = args.replay, instrument = args.instrument,
+    python = args.python, pure_python = args.pure_python,
+    peek = [tuple(p.split('/', 1)) for p in args.peek],
+    patch = [tuple(p.split('/', 1)) for p in args.patch])
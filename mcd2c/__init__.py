@@ -3,12 +3,13 @@
 # For the straight-forward pathway had been lost.
 
 import mcd2c.cfile as c
+import mcd2c.pyfile as pyf
 import copy
+import keyword
 
 # General ToDo:
-#   ! Failed allocations in decode functions cannot recover memory. Consider
-#     using calloc and expanding free functions to make 'free_'ing failed
-#     decodes safe or just aborting on failed malloc
+#   ! Failed allocations in the unchecked dec_ functions still cannot recover
+#     memory, use dec_checked_ or decode into an arena if that matters
 #   ! cfile needs better pointer support
 #   ! cfile's fcall is a constant source of bugs because of the return type
 #     argument being where most cfile classes put their "elems" argument, and
@@ -26,26 +27,100 @@ def mc_data_name(typename):
 class generic_type:
     typename = ''
     postfix = ''
+    # Bounds on the encoded size in bytes, max_size is None if unbounded
+    min_size = 0
+    max_size = None
 
     def __init__(self, name, parent):
         self._name = name
         self.parent = parent
         self.internal = c.variable(name, self.typename)
         self.switched = False
+        # Case values of the switches on this field and whether it's the
+        # count of an array, random instances in the benchmarks stick to them
+        self.switch_values = []
+        self.counts = False
 
     def struct_line(self):
         return c.statement(self.internal.decl)
 
-    def enc_line(self, ret, dest, src):
-        return c.statement(c.assign(
+    # Encoders take an end pointer and a fail sequence for bounds checked
+    # encoding, run when there isn't room for what's about to be written
+    def enc_line(self, ret, dest, src, end = None, fail = None):
+        line = c.statement(c.assign(
             ret, c.fcall(f'enc_{self.postfix}', 'char *', (dest, src))
         ))
+        if end is None:
+            return line
+        return c.sequence((self.bound_line(dest, src, end, fail), line))
 
     def dec_line(self, ret, dest, src):
         return c.statement(c.assign(
             ret, c.fcall(f'dec_{self.postfix}', 'char *', (f'&{dest}', src))
         ))
 
+    # Fills dest with a random value for bench_[version].c, the runtime
+    # mc_bench_ functions in bench.h handle everything that isn't generated
+    def rand_line(self, dest):
+        if self.switch_values:
+            values = ', '.join(str(v) for v in self.switch_values)
+            return c.statement(c.assign(dest, (
+                f'({self.typename}[]){{{values}}}'
+                f'[mc_bench_rand() % {len(self.switch_values)}]'
+            )))
+        if self.counts:
+            return c.statement(c.assign(
+                dest, 'mc_bench_rand() % MC_BENCH_MAX_COUNT'
+            ))
+        return c.statement(c.fcall(
+            f'mc_bench_{self.postfix}', 'void', (f'&{dest}',)
+        ))
+
+    # Converts src to a Python object stored in parent for py_[version].c,
+    # parent is a dict and key a field name or parent is a list and key an
+    # index variable. py[depth] is scratch for this field, anything nested in
+    # it uses the slots after. Failures jump to the fail label with an
+    # exception set, see pyproto.h
+    def topy_line(self, parent, key, src, depth):
+        return py_insert(parent, key, self.topy_val(src))
+
+    def frompy_line(self, parent, key, dest, depth):
+        obj = f'py[{depth}]'
+        return c.sequence((
+            py_fetch(obj, parent, key), self.frompy_val(obj, dest, depth)
+        ))
+
+    # Lines for the pure Python codecs in codec_[version].py. Decoders read
+    # from view at pos into dest and encoders write src to buf at pos, both
+    # leave pos after the field. dest and src are Python expressions, scope is
+    # the pyscope of the function being generated
+    def pysize_line(self, size, src, scope):
+        return pyf.line(f'{size} += {self.pysize_val(src)}')
+
+    # Field of a NumPy layout in codec_[version].py, see Layout in datautils.py,
+    # None if the type doesn't have a fixed layout
+    def np_field(self):
+        return None
+
+    # Members of the structure of arrays dec_batch_ decodes into, as (path in
+    # the packet struct, typename) pairs. typename is None for the anonymous
+    # structs and unions, those arrays are declared with __typeof__
+    def soa_fields(self, path):
+        return [(path, self.typename or None)]
+
+    # Lines for hash_ and eq_, hash_line mixes src into hash and eq_line
+    # returns 0 if a and b differ. Runtime types with no way to compare them
+    # aren't hashable, and neither are packets containing them
+    hashable = False
+
+    def hash_line(self, hash, src):
+        return c.statement(c.assign(hash, c.fcall(
+            'mc_hash_u64', 'uint64_t', (hash, f'(uint64_t) {src}')
+        )))
+
+    def eq_line(self, a, b):
+        return c.inlineif(c.noteq(a, b), c.returnval(0))
+
     def __eq__(self, value):
         return self.typename == value.typename
 
@@ -63,6 +138,78 @@ class generic_type:
 
 class numeric_type(generic_type):
     size = 0
+    # Arrays of bulk types are encoded and decoded a whole run at a time
+    bulk = False
+    # CPython API functions converting to and from Python objects
+    py_from = 'PyLong_FromUnsignedLongLong'
+    py_to = 'PyLong_AsUnsignedLongLong'
+    # Extra arguments to py_to, the C type's limits for the narrower integers
+    # so out of range values raise instead of being truncated
+    py_to_args = ()
+    # struct module format of the pure Python codecs
+    py_format = ''
+    hashable = True
+
+    def bound_line(self, dest, src, end, fail):
+        return enc_short_line(dest, end, self.size, fail)
+
+    def bulk_enc_line(self, ret, dest, src, count):
+        return c.statement(c.assign(ret, c.fcall(
+            f'enc_{self.postfix}s', 'char *', (dest, src, count)
+        )))
+
+    def bulk_dec_line(self, ret, dest, src, count):
+        return c.statement(c.assign(ret, c.fcall(
+            f'dec_{self.postfix}s', 'char *', (dest, count, src)
+        )))
+
+    def rand_line(self, dest):
+        if self.switch_values or self.counts:
+            return super().rand_line(dest)
+        return c.statement(c.assign(dest, f'({self.typename}) mc_bench_rand()'))
+
+    def topy_val(self, src):
+        return c.fcall(self.py_from, 'PyObject *', (src,))
+
+    def frompy_val(self, obj, dest, depth):
+        return c.sequence((
+            c.statement(c.assign(dest, c.fcall(
+                self.py_to, self.typename, (obj, *self.py_to_args)
+            ))),
+            c.inlineif('PyErr_Occurred()', c.statement('goto fail')),
+        ))
+
+    # Runs of numerics are unpacked into their targets all at once, types
+    # that need converting go through a temporary and the returned lines
+    def py_target(self, dest, scope):
+        return dest, []
+
+    def py_value(self, src):
+        return src
+
+    def pydec_line(self, dest, scope):
+        return py_unpack([(self, dest)], scope)
+
+    def pyenc_line(self, src, scope):
+        return py_pack([(self, src)])
+
+    def pysize_val(self, src):
+        return str(self.size)
+
+    @property
+    def np_format(self):
+        return f'>{self.py_format}'
+
+    def np_field(self):
+        return f"({py_attr(self.name)!r}, '{self.np_format}')"
+
+    @property
+    def min_size(self):
+        return self.size
+
+    @property
+    def max_size(self):
+        return self.size
 
 # Why does this even need to exist?
 @mc_data_name('void')
@@ -71,77 +218,208 @@ class void_type(numeric_type):
     def struct_line(self):
         return c.linecomment(f'\'{self.name}\' is a void type')
 
-    def enc_line(self, ret, dest, src):
+    def enc_line(self, ret, dest, src, end = None, fail = None):
         return c.linecomment(f'\'{self.name}\' is a void type')
 
     def dec_line(self, ret, dest, src):
         return c.linecomment(f'\'{self.name}\' is a void type')
 
+    def rand_line(self, dest):
+        return c.linecomment(f'\'{self.name}\' is a void type')
+
+    def soa_fields(self, path):
+        return []
+
+    def hash_line(self, hash, src):
+        return c.linecomment(f'\'{self.name}\' is a void type')
+
+    def eq_line(self, a, b):
+        return c.linecomment(f'\'{self.name}\' is a void type')
+
+    def topy_line(self, parent, key, src, depth):
+        return c.linecomment(f'\'{self.name}\' is a void type')
+
+    def frompy_line(self, parent, key, dest, depth):
+        return c.linecomment(f'\'{self.name}\' is a void type')
+
 @mc_data_name('u8')
 class num_u8(numeric_type):
+    bulk = True
+    py_format = 'B'
     size = 1
     typename = 'uint8_t'
     postfix = 'byte'
+    py_to = 'mc_py_uint'
+    py_to_args = ('UINT8_MAX',)
 
 @mc_data_name('i8')
 class num_i8(num_u8):
+    py_format = 'b'
+    py_from = 'PyLong_FromLongLong'
+    py_to = 'mc_py_int'
+    py_to_args = ('INT8_MIN', 'INT8_MAX')
     typename = 'int8_t'
 
 @mc_data_name('bool')
 class num_bool(num_u8):
-    pass
+    py_format = '?'
+    py_from = 'PyBool_FromLong'
+    py_to = 'PyObject_IsTrue'
+    py_to_args = ()
+
+    def rand_line(self, dest):
+        if self.switch_values:
+            return super().rand_line(dest)
+        return c.statement(c.assign(dest, 'mc_bench_rand() & 1'))
 
 @mc_data_name('u16')
 class num_u16(numeric_type):
+    bulk = True
+    py_format = 'H'
     size = 2
     typename = 'uint16_t'
     postfix = 'be16'
+    py_to = 'mc_py_uint'
+    py_to_args = ('UINT16_MAX',)
 
 @mc_data_name('i16')
 class num_i16(num_u16):
+    py_format = 'h'
+    py_from = 'PyLong_FromLongLong'
+    py_to = 'mc_py_int'
+    py_to_args = ('INT16_MIN', 'INT16_MAX')
     typename = 'int16_t'
 
 @mc_data_name('u32')
 class num_u32(numeric_type):
+    bulk = True
+    py_format = 'I'
     size = 4
     typename = 'uint32_t'
     postfix = 'be32'
+    py_to = 'mc_py_uint'
+    py_to_args = ('UINT32_MAX',)
 
 @mc_data_name('i32')
 class num_i32(num_u32):
+    py_format = 'i'
+    py_from = 'PyLong_FromLongLong'
+    py_to = 'mc_py_int'
+    py_to_args = ('INT32_MIN', 'INT32_MAX')
     typename = 'int32_t'
 
 @mc_data_name('u64')
 class num_u64(numeric_type):
+    bulk = True
+    py_format = 'Q'
     size = 8
     typename = 'uint64_t'
     postfix = 'be64'
 
 @mc_data_name('i64')
 class num_i64(num_u64):
+    py_format = 'q'
+    py_from = 'PyLong_FromLongLong'
+    py_to = 'PyLong_AsLongLong'
     typename = 'int64_t'
 
 @mc_data_name('f32')
 class num_float(num_u32):
+    py_format = 'f'
+    py_from = 'PyFloat_FromDouble'
+    py_to = 'PyFloat_AsDouble'
+    py_to_args = ()
     typename = 'float'
     postfix = 'bef32'
 
+    # Bitwise, -0.0 and 0.0 encode differently and NaNs equal themselves
+    def hash_line(self, hash, src):
+        return hash_bytes_line(hash, f'&{src}', f'sizeof({src})')
+
+    def eq_line(self, a, b):
+        return c.inlineif(
+            f'memcmp(&{a}, &{b}, sizeof({a}))', c.returnval(0)
+        )
+
 @mc_data_name('f64')
 class num_double(num_u64):
+    py_format = 'd'
+    py_from = 'PyFloat_FromDouble'
+    py_to = 'PyFloat_AsDouble'
     typename = 'double'
     postfix = 'bef64'
+    hash_line = num_float.hash_line
+    eq_line = num_float.eq_line
 
 # Positions and UUIDs are broadly similar to numeric types
 @mc_data_name('position')
 class num_position(num_u64):
+    bulk = False
     typename = 'mc_position'
     postfix = 'position'
 
+    def rand_line(self, dest):
+        return generic_type.rand_line(self, dest)
+
+    # (x, y, z) tuples
+    def topy_val(self, src):
+        return c.fcall('Py_BuildValue', 'PyObject *', (
+            '"(iii)"', f'{src}.x', f'{src}.y', f'{src}.z'
+        ))
+
+    def frompy_val(self, obj, dest, depth):
+        return c.inlineif(c.wrap(c.fcall('PyArg_ParseTuple', 'int', (
+            obj, '"iii"', f'&{dest}.x', f'&{dest}.y', f'&{dest}.z'
+        )), True), c.statement('goto fail'))
+
+    def py_target(self, dest, scope):
+        tmp = scope.fresh('t')
+        return tmp, [f'{dest} = dec_position({tmp})']
+
+    def py_value(self, src):
+        return f'enc_position({src})'
+
+    def np_field(self):
+        return f"({py_attr(self.name)!r}, '{self.np_format}', POSITION)"
+
+    def hash_line(self, hash, src):
+        return c.sequence([
+            generic_type.hash_line(self, hash, f'{src}.{m}') for m in 'xyz'
+        ])
+
+    def eq_line(self, a, b):
+        return c.sequence([
+            generic_type.eq_line(self, f'{a}.{m}', f'{b}.{m}') for m in 'xyz'
+        ])
+
 @mc_data_name('UUID')
 class num_uuid(numeric_type):
     size = 16
     typename = 'mc_uuid'
     postfix = 'uuid'
+    py_from = 'mc_py_from_uuid'
+    py_format = '16s'
+    # Raw bytes, S16 would drop trailing zero bytes
+    np_format = 'V16'
+
+    def rand_line(self, dest):
+        return generic_type.rand_line(self, dest)
+
+    def frompy_val(self, obj, dest, depth):
+        return c.inlineif(c.fcall('mc_py_uuid', 'int', (obj, f'&{dest}')),
+            c.statement('goto fail'))
+
+    def hash_line(self, hash, src):
+        return c.sequence([
+            generic_type.hash_line(self, hash, f'{src}.{m}')
+            for m in ('msb', 'lsb')
+        ])
+
+    def eq_line(self, a, b):
+        return c.sequence([
+            generic_type.eq_line(self, f'{a}.{m}', f'{b}.{m}')
+            for m in ('msb', 'lsb')
+        ])
 
 class complex_type(generic_type):
     def size_line(self, size, src):
@@ -149,37 +427,95 @@ class complex_type(generic_type):
             c.addeq(size, c.fcall(f'size_{self.postfix}', 'size_t', (src,)))
         )
 
+    def bound_line(self, dest, src, end, fail):
+        return enc_short_line(
+            dest, end, c.fcall(f'size_{self.postfix}', 'size_t', (src,)), fail
+        )
+
     def walk_line(self, ret, src, max_len, fail):
         assign = c.wrap(c.assign(
             ret, c.fcall(f'walk_{self.postfix}', 'int', (src, max_len))
         ))
         return c.ifcond(c.lth(assign, 0), (fail,))
 
+    # Fused walk and decode, dec_checked_ runtime functions return NULL on
+    # failure and leave dest in a state the matching free_ can release
+    def checked_dec_line(self, dest, src, end, fail):
+        assign = c.wrap(c.assign(src, c.fcall(
+            f'dec_checked_{self.postfix}', 'char *',
+            (f'&{dest}', src, c.subop(end, src))
+        )), True)
+        return c.ifcond(assign, (copy.deepcopy(fail),))
+
+# Arrays of these are walked and decoded in bulk with the plural runtime
+# functions, ie: walk_varlongs
+class varnum_type(complex_type):
+    typename = 'int64_t'
+    postfix = 'varlong'
+    # Encoded as a varlong, so negative values take the full ten bytes
+    min_size = 1
+    max_size = 10
+    hashable = True
+    py_from = 'PyLong_FromLongLong'
+    py_to = 'PyLong_AsLongLong'
+    py_to_args = ()
+    topy_val = numeric_type.topy_val
+    frompy_val = numeric_type.frompy_val
+
+    def pydec_line(self, dest, scope):
+        return pyf.line(f'{dest}, pos = dec_varint(view, pos)')
+
+    def pyenc_line(self, src, scope):
+        return pyf.line(f'pos = enc_varint(buf, pos, {src})')
+
+    def pysize_val(self, src):
+        return f'size_varint({src})'
+
+    def bulk_walk_line(self, ret, src, count, max_len, fail):
+        assign = c.wrap(c.assign(ret, c.fcall(
+            f'walk_{self.postfix}s', 'int', (src, count, max_len)
+        )))
+        return c.ifcond(c.lth(assign, 0), (fail,))
+
+    def bulk_checked_dec_line(self, dest, src, count, end, fail):
+        assign = c.wrap(c.assign(src, c.fcall(
+            f'dec_checked_{self.postfix}s', 'char *',
+            (dest, count, src, c.subop(end, src))
+        )), True)
+        return c.ifcond(assign, (copy.deepcopy(fail),))
+
 @mc_data_name('varint')
-class mc_varint(complex_type):
+class mc_varint(varnum_type):
     # typename = 'int32_t'
     # postfix = 'varint'
     # All varints are varlongs until this gets fixed
     # https://github.com/PrismarineJS/minecraft-data/issues/119
-    typename = 'int64_t'
-    postfix = 'varlong'
+    pass
 
 @mc_data_name('varlong')
-class mc_varlong(complex_type):
-    typename = 'int64_t'
-    postfix = 'varlong'
+class mc_varlong(varnum_type):
+    pass
 
-# Types which require some level of memory management
+# Types which require some level of memory management, their runtime dec_
+# functions all take the arena the generated function was handed
 class memory_type(complex_type):
     def dec_line(self, ret, dest, src):
         assign = c.wrap(c.assign(ret, c.fcall(
-            f'dec_{self.postfix}', 'char *', (f'&{dest}', src)
+            f'dec_{self.postfix}', 'char *', (f'&{dest}', src, 'arena')
         )), True)
         return c.inlineif(assign, c.returnval('NULL'))
 
+    def checked_dec_line(self, dest, src, end, fail):
+        assign = c.wrap(c.assign(src, c.fcall(
+            f'dec_checked_{self.postfix}', 'char *',
+            (f'&{dest}', src, c.subop(end, src), 'arena')
+        )), True)
+        return c.ifcond(assign, (copy.deepcopy(fail),))
+
+    # Walk functions free what they decode themselves, so never use an arena
     def walkdec_line(self, ret, dest, src, fail):
         assign = c.wrap(c.assign(ret, c.fcall(
-            f'dec_{self.postfix}', 'char *', (f'&{dest}', src)
+            f'dec_{self.postfix}', 'char *', (f'&{dest}', src, 'NULL')
         )), True)
         return c.ifcond(assign, (fail,))
 
@@ -188,45 +524,181 @@ class memory_type(complex_type):
             c.fcall(f'free_{self.postfix}', 'void', (src,))
         )
 
+    # Runtime types without a natural Python equivalent convert to and from
+    # their encoded bytes
+    def topy_line(self, parent, key, src, depth):
+        obj = f'py[{depth}]'
+        size = c.fcall(f'size_{self.postfix}', 'size_t', (src,))
+        return c.sequence((
+            c.statement(c.assign(obj, c.fcall(
+                'PyBytes_FromStringAndSize', 'PyObject *', ('NULL', size)
+            ))),
+            py_insert(parent, key, obj),
+            c.statement(c.fcall(f'enc_{self.postfix}', 'char *', (
+                f'PyBytes_AS_STRING({obj})', src
+            ))),
+        ))
+
+    def frompy_val(self, obj, dest, depth):
+        return c.sequence((
+            c.inlineif(c.fcall('mc_py_bytes', 'int', (obj, '&raw')),
+                c.statement('goto fail')),
+            c.ifcond(c.noteq(self.frompy_raw(dest), 'raw.base + raw.len'), (
+                c.statement(c.fcall(
+                    'mc_py_invalid', 'int', (f'"{self.postfix}"',)
+                )),
+                c.statement('goto fail'),
+            )),
+        ))
+
+    def frompy_raw(self, dest):
+        return c.fcall(f'dec_checked_{self.postfix}', 'char *', (
+            f'&{dest}', 'raw.base', 'raw.len', 'NULL'
+        ))
+
+    # Encoded bytes in the pure Python codecs too, datautils.py walks them
+    @property
+    def py_postfix(self):
+        return self.postfix
+
+    def pydec_line(self, dest, scope):
+        return pyf.line(f'{dest}, pos = dec_{self.py_postfix}(view, pos)')
+
+    def pyenc_line(self, src, scope):
+        return pyf.line(f'pos = enc_{self.py_postfix}(buf, pos, {src})')
+
+    def pysize_val(self, src):
+        return f'len({src})'
+
 @mc_data_name('string')
 class mc_string(memory_type):
     typename = 'sds'
     postfix = 'string'
+    min_size = 1
+
+    # Pointer and length for string switches to hash
+    @staticmethod
+    def switch_args(var):
+        return (var, f'sdslen({var})')
+
+    def rand_line(self, dest):
+        if not self.switch_values:
+            return generic_type.rand_line(self, dest)
+        values = ', '.join(c_string(v) for v in self.switch_values)
+        return c.statement(c.fcall(f'mc_bench_{self.postfix}_of', 'void', (
+            f'&{dest}', f'(const char *[]){{{values}}}'
+            f'[mc_bench_rand() % {len(self.switch_values)}]'
+        )))
+
+    topy_line = generic_type.topy_line
+
+    def topy_val(self, src):
+        return c.fcall('PyUnicode_FromStringAndSize', 'PyObject *', (
+            *self.switch_args(src),
+        ))
+
+    def frompy_val(self, obj, dest, depth):
+        return c.inlineif(c.fcall(
+            f'mc_py_{self.postfix}', 'int', (obj, f'&{dest}')
+        ), c.statement('goto fail'))
+
+    def pydec_line(self, dest, scope):
+        return pyf.line(f'{dest}, pos = dec_string(view, pos)')
+
+    def pyenc_line(self, src, scope):
+        return pyf.line(f'pos = enc_string(buf, pos, {src})')
+
+    def pysize_val(self, src):
+        return f'size_string({src})'
+
+    hashable = True
+
+    def hash_line(self, hash, src):
+        return hash_bytes_line(hash, *self.switch_args(src))
+
+    def eq_line(self, a, b):
+        return eq_bytes_line(self.switch_args(a), self.switch_args(b))
+
+# Zero-copy string, points into the buffer the packet was decoded from and
+# isn't null terminated
+class mc_string_view(complex_type):
+    typename = 'mc_strview'
+    postfix = 'strview'
+    min_size = 1
+
+    @staticmethod
+    def switch_args(var):
+        return (f'{var}.base', f'{var}.len')
+
+    hashable = True
+    hash_line = mc_string.hash_line
+    eq_line = mc_string.eq_line
+    rand_line = mc_string.rand_line
+    topy_val = mc_string.topy_val
+    frompy_val = mc_string.frompy_val
+    pydec_line = mc_string.pydec_line
+    pyenc_line = mc_string.pyenc_line
+    pysize_val = mc_string.pysize_val
 
 @mc_data_name('nbt')
 class mc_nbt(memory_type):
     typename = 'nbt_node *'
     postfix = 'nbt'
+    min_size = 1
 
 @mc_data_name('optionalNbt')
 class mc_optnbt(memory_type):
     typename = 'nbt_node *'
     postfix = 'optnbt'
+    min_size = 1
 
 @mc_data_name('slot')
 class mc_slot(memory_type):
     typename = 'mc_slot'
     postfix = 'slot'
+    min_size = 2
+
+# Lazy versions of the above keep the NBT as raw bytes until it's asked for,
+# see mc_lazy_nbt in datautils.h
+class mc_lazy_nbt(mc_nbt):
+    typename = 'mc_lazy_nbt'
+    postfix = 'lazynbt'
+    py_postfix = 'nbt'
+
+class mc_lazy_optnbt(mc_optnbt):
+    typename = 'mc_lazy_nbt'
+    postfix = 'lazyoptnbt'
+    py_postfix = 'optnbt'
+
+class mc_lazy_slot(mc_slot):
+    typename = 'mc_lazy_slot'
+    postfix = 'lazyslot'
+    py_postfix = 'slot'
 
 @mc_data_name('ingredient')
 class mc_ingredient(memory_type):
     typename = 'mc_ingredient'
     postfix = 'ingredient'
+    min_size = 1
 
 @mc_data_name('entityMetadata')
 class mc_metadata(memory_type):
     typename = 'mc_metadata'
     postfix = 'metadata'
+    min_size = 1
 
 @mc_data_name('tags')
 class mc_itemtag_array(memory_type):
     typename = 'mc_itemtag_array'
     postfix = 'itemtag_array'
+    min_size = 1
 
 @mc_data_name('minecraft_smelting_format')
 class mc_smelting(memory_type):
     typename = 'mc_smelting'
     postfix = 'smelting'
+    # group, ingredient, result, experience and cooking_time
+    min_size = 1 + 1 + 2 + 4 + 1
 
 
 def get_type(typ, name, parent):
@@ -237,6 +709,60 @@ def get_type(typ, name, parent):
     else:
         return mcd_typemap[typ[0]](name, typ[1], parent)
 
+# String switches dispatch through a perfect hash built over their case
+# strings, the same FNV-1a as mc_strhash in datautils.c. The slot table is
+# sized so a seed without collisions turns up quickly
+def strhash(string, seed):
+    h = 0x811C9DC5 ^ seed
+    for b in string.encode():
+        h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+    return h
+
+# C literal for a case string. Anything but printable ASCII goes in as octal
+# escapes of its UTF-8 bytes, the same bytes strhash hashes
+def c_string(string):
+    chars = []
+    for b in string.encode():
+        if chr(b) in '"\\':
+            chars.append(f'\\{chr(b)}')
+        elif 0x20 <= b < 0x7F:
+            chars.append(chr(b))
+        else:
+            chars.append(f'\\{b:03o}')
+    return f'"{"".join(chars)}"'
+
+def perfect_hash(keys):
+    size = 1
+    while size < 2 * len(keys):
+        size <<= 1
+    while True:
+        for seed in range(4096):
+            slots = {strhash(k, seed) & (size - 1): k for k in keys}
+            if len(slots) == len(keys):
+                return seed, size, slots
+        size <<= 1
+
+# Slot tables shared by every string switch with the same cases, emitted once
+# at the top of the generated source
+string_switch_tables = []
+
+# Largest count a numeric count type can hold, None for varints since a count
+# anywhere near their range can't be a meaningful bound
+def count_max(typ):
+    if not isinstance(typ, numeric_type) or not typ.size:
+        return None
+    bits = typ.size * 8
+    if typ.typename.startswith('u'):
+        return 2**bits - 1
+    return 2**(bits - 1) - 1
+
+# Summed size bounds of a sequence of fields
+def sum_sizes(fields):
+    min_size = sum(field.min_size for field in fields)
+    if any(field.max_size is None for field in fields):
+        return min_size, None
+    return min_size, sum(field.max_size for field in fields)
+
 def get_depth(field):
     depth = 0
     while not isinstance(field.parent, packet):
@@ -244,6 +770,207 @@ def get_depth(field):
         field = field.parent
     return depth
 
+# hash_ and eq_ lines for a pointer and length, a and b are (base, len) pairs
+def hash_bytes_line(hash, base, length):
+    return c.statement(c.assign(hash, c.fcall(
+        'mc_hash_bytes', 'uint64_t', (hash, base, length)
+    )))
+
+def eq_bytes_line(a, b):
+    (abase, alen), (bbase, blen) = a, b
+    return c.inlineif(
+        f'{alen} != {blen} || memcmp({abase}, {bbase}, {alen})',
+        c.returnval(0)
+    )
+
+# Python objects go in and out of dicts by field name and lists by index, see
+# generic_type.topy_line
+def py_insert(parent, key, val):
+    if isinstance(key, str):
+        call = c.fcall('mc_py_set', 'int', (parent, f'"{key}"', val))
+    else:
+        call = c.fcall('mc_py_item', 'int', (parent, key, val))
+    return c.inlineif(call, c.statement('goto fail'))
+
+def py_fetch(obj, parent, key):
+    if isinstance(key, str):
+        return c.inlineif(c.wrap(c.assign(obj, c.fcall(
+            'mc_py_get', 'PyObject *', (parent, f'"{key}"')
+        )), True), c.statement('goto fail'))
+    return c.statement(c.assign(obj, f'PyList_GET_ITEM({parent}, {key})'))
+
+# Scratch slots needed to convert fields to and from Python
+def py_depth(fields):
+    return 1 + max((
+        py_depth(f.children) for f in fields if hasattr(f, 'children')
+    ), default = 0)
+
+# The pure Python codecs keep packets in p and containers in locals, env maps
+# the id() of each container to its local while a function is generated
+class pyscope:
+    def __init__(self, pak):
+        self.env = {id(pak): 'p'}
+        self.count = 0
+
+    def fresh(self, prefix):
+        self.count += 1
+        return f'{prefix}{self.count}'
+
+# Precompiled struct.Struct for every distinct run of numerics, emitted once
+# at the top of codec_[version].py
+py_structs = {}
+
+def py_struct(fmt):
+    if fmt not in py_structs:
+        py_structs[fmt] = f'_s{len(py_structs)}'
+    return py_structs[fmt]
+
+def py_attr(name):
+    return f'{name}_' if keyword.iskeyword(name) else name
+
+# Packet fields are attributes, container fields dict items
+def py_access(container, name, scope):
+    if isinstance(container, packet):
+        return f'{scope.env[id(container)]}.{py_attr(name)}'
+    return f"{scope.env[id(container)]}['{name}']"
+
+def py_container(field):
+    parent = field.parent
+    while not isinstance(parent, (mc_container, packet)):
+        parent = parent.parent
+    return parent
+
+# The Python equivalent of get_switched_path, '..' goes up a container like
+# protodef intends. Bitfield members can be named on their own or through
+# their bitfield
+def py_lookup(compare, field, scope):
+    container = py_container(field)
+    tokens = compare.split('/')
+    while tokens[0] == '..':
+        tokens.pop(0)
+        container = py_container(container)
+    name = to_snake_case(tokens[0])
+    for f in container.fields:
+        if f.name == name:
+            break
+        if isinstance(f, mc_bitfield) and any(
+            to_snake_case(m.name) == name for m in f.fields
+        ):
+            tokens.insert(0, f.name)
+            break
+    else:
+        raise KeyError(f'{compare} not found from {field.name}')
+    expr = py_access(container, f.name, scope)
+    for token in tokens[1:]:
+        f = next(
+            m for m in f.fields if to_snake_case(m.name) == to_snake_case(token)
+        )
+        expr = f"{expr}['{f.name}']"
+    return expr
+
+def py_unpack(pairs, scope):
+    seq = pyf.sequence()
+    fmt = ''
+    targets = []
+    post = []
+    for field, dest in pairs:
+        if not field.size:
+            continue
+        target, lines = field.py_target(dest, scope)
+        fmt += field.py_format
+        targets.append(target)
+        post.extend(lines)
+    if targets:
+        seq.append(f'{", ".join(targets)}{"," if len(targets) == 1 else ""}'
+            f' = {py_struct(fmt)}.unpack_from(view, pos)')
+        seq.append(f'pos += {sum(field.size for field, _ in pairs)}')
+        seq.extend(post)
+    return seq
+
+def py_pack(pairs):
+    seq = pyf.sequence()
+    fmt = ''
+    values = []
+    for field, src in pairs:
+        if field.size:
+            fmt += field.py_format
+            values.append(field.py_value(src))
+    if values:
+        seq.append(
+            f'{py_struct(fmt)}.pack_into(buf, pos, {", ".join(values)})'
+        )
+        seq.append(f'pos += {sum(field.size for field, _ in pairs)}')
+    return seq
+
+# Fields of a container or packet, runs of numerics found the same way as
+# size_ functions find them share a single struct
+def py_dec_fields(app, fields, container, scope):
+    position = 0
+    endpos = len(fields)
+    while(position < endpos):
+        start = position
+        position, total = group_numerics_size(fields, position)
+        app.append(py_unpack([
+            (f, py_access(container, f.name, scope))
+            for f in fields[start:position]
+        ], scope))
+        if position < endpos:
+            field = fields[position]
+            position += 1
+            app.append(field.pydec_line(
+                py_access(container, field.name, scope), scope
+            ))
+
+def py_enc_fields(app, fields, container, scope):
+    position = 0
+    endpos = len(fields)
+    while(position < endpos):
+        start = position
+        position, total = group_numerics_size(fields, position)
+        app.append(py_pack([
+            (f, py_access(container, f.name, scope))
+            for f in fields[start:position]
+        ]))
+        if position < endpos:
+            field = fields[position]
+            position += 1
+            app.append(field.pyenc_line(
+                py_access(container, field.name, scope), scope
+            ))
+
+# Returns the size of the numerics for the caller to fold into its own total
+def py_size_fields(app, fields, container, size, scope):
+    fixed = 0
+    position = 0
+    endpos = len(fields)
+    while(position < endpos):
+        position, total = group_numerics_size(fields, position)
+        fixed += total
+        if position < endpos:
+            field = fields[position]
+            position += 1
+            app.append(field.pysize_line(
+                size, py_access(container, field.name, scope), scope
+            ))
+    return fixed
+
+def py_signed(typ):
+    return not typ.typename.startswith('u')
+
+# Fields of a NumPy layout, void fields take up no room and are left out.
+# None if any field doesn't have a fixed layout. Names go through py_attr so
+# they match the attributes of the generated classes
+def np_fields(fields):
+    elems = []
+    for field in fields:
+        if isinstance(field, void_type):
+            continue
+        elem = field.np_field()
+        if elem is None:
+            return None
+        elems.append(elem)
+    return elems
+
 # These are generic structures that Mcdata uses to implement other types. Since
 # mcdata often likes to define new types inline, rather than in the "types"
 # section, we need to support them. This makes the generated code ugly and is
@@ -254,49 +981,60 @@ class custom_type(complex_type):
         super().__init__(name, parent)
         self.data = data
 
-@mc_data_name('buffer')
-class mc_buffer(custom_type, memory_type):
+# Shared by the owning and zero-copy buffers, they only differ in decoding
+class buffer_type(custom_type):
+    # Where random contents come from, see bench.h
+    rand_base = 'mc_bench_bytes'
+    # Copies the bytes object's contents, or points into it for views
+    frompy_base = 'mc_py_buffer'
+
     def __init__(self, name, data, parent):
         super().__init__(name, data, parent)
         self.ln = get_type(data['countType'], 'len', self)
         self.base = c.variable('base', 'char *')
         self.children = [self.ln, self.base]
 
+    @property
+    def min_size(self):
+        return self.ln.min_size
+
+    @property
+    def max_size(self):
+        if count_max(self.ln) is None:
+            return None
+        return self.ln.max_size + count_max(self.ln)
+
     def struct_line(self):
         return c.linesequence((c.struct(elems = (
             self.ln.struct_line(),
             c.statement(self.base.decl)
         )), c.statement(self.name)))
 
-    def enc_line(self, ret, dest, src):
+    def enc_line(self, ret, dest, src, end = None, fail = None):
         seq = c.sequence()
         basevar = c.variable(f'{src}.base', 'char *')
         lenvar = c.variable(f'{src}.len', self.ln.typename)
-        seq.append(self.ln.enc_line(ret, dest, lenvar))
-        seq.append(c.statement(c.assign(dest, c.fcall(
-            'memcpy', 'void *', (dest, basevar, lenvar)
-        ))))
+        seq.append(self.ln.enc_line(ret, dest, lenvar, end, fail))
+        if end is not None:
+            seq.append(enc_short_line(dest, end, lenvar, fail))
+        seq.append(c.statement(c.assign(dest, c.addop(c.fcall(
+            'memcpy', 'char *', (dest, basevar, lenvar)
+        ), lenvar))))
         return seq
 
-    def dec_line(self, ret, dest, src):
-        seq = c.sequence()
-        basevar = c.variable(f'{dest}.base', 'char *')
-        lenvar = c.variable(f'{dest}.len', self.ln.typename)
-        seq.append(self.ln.dec_line(ret, lenvar, src))
-        seq.append(c.inlineif(c.wrap(c.assign(
-            basevar, c.fcall('malloc', 'void *', (lenvar,))
-        ), True), c.returnval('NULL')))
-        seq.append(c.statement(c.fcall('memcpy', 'void *', (
-            basevar, src, lenvar
-        ))))
-        seq.append(c.statement(c.addeq(src, lenvar)))
-        return seq
+    # Decodes the length and makes sure that many bytes are left
+    def checked_len_line(self, seq, lenvar, src, end, fail):
+        generic_checked_dec_func(seq, self.ln, lenvar, src, end, fail)
+        short = c.lth(c.subop(end, src), lenvar)
+        if not self.ln.typename.startswith('u'):
+            short = f'{lenvar} < 0 || {short}'
+        seq.append(c.ifcond(short, (copy.deepcopy(fail),)))
 
     def walk_line(self, ret, src, max_len, size, fail):
         seq = c.sequence()
         lenvar = c.variable(f'{self.name}_len', self.ln.typename)
         if isinstance(self.ln, numeric_type):
-            seq.append(c.ifcond(c.lth(max_len, self.ln.size), (fail,)))
+            seq.append(walk_short_line(ret, max_len, self.ln.size, fail))
             seq.append(c.statement(c.addeq(size, self.ln.size)))
             seq.append(c.statement(c.subeq(max_len, self.ln.size)))
         else:
@@ -305,7 +1043,11 @@ class mc_buffer(custom_type, memory_type):
             seq.append(c.statement(c.subeq(max_len, ret)))
         seq.append(c.statement(lenvar.decl))
         seq.append(self.ln.dec_line(src, lenvar, src))
-        seq.append(c.ifcond(c.lth(max_len, lenvar), (fail,)))
+        if not self.ln.typename.startswith('u'):
+            seq.append(c.ifcond(
+                c.lth(lenvar, 0), (walk_fail(ret, fail, 'varnum_invalid'),)
+            ))
+        seq.append(walk_short_line(ret, max_len, lenvar, fail))
         seq.append(c.statement(c.addeq(size, lenvar)))
         seq.append(c.statement(c.addeq(src, lenvar)))
         seq.append(c.statement(c.subeq(max_len, lenvar)))
@@ -321,29 +1063,179 @@ class mc_buffer(custom_type, memory_type):
         seq.append(c.statement(c.addeq(size, lenvar)))
         return seq
 
+    def rand_line(self, dest):
+        lenvar = c.variable(f'{dest}.len', self.ln.typename)
+        return c.sequence((
+            c.statement(c.assign(lenvar, 'mc_bench_rand() % MC_BENCH_MAX_LEN')),
+            c.statement(c.assign(f'{dest}.base', c.fcall(
+                self.rand_base, 'char *', (lenvar,)
+            ))),
+        ))
+
+    topy_line = generic_type.topy_line
+
+    def topy_val(self, src):
+        return c.fcall('PyBytes_FromStringAndSize', 'PyObject *', (
+            f'{src}.base', f'{src}.len'
+        ))
+
+    def frompy_val(self, obj, dest, depth):
+        return c.sequence((
+            c.inlineif(c.fcall(self.frompy_base, 'int', (obj, '&raw')),
+                c.statement('goto fail')),
+            c.statement(c.assign(f'{dest}.len', 'raw.len')),
+            c.statement(c.assign(f'{dest}.base', 'raw.base')),
+        ))
+
+    def pydec_line(self, dest, scope):
+        count = scope.fresh('n')
+        return pyf.sequence((
+            self.ln.pydec_line(count, scope),
+            f'{dest}, pos = dec_bytes(view, pos, {count})',
+        ))
+
+    def pyenc_line(self, src, scope):
+        return pyf.sequence((
+            self.ln.pyenc_line(f'len({src})', scope),
+            f'pos = enc_bytes(buf, pos, {src})',
+        ))
+
+    def pysize_val(self, src):
+        return f'{self.ln.pysize_val(f"len({src})")} + len({src})'
+
+    hashable = True
+
+    def hash_line(self, hash, src):
+        return hash_bytes_line(hash, f'{src}.base', f'{src}.len')
+
+    def eq_line(self, a, b):
+        return eq_bytes_line(
+            (f'{a}.base', f'{a}.len'), (f'{b}.base', f'{b}.len')
+        )
+
+@mc_data_name('buffer')
+class mc_buffer(buffer_type, memory_type):
+    def dec_line(self, ret, dest, src):
+        seq = c.sequence()
+        basevar = c.variable(f'{dest}.base', 'char *')
+        lenvar = c.variable(f'{dest}.len', self.ln.typename)
+        seq.append(self.ln.dec_line(ret, lenvar, src))
+        seq.append(c.inlineif(c.wrap(c.assign(
+            basevar, c.fcall('mc_alloc', 'void *', ('arena', lenvar))
+        ), True), c.returnval('NULL')))
+        seq.append(c.statement(c.fcall('memcpy', 'void *', (
+            basevar, src, lenvar
+        ))))
+        seq.append(c.statement(c.addeq(src, lenvar)))
+        return seq
+
+    def checked_dec_line(self, dest, src, end, fail):
+        seq = c.sequence()
+        basevar = c.variable(f'{dest}.base', 'char *')
+        lenvar = c.variable(f'{dest}.len', self.ln.typename)
+        self.checked_len_line(seq, lenvar, src, end, fail)
+        seq.append(c.ifcond(c.wrap(c.assign(
+            basevar, c.fcall('mc_alloc', 'void *', ('arena', lenvar))
+        ), True), (copy.deepcopy(fail),)))
+        seq.append(c.statement(c.fcall('memcpy', 'void *', (
+            basevar, src, lenvar
+        ))))
+        seq.append(c.statement(c.addeq(src, lenvar)))
+        return seq
+
     def free_line(self, src):
         return c.statement(c.fcall('free', 'void', (f'{src}.base',)))
 
-@mc_data_name('restBuffer')
-class mc_restbuffer(memory_type):
+# Zero-copy buffer, base points into the buffer the packet was decoded from
+class mc_buffer_view(buffer_type):
+    rand_base = 'mc_bench_view'
+    frompy_base = 'mc_py_bytes'
+
+    def dec_line(self, ret, dest, src):
+        seq = c.sequence()
+        basevar = c.variable(f'{dest}.base', 'char *')
+        lenvar = c.variable(f'{dest}.len', self.ln.typename)
+        seq.append(self.ln.dec_line(ret, lenvar, src))
+        seq.append(c.statement(c.assign(basevar, src)))
+        seq.append(c.statement(c.addeq(src, lenvar)))
+        return seq
+
+    def checked_dec_line(self, dest, src, end, fail):
+        seq = c.sequence()
+        basevar = c.variable(f'{dest}.base', 'char *')
+        lenvar = c.variable(f'{dest}.len', self.ln.typename)
+        self.checked_len_line(seq, lenvar, src, end, fail)
+        seq.append(c.statement(c.assign(basevar, src)))
+        seq.append(c.statement(c.addeq(src, lenvar)))
+        return seq
+
+# Consumes whatever is left of the packet, so packets containing one take the
+# total packet size in their dec_ function
+class restbuffer_type(complex_type):
     typename = 'mc_buffer'
+    frompy_base = 'mc_py_buffer'
+
+    def size_line(self, size, src):
+        return c.statement(c.addeq(size, f'{src}.len'))
+
+    def bound_line(self, dest, src, end, fail):
+        return enc_short_line(dest, end, f'{src}.len', fail)
+
+    def walk_line(self, ret, src, max_len, fail):
+        return c.statement(c.assign(ret, max_len))
+
+    hashable = True
+    hash_line = buffer_type.hash_line
+    eq_line = buffer_type.eq_line
+    topy_line = generic_type.topy_line
+    topy_val = buffer_type.topy_val
+
+    def frompy_val(self, obj, dest, depth):
+        return c.inlineif(c.fcall(self.frompy_base, 'int', (obj, f'&{dest}')),
+            c.statement('goto fail'))
+
+    def pydec_line(self, dest, scope):
+        return pyf.line(f'{dest}, pos = dec_rest(view, pos)')
+
+    def pyenc_line(self, src, scope):
+        return pyf.line(f'pos = enc_rest(buf, pos, {src})')
+
+    def pysize_val(self, src):
+        return f'len({src})'
+
+@mc_data_name('restBuffer')
+class mc_restbuffer(restbuffer_type, memory_type):
     postfix = 'buffer'
 
     def dec_line(self, ret, dest, src, endptr):
         return c.statement(c.assign(
             ret, c.fcall(f'dec_{self.postfix}', 'char *',
-            (f'&{dest}', src, c.subop(endptr, ret)))
+            (f'&{dest}', src, c.subop(endptr, ret), 'arena'))
         ))
 
-    def size_line(self, size, src):
-        return c.statement(c.addeq(size, f'{src}.len'))
-
-    def walk_line(self, ret, src, max_len, fail):
-        return c.statement(c.assign(ret, max_len))
+    def checked_dec_line(self, dest, src, end, fail):
+        assign = c.wrap(c.assign(src, c.fcall(
+            f'dec_{self.postfix}', 'char *',
+            (f'&{dest}', src, c.subop(end, src), 'arena')
+        )), True)
+        return c.ifcond(assign, (copy.deepcopy(fail),))
 
     def free_line(self, src):
         return c.statement(c.fcall('free', 'void', (f'{src}.base',)))
 
+class mc_restbuffer_view(restbuffer_type):
+    postfix = 'bufview'
+    frompy_base = 'mc_py_bytes'
+
+    def dec_line(self, ret, dest, src, endptr):
+        return c.statement(c.assign(
+            ret, c.fcall(f'dec_{self.postfix}', 'char *',
+            (f'&{dest}', src, c.subop(endptr, ret)))
+        ))
+
+    def checked_dec_line(self, dest, src, end, fail):
+        return self.dec_line(src, dest, src, end)
+
 @mc_data_name('array')
 class mc_array(custom_type, memory_type):
     def __init__(self, name, data, parent):
@@ -370,11 +1262,32 @@ class mc_array(custom_type, memory_type):
                 to_snake_case(data['count']), parent
             )
             self.external_count.switched = True
+            self.external_count.counts = True
             self.count = None
             # ToDo: This is a hack, cfile needs better pointer support
             self.base = get_type(data['type'], f'*{name}', self)
         self.children.append(self.base)
 
+    @property
+    def min_size(self):
+        if self.prefixed:
+            return self.count.min_size
+        if self.self_contained:
+            return self.count * self.base.min_size
+        return 0
+
+    @property
+    def max_size(self):
+        if self.self_contained and not self.prefixed:
+            count = self.count
+        else:
+            count = count_max(self.count if self.prefixed
+                else self.external_count)
+        if count is None or self.base.max_size is None:
+            return None
+        prefix = self.count.max_size if self.prefixed else 0
+        return prefix + count * self.base.max_size
+
     def __eq__(self, value):
         if not super().__eq__(value):
             return False
@@ -397,25 +1310,34 @@ class mc_array(custom_type, memory_type):
             )), c.statement(self.name)))
         return self.base.struct_line()
 
-    def enc_line(self, ret, dest, src):
+    def enc_line(self, ret, dest, src, end = None, fail = None):
         seq = c.sequence()
         loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
         if self.self_contained:
             basevar = c.variable(f'{src}.base')
             if self.prefixed:
                 countvar = c.variable(f'{src}.count')
-                seq.append(self.count.enc_line(ret, dest, countvar))
+                seq.append(self.count.enc_line(ret, dest, countvar, end, fail))
             else:
                 countvar = self.count
         else:
             countvar = c.variable(get_switched_path(self.compare, src.name, self, False))
             basevar = c.variable(f'{src}')
+        # Fixed size elements are bounds checked all at once
+        if end is not None and isinstance(self.base, numeric_type):
+            seq.append(enc_short_line(
+                dest, end, c.mulop(countvar, self.base.size), fail
+            ))
+            end = None
+        if isinstance(self.base, numeric_type) and self.base.bulk:
+            seq.append(self.base.bulk_enc_line(ret, dest, basevar, countvar))
+            return seq
         basevar = c.variable(f'{basevar}[{loopvar}]')
         seq.append(c.forloop(
             c.assign(loopvar.decl, 0),
             c.lth(loopvar, countvar),
             c.incop(loopvar),
-            (self.base.enc_line(ret, dest, basevar),)
+            (self.base.enc_line(ret, dest, basevar, end, fail),)
         ))
         return seq
 
@@ -433,8 +1355,11 @@ class mc_array(custom_type, memory_type):
             countvar = c.variable(get_switched_path(self.compare, dest.name, self))
             basevar = c.variable(f'{dest}')
         seq.append(c.inlineif(c.wrap(c.assign(basevar, c.fcall(
-            'malloc', 'void *', (f'sizeof(*{basevar}) * {countvar}',)
+            'mc_alloc', 'void *', ('arena', f'sizeof(*{basevar}) * {countvar}')
         )), True), c.returnval('NULL')))
+        if isinstance(self.base, numeric_type) and self.base.bulk:
+            seq.append(self.base.bulk_dec_line(ret, basevar, src, countvar))
+            return seq
         basevar = c.variable(f'{basevar}[{loopvar}]')
         seq.append(c.forloop(
             c.assign(loopvar.decl, 0),
@@ -444,13 +1369,72 @@ class mc_array(custom_type, memory_type):
         ))
         return seq
 
-    def size_line(self, size, src):
+    def checked_dec_line(self, dest, src, end, fail):
         seq = c.sequence()
+        loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
         if self.self_contained:
-            basevar = c.variable(f'{src}.base')
+            basevar = c.variable(f'{dest}.base')
             if self.prefixed:
-                countvar = c.variable(f'{src}.count')
-                if isinstance(self.count, numeric_type):
+                countvar = c.variable(f'{dest}.count')
+                generic_checked_dec_func(seq, self.count, countvar, src, end, fail)
+            else:
+                countvar = self.count
+        else:
+            countvar = c.variable(get_switched_path(self.compare, dest.name, self))
+            basevar = c.variable(f'{dest}')
+        fixed = hasattr(self.base, 'size') and not self.base.size is None
+        # Checked before allocating, in size_t so a negative or huge count
+        # can't wrap past it. Elements that aren't fixed size are at least
+        # min_size each, which keeps the allocation in proportion to the input
+        elem_size = max(self.base.size if fixed else self.base.min_size, 1)
+        short = (
+            f'(size_t) {countvar} > (size_t) ({c.subop(end, src)}) / '
+            f'{elem_size}'
+        )
+        if self.prefixed:
+            count_typ = self.count
+        elif not self.self_contained:
+            count_typ = self.external_count
+        else:
+            count_typ = None
+        if count_typ is not None and \
+                not count_typ.typename.startswith('u'):
+            short = f'{countvar} < 0 || {short}'
+        seq.append(c.ifcond(short, (copy.deepcopy(fail),)))
+        # calloc so a failure part way through leaves the array free-able
+        seq.append(c.ifcond(c.wrap(c.assign(basevar, c.fcall(
+            'mc_calloc', 'void *', ('arena', countvar, f'sizeof(*{basevar})')
+        )), True), (copy.deepcopy(fail),)))
+        if isinstance(self.base, varnum_type):
+            seq.append(self.base.bulk_checked_dec_line(
+                basevar, src, countvar, end, fail
+            ))
+            return seq
+        if isinstance(self.base, numeric_type) and self.base.bulk:
+            seq.append(self.base.bulk_dec_line(src, basevar, src, countvar))
+            return seq
+        basevar = c.variable(f'{basevar}[{loopvar}]')
+        if fixed:
+            # Already bounds checked the whole array above
+            forelems = (self.base.dec_line(src, basevar, src),)
+        else:
+            forelems = []
+            generic_checked_dec_func(forelems, self.base, basevar, src, end, fail)
+        seq.append(c.forloop(
+            c.assign(loopvar.decl, 0),
+            c.lth(loopvar, countvar),
+            c.incop(loopvar),
+            forelems
+        ))
+        return seq
+
+    def size_line(self, size, src):
+        seq = c.sequence()
+        if self.self_contained:
+            basevar = c.variable(f'{src}.base')
+            if self.prefixed:
+                countvar = c.variable(f'{src}.count')
+                if isinstance(self.count, numeric_type):
                     seq.append(c.statement(c.addeq(size, self.count.size)))
                 else:
                     seq.append(self.count.size_line(size, countvar))
@@ -487,7 +1471,9 @@ class mc_array(custom_type, memory_type):
                     parent = self.parent
                 countvar.name = f'{self.parent.name}{depth}_count'
             if isinstance(self.count, numeric_type):
-                seq.append(c.ifcond(c.lth(max_len, self.count.size), (fail,)))
+                seq.append(walk_short_line(
+                    ret, max_len, self.count.size, fail
+                ))
                 seq.append(c.statement(c.addeq(size, self.count.size)))
                 seq.append(c.statement(c.subeq(max_len, self.count.size)))
             else:
@@ -496,14 +1482,17 @@ class mc_array(custom_type, memory_type):
                 seq.append(c.statement(c.subeq(max_len, ret)))
             seq.append(c.statement(countvar.decl))
             seq.append(self.count.dec_line(src, countvar, src))
+            if not self.count.typename.startswith('u'):
+                seq.append(c.ifcond(c.lth(countvar, 0), (
+                    walk_fail(ret, fail, 'varnum_invalid'),
+                )))
         elif self.self_contained and not self.prefixed:
             countvar = self.count
         else:
             countvar = self.external_count.internal
         if hasattr(self.base, 'size') and not self.base.size is None:
-            seq.append(c.ifcond(
-                c.lth(max_len, c.mulop(countvar, self.base.size)),
-                (fail,)
+            seq.append(walk_short_line(
+                ret, max_len, c.mulop(countvar, self.base.size), fail
             ))
             seq.append(c.statement(c.addeq(
                 size, c.mulop(countvar, self.base.size)
@@ -514,6 +1503,13 @@ class mc_array(custom_type, memory_type):
             seq.append(c.statement(c.subeq(
                 max_len, c.mulop(countvar, self.base.size)
             )))
+        elif isinstance(self.base, varnum_type):
+            seq.append(self.base.bulk_walk_line(
+                ret, src, countvar, max_len, fail
+            ))
+            seq.append(c.statement(c.addeq(size, ret)))
+            seq.append(c.statement(c.addeq(src, ret)))
+            seq.append(c.statement(c.subeq(max_len, ret)))
         else:
             depth = get_depth(self)
             loopvar = c.variable(f'i_{depth}', 'size_t')
@@ -533,6 +1529,74 @@ class mc_array(custom_type, memory_type):
 
         return seq
 
+    @property
+    def hashable(self):
+        return self.base.hashable
+
+    # External counts are hashed and compared as the field they are
+    def hash_line(self, hash, src):
+        seq = c.sequence()
+        loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
+        if self.self_contained:
+            basevar = c.variable(f'{src}.base')
+            if self.prefixed:
+                countvar = c.variable(f'{src}.count')
+                seq.append(self.count.hash_line(hash, countvar))
+            else:
+                countvar = self.count
+        else:
+            countvar = c.variable(get_switched_path(
+                self.compare, src.name, self, False
+            ))
+            basevar = c.variable(f'{src}')
+        if isinstance(self.base, numeric_type) and self.base.bulk:
+            seq.append(hash_bytes_line(
+                hash, basevar, c.mulop(f'sizeof(*{basevar})', countvar)
+            ))
+            return seq
+        seq.append(c.forloop(
+            c.assign(loopvar.decl, 0),
+            c.lth(loopvar, countvar),
+            c.incop(loopvar),
+            (self.base.hash_line(hash, c.variable(f'{basevar}[{loopvar}]')),)
+        ))
+        return seq
+
+    def eq_line(self, a, b):
+        seq = c.sequence()
+        loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
+        if self.self_contained:
+            abase = c.variable(f'{a}.base')
+            bbase = c.variable(f'{b}.base')
+            if self.prefixed:
+                countvar = c.variable(f'{a}.count')
+                seq.append(self.count.eq_line(
+                    countvar, c.variable(f'{b}.count')
+                ))
+            else:
+                countvar = self.count
+        else:
+            countvar = c.variable(get_switched_path(
+                self.compare, a.name, self, False
+            ))
+            abase = c.variable(f'{a}')
+            bbase = c.variable(f'{b}')
+        if isinstance(self.base, numeric_type) and self.base.bulk:
+            seq.append(c.inlineif(c.fcall('memcmp', 'int', (
+                abase, bbase, c.mulop(f'sizeof(*{abase})', countvar)
+            )), c.returnval(0)))
+            return seq
+        seq.append(c.forloop(
+            c.assign(loopvar.decl, 0),
+            c.lth(loopvar, countvar),
+            c.incop(loopvar),
+            (self.base.eq_line(
+                c.variable(f'{abase}[{loopvar}]'),
+                c.variable(f'{bbase}[{loopvar}]')
+            ),)
+        ))
+        return seq
+
     def free_line(self, src):
         seq = c.sequence()
         if self.self_contained:
@@ -552,16 +1616,185 @@ class mc_array(custom_type, memory_type):
             check_instance(self.base.children, memory_type)
         ):
             loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
+            # A failed decode can leave the count set with no base
+            guard = c.ifcond(basevar)
             basevar = c.variable(f'{basevar}[{loopvar}]')
-            seq.append(c.forloop(
+            guard.append(c.forloop(
                 c.assign(loopvar.decl, 0),
                 c.lth(loopvar, countvar),
                 c.incop(loopvar),
                 (self.base.free_line(basevar),)
             ))
+            seq.append(guard)
         seq.append(final)
         return seq
 
+    # Allocated the same way a decode without an arena would be, so free_
+    # can release it
+    def rand_line(self, dest):
+        seq = c.sequence()
+        loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
+        if self.self_contained:
+            basevar = c.variable(f'{dest}.base')
+            if self.prefixed:
+                countvar = c.variable(f'{dest}.count')
+                seq.append(c.statement(c.assign(
+                    countvar, 'mc_bench_rand() % MC_BENCH_MAX_COUNT'
+                )))
+            else:
+                countvar = self.count
+        else:
+            countvar = c.variable(get_switched_path(self.compare, dest.name, self))
+            basevar = c.variable(f'{dest}')
+        seq.append(c.statement(c.assign(basevar, c.fcall(
+            'calloc', 'void *', (countvar, f'sizeof(*{basevar})')
+        ))))
+        basevar = c.variable(f'{basevar}[{loopvar}]', self.base.typename)
+        seq.append(c.forloop(
+            c.assign(loopvar.decl, 0),
+            c.lth(loopvar, countvar),
+            c.incop(loopvar),
+            (self.base.rand_line(basevar),)
+        ))
+        return seq
+
+    # Lists, filled in after they're stored in their parent so a failure
+    # part way through only has the top level dict to release
+    def topy_line(self, parent, key, src, depth):
+        obj = f'py[{depth}]'
+        loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
+        if self.self_contained:
+            basevar = c.variable(f'{src}.base')
+            countvar = f'{src}.count' if self.prefixed else self.count
+        else:
+            countvar = c.variable(get_switched_path(self.compare, src.name, self))
+            basevar = c.variable(f'{src}')
+        basevar = c.variable(f'{basevar}[{loopvar}]', self.base.typename)
+        return c.sequence((
+            c.statement(c.assign(obj, c.fcall(
+                'PyList_New', 'PyObject *', (countvar,)
+            ))),
+            py_insert(parent, key, obj),
+            c.forloop(
+                c.assign(loopvar.decl, 0),
+                c.lth(loopvar, countvar),
+                c.incop(loopvar),
+                (self.base.topy_line(obj, loopvar, basevar, depth + 1),)
+            ),
+        ))
+
+    # Arrays without a count prefix have to match the count they already have
+    def frompy_val(self, obj, dest, depth):
+        seq = c.sequence()
+        loopvar = c.variable(f'i_{get_depth(self)}', 'size_t')
+        if self.self_contained:
+            basevar = c.variable(f'{dest}.base')
+            if self.prefixed:
+                countvar = c.variable(f'{dest}.count')
+                seq.append(c.inlineif(c.fcall(
+                    'mc_py_list', 'int', (obj, -1)
+                ), c.statement('goto fail')))
+                seq.append(c.statement(c.assign(
+                    countvar, f'PyList_GET_SIZE({obj})'
+                )))
+            else:
+                countvar = self.count
+        else:
+            countvar = c.variable(get_switched_path(self.compare, dest.name, self))
+            basevar = c.variable(f'{dest}')
+        if not self.prefixed:
+            seq.append(c.inlineif(c.fcall(
+                'mc_py_list', 'int', (obj, countvar)
+            ), c.statement('goto fail')))
+        # calloc so free_ can release a partly converted array
+        alloc = c.wrap(c.assign(basevar, c.fcall(
+            'calloc', 'void *', (countvar, f'sizeof(*{basevar})')
+        )), True)
+        seq.append(c.ifcond(f'{alloc} && {countvar}', (
+            c.statement(c.fcall('PyErr_NoMemory', 'PyObject *')),
+            c.statement('goto fail'),
+        )))
+        basevar = c.variable(f'{basevar}[{loopvar}]', self.base.typename)
+        seq.append(c.forloop(
+            c.assign(loopvar.decl, 0),
+            c.lth(loopvar, countvar),
+            c.incop(loopvar),
+            (self.base.frompy_line(obj, loopvar, basevar, depth + 1),)
+        ))
+        return seq
+
+    # Lists, arrays of plain numbers are unpacked in one go
+    def pydec_line(self, dest, scope):
+        seq = pyf.sequence()
+        if self.prefixed:
+            count = scope.fresh('n')
+            seq.append(self.count.pydec_line(count, scope))
+            signed = py_signed(self.count)
+        elif self.self_contained:
+            count = str(self.count)
+            signed = False
+        else:
+            count = py_lookup(self.compare, self, scope)
+            signed = py_signed(self.external_count)
+        if signed:
+            seq.append(pyf.ifcond(f'{count} < 0', (
+                "raise DecodeError('negative count')",
+            )))
+        if isinstance(self.base, numeric_type) and self.base.bulk:
+            seq.append(
+                f'{dest}, pos = dec_numerics({self.base.py_format!r}, '
+                f'{self.base.size}, {count}, view, pos)'
+            )
+        elif isinstance(self.base, varnum_type):
+            seq.append(f'{dest}, pos = dec_varints(view, pos, {count})')
+        else:
+            items = scope.fresh('a')
+            item = scope.fresh('e')
+            seq.append(f'{dest} = {items} = []')
+            seq.append(pyf.forloop('_', f'range({count})', (
+                self.base.pydec_line(item, scope),
+                f'{items}.append({item})',
+            )))
+        return seq
+
+    # Arrays without a count prefix have to match the count they already have
+    def pyenc_line(self, src, scope):
+        seq = pyf.sequence()
+        if self.prefixed:
+            seq.append(self.count.pyenc_line(f'len({src})', scope))
+        else:
+            if self.self_contained:
+                count = self.count
+            else:
+                count = py_lookup(self.compare, self, scope)
+            seq.append(pyf.ifcond(f'len({src}) != {count}', (
+                "raise ValueError('array is the wrong length')",
+            )))
+        if isinstance(self.base, numeric_type) and self.base.bulk:
+            seq.append(
+                f'pos = enc_numerics({self.base.py_format!r}, '
+                f'{self.base.size}, buf, pos, {src})'
+            )
+        else:
+            item = scope.fresh('e')
+            seq.append(pyf.forloop(item, src, (
+                self.base.pyenc_line(item, scope),
+            )))
+        return seq
+
+    def pysize_line(self, size, src, scope):
+        seq = pyf.sequence()
+        if self.prefixed:
+            seq.append(self.count.pysize_line(size, f'len({src})', scope))
+        if getattr(self.base, 'size', None) is not None:
+            seq.append(f'{size} += len({src}) * {self.base.size}')
+        else:
+            item = scope.fresh('e')
+            seq.append(pyf.forloop(item, src, (
+                self.base.pysize_line(size, item, scope),
+            )))
+        return seq
+
 import re
 
 first_cap_re = re.compile('(.)([A-Z][a-z]+)')
@@ -617,12 +1850,21 @@ class mc_container(custom_type):
             except KeyError as err:
                 fname = 'anonymous'
             self.fields.append(get_type(field['type'], fname, self))
+        merge_switches(self.fields)
         self.complex = check_instance(self.fields, complex_type)
         if self.complex:
             self.size = None
         else:
             _, self.size = group_numerics_size(self.fields, 0)
 
+    @property
+    def min_size(self):
+        return sum_sizes(self.fields)[0]
+
+    @property
+    def max_size(self):
+        return sum_sizes(self.fields)[1]
+
     def __eq__(self, value):
         if not super().__eq__(value) or len(self.fields) != len(value.fields):
             return False
@@ -634,8 +1876,11 @@ class mc_container(custom_type):
             c.statement(self.name)
         ))
 
-    def enc_line(self, ret, dest, src):
+    def enc_line(self, ret, dest, src, end = None, fail = None):
         seq = c.sequence()
+        if end is not None:
+            bounded_enc_fields(seq, self.fields, ret, dest, src, end, fail)
+            return seq
         for field in self.fields:
             v = c.variable(f'{src}.{field}', field.typename)
             seq.append(field.enc_line(ret, dest, v))
@@ -648,6 +1893,107 @@ class mc_container(custom_type):
             seq.append(field.dec_line(ret, v, src))
         return seq
 
+    def rand_line(self, dest):
+        seq = c.sequence()
+        for field in self.fields:
+            v = c.variable(f'{dest}.{field}', field.typename)
+            seq.append(field.rand_line(v))
+        return seq
+
+    def topy_line(self, parent, key, src, depth):
+        obj = f'py[{depth}]'
+        seq = c.sequence([
+            c.statement(c.assign(obj, c.fcall('PyDict_New', 'PyObject *'))),
+            py_insert(parent, key, obj),
+        ])
+        for field in self.fields:
+            v = c.variable(f'{src}.{field}', field.typename)
+            seq.append(field.topy_line(obj, field.name, v, depth + 1))
+        return seq
+
+    def frompy_val(self, obj, dest, depth):
+        seq = c.sequence()
+        for field in self.fields:
+            v = c.variable(f'{dest}.{field}', field.typename)
+            seq.append(field.frompy_line(obj, field.name, v, depth + 1))
+        return seq
+
+    def pydec_line(self, dest, scope):
+        scope.env[id(self)] = scope.fresh('c')
+        seq = pyf.sequence([f'{dest} = {scope.env[id(self)]} = {{}}'])
+        py_dec_fields(seq, self.fields, self, scope)
+        return seq
+
+    def pyenc_line(self, src, scope):
+        scope.env[id(self)] = scope.fresh('c')
+        seq = pyf.sequence([f'{scope.env[id(self)]} = {src}'])
+        py_enc_fields(seq, self.fields, self, scope)
+        return seq
+
+    def pysize_line(self, size, src, scope):
+        if not self.complex:
+            return pyf.line(f'{size} += {self.size}')
+        scope.env[id(self)] = scope.fresh('c')
+        seq = pyf.sequence([f'{scope.env[id(self)]} = {src}'])
+        fixed = py_size_fields(seq, self.fields, self, size, scope)
+        if fixed:
+            seq.append(f'{size} += {fixed}')
+        return seq
+
+    # Nested structured dtype, same as the dicts
+    def np_field(self):
+        fields = np_fields(self.fields)
+        if not fields:
+            return None
+        return pyf.literal(f'({py_attr(self.name)!r}, [', '])', fields)
+
+    # Flattened, an array per member
+    def soa_fields(self, path):
+        return [
+            m for f in self.fields for m in f.soa_fields(f'{path}.{f.name}')
+        ]
+
+    @property
+    def hashable(self):
+        return all(field.hashable for field in self.fields)
+
+    def hash_line(self, hash, src):
+        seq = c.sequence()
+        for field in self.fields:
+            v = c.variable(f'{src}.{field}', field.typename)
+            seq.append(field.hash_line(hash, v))
+        return seq
+
+    def eq_line(self, a, b):
+        seq = c.sequence()
+        for field in self.fields:
+            seq.append(field.eq_line(
+                c.variable(f'{a}.{field}', field.typename),
+                c.variable(f'{b}.{field}', field.typename)
+            ))
+        return seq
+
+    def checked_dec_line(self, dest, src, end, fail):
+        seq = c.sequence()
+        position = 0
+        endpos = len(self.fields)
+        while(position < endpos):
+            start = position
+            position, total = group_numerics_size(self.fields, position)
+            if total:
+                seq.append(c.ifcond(c.lth(c.subop(end, src), total), (
+                    copy.deepcopy(fail),
+                )))
+            for field in self.fields[start:position]:
+                v = c.variable(f'{dest}.{field}', field.typename)
+                seq.append(field.dec_line(src, v, src))
+            if position < endpos:
+                field = self.fields[position]
+                position += 1
+                v = c.variable(f'{dest}.{field}', field.typename)
+                seq.append(field.checked_dec_line(v, src, end, fail))
+        return seq
+
     def size_line(self, size, src):
         if not self.complex:
             position, total = group_numerics_size(self.fields, 0)
@@ -674,7 +2020,7 @@ class mc_container(custom_type):
         while(position < endpos):
             position, total = group_numerics_walk(self.fields, position)
             if total:
-                seq.append(c.ifcond(c.lth(max_len, total), (fail,)))
+                seq.append(walk_short_line(ret, max_len, total, fail))
                 seq.append(c.statement(c.addeq(size, total)))
                 seq.append(c.statement(c.addeq(src, total)))
                 seq.append(c.statement(c.subeq(max_len, total)))
@@ -683,24 +2029,9 @@ class mc_container(custom_type):
                 field = self.fields[position]
                 position += 1
                 if field.switched:
-                    #ToDo: Consider giving types a walk_switched method instead
-                    # of this madness
-                    seq.append(c.statement(field.internal.decl))
-                    if isinstance(field, numeric_type):
-                        seq.append(c.ifcond(c.lth(max_len, field.size), (fail,)))
-                        seq.append(c.statement(c.addeq(size, field.size)))
-                        seq.append(c.statement(c.subeq(max_len, field.size)))
-                    else:
-                        seq.append(field.walk_line(ret, src, max_len, fail))
-                        seq.append(c.statement(c.addeq(size, ret)))
-                        seq.append(c.statement(c.subeq(max_len, ret)))
-                    if isinstance(field, memory_type):
-                        seq.append(field.walkdec_line(src, field, src, fail))
-                        to_free.append(field)
-                        fail = copy.deepcopy(fail)
-                        fail.insert(0, field.free_line(field))
-                    else:
-                        seq.append(field.dec_line(src, field, src))
+                    fail = walk_switched_field(
+                        seq, field, ret, src, max_len, size, fail, to_free
+                    )
                 elif isinstance(field, custom_type):
                     seq.append(field.walk_line(ret, src, max_len, size, fail))
                 else:
@@ -714,7 +2045,8 @@ class mc_container(custom_type):
 
     def free_line(self, src):
         seq = c.sequence()
-        for field in self.fields:
+        # Backwards, switches need the fields they compare to still intact
+        for field in reversed(self.fields):
             if isinstance(field, memory_type) or (
                 hasattr(field, 'children') and
                 check_instance(field.children, memory_type)
@@ -733,18 +2065,30 @@ class mc_option(custom_type):
         self.val = get_type(data, 'val', self)
         self.children.append(self.val)
 
+    @property
+    def min_size(self):
+        return self.opt.size
+
+    @property
+    def max_size(self):
+        if self.val.max_size is None:
+            return None
+        return self.opt.size + self.val.max_size
+
     def struct_line(self):
         return c.linesequence((c.struct(elems = (
             self.opt.struct_line(),
             self.val.struct_line()
         )), c.statement(self.name)))
 
-    def enc_line(self, ret, dest, src):
+    def enc_line(self, ret, dest, src, end = None, fail = None):
         seq = c.sequence()
         optvar = c.variable(f'{src}.opt')
-        seq.append(self.opt.enc_line(ret, dest, optvar))
+        seq.append(self.opt.enc_line(ret, dest, optvar, end, fail))
         valvar = c.variable(f'{src}.val')
-        seq.append(c.ifcond(optvar, (self.val.enc_line(ret, dest, valvar),)))
+        seq.append(c.ifcond(optvar, (
+            self.val.enc_line(ret, dest, valvar, end, fail),
+        )))
         return seq
 
     def dec_line(self, ret, dest, src):
@@ -755,6 +2099,71 @@ class mc_option(custom_type):
         seq.append(c.ifcond(optvar, (self.val.dec_line(ret, valvar, src),)))
         return seq
 
+    def rand_line(self, dest):
+        seq = c.sequence()
+        optvar = c.variable(f'{dest}.opt')
+        seq.append(c.statement(c.assign(optvar, 'mc_bench_rand() & 1')))
+        valvar = c.variable(f'{dest}.val', self.val.typename)
+        seq.append(c.ifcond(optvar, (self.val.rand_line(valvar),)))
+        return seq
+
+    # None when absent
+    def topy_line(self, parent, key, src, depth):
+        optvar = c.variable(f'{src}.opt')
+        valvar = c.variable(f'{src}.val', self.val.typename)
+        return c.sequence((
+            c.ifcond(optvar, (
+                self.val.topy_line(parent, key, valvar, depth),
+            )),
+            c.ifcond(f'!{optvar}', (
+                py_insert(parent, key, c.fcall('mc_py_none', 'PyObject *')),
+            )),
+        ))
+
+    def frompy_line(self, parent, key, dest, depth):
+        obj = f'py[{depth}]'
+        optvar = c.variable(f'{dest}.opt')
+        valvar = c.variable(f'{dest}.val', self.val.typename)
+        return c.sequence((
+            py_fetch(obj, parent, key),
+            c.statement(c.assign(optvar, f'{obj} != Py_None')),
+            c.ifcond(optvar, (self.val.frompy_val(obj, valvar, depth),)),
+        ))
+
+    def pydec_line(self, dest, scope):
+        return pyf.sequence((
+            'pos += 1',
+            pyf.ifcond('view[pos - 1]', (self.val.pydec_line(dest, scope),)),
+            pyf.elsecond((f'{dest} = None',)),
+        ))
+
+    def pyenc_line(self, src, scope):
+        return pyf.sequence((
+            f'buf[pos] = {src} is not None',
+            'pos += 1',
+            pyf.ifcond(f'{src} is not None', (
+                self.val.pyenc_line(src, scope),
+            )),
+        ))
+
+    def pysize_line(self, size, src, scope):
+        return pyf.sequence((
+            f'{size} += 1',
+            pyf.ifcond(f'{src} is not None', (
+                self.val.pysize_line(size, src, scope),
+            )),
+        ))
+
+    def checked_dec_line(self, dest, src, end, fail):
+        seq = c.sequence()
+        optvar = c.variable(f'{dest}.opt')
+        generic_checked_dec_func(seq, self.opt, optvar, src, end, fail)
+        valvar = c.variable(f'{dest}.val')
+        ifseq = c.ifcond(optvar)
+        generic_checked_dec_func(ifseq, self.val, valvar, src, end, fail)
+        seq.append(ifseq)
+        return seq
+
     def size_line(self, size, src):
         seq = c.sequence()
         optvar = c.variable(f'{src}.opt')
@@ -770,7 +2179,7 @@ class mc_option(custom_type):
 
     def walk_line(self, ret, src, max_len, size, fail):
         seq = c.sequence()
-        seq.append(c.ifcond(c.lth(max_len, self.opt.size), (fail,)))
+        seq.append(walk_short_line(ret, max_len, self.opt.size, fail))
         optvar = c.variable(f'{self.name}_opt', self.opt.typename)
         seq.append(c.statement(optvar.decl))
         seq.append(self.opt.dec_line(src, optvar, src))
@@ -781,7 +2190,7 @@ class mc_option(custom_type):
         if isinstance(self.val, custom_type):
             ifseq.append(self.val.walk_line(ret, src, max_len, size, fail))
         elif isinstance(self.val, numeric_type):
-            ifseq.append(c.ifcond(c.lth(max_len, self.val.size), (fail,)))
+            ifseq.append(walk_short_line(ret, max_len, self.val.size, fail))
             ifseq.append(c.statement(c.addeq(size, self.val.size)))
             ifseq.append(c.statement(c.addeq(src, self.val.size)))
             ifseq.append(c.statement(c.subeq(max_len, self.val.size)))
@@ -792,6 +2201,27 @@ class mc_option(custom_type):
             ifseq.append(c.statement(c.subeq(max_len, ret)))
         return seq
 
+    @property
+    def hashable(self):
+        return self.val.hashable
+
+    def hash_line(self, hash, src):
+        optvar = c.variable(f'{src}.opt')
+        valvar = c.variable(f'{src}.val')
+        return c.sequence((
+            self.opt.hash_line(hash, optvar),
+            c.ifcond(optvar, (self.val.hash_line(hash, valvar),)),
+        ))
+
+    def eq_line(self, a, b):
+        optvar = c.variable(f'{a}.opt')
+        return c.sequence((
+            self.opt.eq_line(optvar, c.variable(f'{b}.opt')),
+            c.ifcond(optvar, (self.val.eq_line(
+                c.variable(f'{a}.val'), c.variable(f'{b}.val')
+            ),)),
+        ))
+
     # Option isn't a memory type, so if free_line is called we know that val is
     # or contains one
     def free_line(self, src):
@@ -829,9 +2259,85 @@ def generic_size_func(app, field, size, src):
     else:
         app.append(field.size_line(size, src))
 
+def enc_short_line(dest, end, need, fail):
+    return c.ifcond(c.lth(c.subop(end, dest), need), (copy.deepcopy(fail),))
+
+# Bounds checked encode of a run of fields, numerics next to each other share a
+# single check
+def bounded_enc_fields(app, fields, ret, dest, src, end, fail):
+    position = 0
+    endpos = len(fields)
+    while(position < endpos):
+        start = position
+        position, total = group_numerics_size(fields, position)
+        if total:
+            app.append(enc_short_line(dest, end, total, fail))
+        for field in fields[start:position]:
+            v = c.variable(f'{src}.{field}', field.typename)
+            app.append(field.enc_line(ret, dest, v))
+        if position < endpos:
+            field = fields[position]
+            position += 1
+            v = c.variable(f'{src}.{field}', field.typename)
+            app.append(field.enc_line(ret, dest, v, end, fail))
+
+# Walk functions return the varnum_errors value left in ret, so failures that
+# aren't a nested walk call set it first
+def walk_fail(ret, fail, err):
+    fail = copy.deepcopy(fail)
+    fail.insert(0, c.statement(c.assign(ret, err)))
+    return fail
+
+# walk_resume_ tags its fail sequences with the size variable, so running
+# short also records how much the walk needs at least, see gen_resumefunc
+def walk_short_line(ret, max_len, need, fail):
+    fail = walk_fail(ret, fail, 'varnum_overrun')
+    size = getattr(fail, 'resume_size', None)
+    if size is not None:
+        total = f'(size_t) ({c.addop(size, need)})'
+        fail.insert(0, c.inlineif(c.lth('cursor->need', total),
+            c.statement(c.assign('cursor->need', total))))
+    return c.ifcond(c.lth(max_len, need), (fail,))
+
+# Switched fields are walked and then decoded into a local for the switches
+# that depend on them, memory types among them get freed by the returned fail
+# and are added to to_free for the caller to free on success. Strings are only
+# ever compared against, so they're decoded as views and never allocate
+#ToDo: Consider giving types a walk_switched method instead of this madness
+def walk_switched_field(app, field, ret, src, max_len, size, fail, to_free):
+    if isinstance(field, mc_string):
+        field = mc_string_view(field.name, field.parent)
+    app.append(c.statement(field.internal.decl))
+    if isinstance(field, numeric_type):
+        app.append(walk_short_line(ret, max_len, field.size, fail))
+        app.append(c.statement(c.addeq(size, field.size)))
+        app.append(c.statement(c.subeq(max_len, field.size)))
+    else:
+        app.append(field.walk_line(ret, src, max_len, fail))
+        app.append(c.statement(c.addeq(size, ret)))
+        app.append(c.statement(c.subeq(max_len, ret)))
+    if isinstance(field, memory_type):
+        app.append(field.walkdec_line(
+            src, field, src, walk_fail(ret, fail, 'varnum_invalid')
+        ))
+        fail = copy.deepcopy(fail)
+        fail.insert(0, field.free_line(field))
+        to_free.append(field)
+    else:
+        app.append(field.dec_line(src, field, src))
+    return fail
+
+def check_switched(fields):
+    for field in fields:
+        if getattr(field, 'switched', False):
+            return True
+        if hasattr(field, 'children') and check_switched(field.children):
+            return True
+    return False
+
 def generic_walk_func(app, field, ret, src, max_len, size, fail):
     if isinstance(field, numeric_type):
-        app.append(c.ifcond(c.lth(max_len, field.size), (fail,)))
+        app.append(walk_short_line(ret, max_len, field.size, fail))
         app.append(c.statement(c.addeq(size, field.size)))
         app.append(c.statement(c.addeq(src, field.size)))
         app.append(c.statement(c.subeq(max_len, field.size)))
@@ -845,6 +2351,16 @@ def generic_walk_func(app, field, ret, src, max_len, size, fail):
             app.append(c.statement(c.addeq(src, ret)))
             app.append(c.statement(c.subeq(max_len, ret)))
 
+def generic_checked_dec_func(app, field, dest, src, end, fail):
+    if isinstance(field, numeric_type):
+        if field.size:
+            app.append(c.ifcond(c.lth(c.subop(end, src), field.size), (
+                copy.deepcopy(fail),
+            )))
+        app.append(field.dec_line(src, dest, src))
+    else:
+        app.append(field.checked_dec_line(dest, src, end, fail))
+
 # compare is a protodef compareTo string
 # dest is a C struct/variable string to the switch variable
 # By their powers combined we find our way to the switched variable
@@ -887,9 +2403,9 @@ def get_switched_path(compare, dest, field, decode=True):
 # Moreover, mcdata uses switches to implement non-trivial optionals (optionals
 # that aren't prefixed by a bool byte). A naive implementation results in some
 # pretty silly data structures. We try to detect when the switch is actually an
-# optional by checking all sorts of crap. Ideally we would be able to merge
-# identical sequential switches but that's really hard to do with mcd2c's
-# current structure
+# optional by checking all sorts of crap. Sequential switches on the same value
+# are merged by merge_switches, the first one generates a single branch for all
+# of them
 #
 # I dislike protodef switches and I dislike how mcdata uses them
 @mc_data_name('switch')
@@ -947,6 +2463,134 @@ class mc_switch(custom_type):
         if isinstance(field.parent, mc_bitfield) and not self.isbool:
             self.isbool = field.parent.field_sizes[field.name] == 1
         field.switched = True
+        # Random instances take every case, and the default through a value
+        # none of the cases match
+        if self.isbool:
+            values = [0, 1]
+        else:
+            values = list(self.map)
+            if self.has_default:
+                values.append('' if self.string_switch else max(values) + 1)
+        field.switch_values.extend(
+            v for v in values if v not in field.switch_values
+        )
+
+        # Switches merged into this one, see merge_switches
+        self.merged = []
+        self.leader = None
+
+    # Folds a following switch on the same value into this one, it generates
+    # nothing itself from then on
+    def merge(self, follower):
+        self.merged.append(follower)
+        follower.leader = self
+        self.children = self.children + follower.children
+
+    def mergeable(self, value):
+        if not isinstance(value, mc_switch) or value.leader is not None:
+            return False
+        if self.compare != value.compare:
+            return False
+        if self.string_switch != value.string_switch:
+            return False
+        ifs = self.isbool and self.optional
+        if ifs != (value.isbool and value.optional):
+            return False
+        return not ifs or bool(self.optional_case) == bool(value.optional_case)
+
+    @property
+    def members(self):
+        return [self] + self.merged
+
+    # Every case value across the merged switches, grouped by the fields each
+    # switch handles it with (None for nothing), plus the fields for the
+    # default case or None if there isn't one
+    def case_table(self):
+        def member_case(member, caseval):
+            field = member.map.get(caseval)
+            if field is None and member.has_default:
+                field = member.default_typ
+            return None if isinstance(field, void_type) else field
+        def same(a, b):
+            return all(
+                i is j or (i is not None and j is not None and i == j)
+                for i, j in zip(a, b)
+            )
+        groups = []
+        for caseval in dict.fromkeys(k for m in self.members for k in m.map):
+            fields = tuple(member_case(m, caseval) for m in self.members)
+            for keys, group in groups:
+                if same(fields, group):
+                    keys.append(caseval)
+                    break
+            else:
+                groups.append(([caseval], fields))
+        default = tuple(
+            m.default_typ if m.has_default else None for m in self.members
+        )
+        if all(field is None for field in default):
+            default = None
+        return groups, default, same
+
+    def _string_table(self):
+        if not hasattr(self, 'seed'):
+            keys = [
+                str(k) for k in dict.fromkeys(
+                    k for m in self.members for k in m.map
+                )
+            ]
+            self.seed, size, slots = perfect_hash(keys)
+            self.mask = size - 1
+            self.slot_of = {k: i for i, k in slots.items()}
+            table = tuple(slots.get(i) for i in range(size))
+            if table not in string_switch_tables:
+                string_switch_tables.append(table)
+            self.table = f'strswitch_{string_switch_tables.index(table)}'
+
+    # String switches switch on the slot their string hashes to, or -1 if it
+    # isn't one of the cases. string_type is the type of swvar, walks decode
+    # the strings they switch on as views
+    def switch_on(self, swvar, string_type = None):
+        if not self.string_switch:
+            return swvar
+        self._string_table()
+        if string_type is None:
+            string_type = mcd_typemap['string']
+        return c.fcall('mc_strswitch', 'int', (
+            *string_type.switch_args(swvar),
+            f'{self.seed}', self.table, f'{self.mask}'
+        ))
+
+    def case_val(self, caseval):
+        if not self.string_switch:
+            return caseval
+        self._string_table()
+        return f'{self.slot_of[str(caseval)]} /* "{caseval}" */'
+
+    # Merged switches only count towards the size of their leader, without a
+    # default unmatched values encode nothing
+    def _case_sizes(self, attr):
+        if self.leader is not None:
+            return [0]
+        groups, default, _ = self.case_table()
+        cases = [fields for _, fields in groups]
+        cases.append(default if default else ())
+        sizes = []
+        for fields in cases:
+            fields = [f for f in fields if f is not None]
+            if any(getattr(f, attr) is None for f in fields):
+                return None
+            sizes.append(sum(getattr(f, attr) for f in fields))
+        return sizes
+
+    @property
+    def min_size(self):
+        return min(self._case_sizes('min_size'))
+
+    @property
+    def max_size(self):
+        sizes = self._case_sizes('max_size')
+        return None if sizes is None else max(sizes)
 
     def struct_line(self):
         if self.optional:
@@ -956,404 +2600,224 @@ class mc_switch(custom_type):
             c.statement(self.name)
         ))
 
-    def enc_line(self, ret, dest, src):
-        swvar = c.variable(get_switched_path(self.compare, src.name, self, False))
+    # The variable for a case's field, var is the one for this switch and
+    # merged switches sit next to it
+    def _case_var(self, member, field, var):
+        var = str(var)
+        if member is not self:
+            var = var[:len(var) - len(self.name)] + member.name
+        if member.optional:
+            return c.variable(var)
+        return c.variable(f'{var}.{field}')
+
+    # case_line(member, field) builds the lines for one switch's field, empty
+    # is the comment left in cases with nothing to do
+    def _switch(self, swvar, case_line, empty, string_type = None):
+        if self.leader is not None:
+            return c.sequence()
         if self.isbool and self.optional:
-            v = c.variable(src.name)
+            elems = []
+            for member in self.members:
+                elems.extend(case_line(member, member.fields[0]))
             if self.optional_case:
-                return c.ifcond(swvar, (self.fields[0].enc_line(ret, dest, v),))
-            else:
-                return c.ifcond(c.wrap(swvar, True), (
-                    self.fields[0].enc_line(ret, dest, v),
-                ))
-
-        if not self.string_switch:
-            sw = c.switch(swvar)
-            completed_fields = []
-            for caseval, field in self.map.items():
-                for idx, temp in enumerate(completed_fields):
-                    if field == temp:
-                        sw.insert(idx, c.case(caseval, fall=True))
-                        completed_fields.insert(idx, field)
-                        break
-                else:
-                    cf = c.case(caseval)
-                    if isinstance(field, void_type):
-                        cf.append(c.linecomment('void condition'))
-                    else:
-                        if self.optional:
-                            v = c.variable(src.name)
-                        else:
-                            v = c.variable(f'{src}.{field}')
-                        cf.append(field.enc_line(ret, dest, v))
-                    completed_fields.append(field)
-                    sw.append(cf)
-            if self.has_default:
-                for idx, temp in enumerate(completed_fields):
-                    if self.default_typ == temp:
-                        sw.insert(idx, c.defaultcase())
-                        break
-                else:
-                    df = c.defaultcase()
-                    if self.optional:
-                        v = c.variable(src.name)
-                    else:
-                        v = c.variable(f'{src}.{field}')
-                    df.append(self.default_typ.enc_line(ret, dest, v))
-                    sw.append(df)
-            return sw
-        first = True
-        sw = c.linesequence()
-        for caseval, field in self.map.items():
-            if not self.has_default and isinstance(field, void_type):
-                continue
-            if first:
-                cf = c.nospace_ifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swvar)
-                ), True))
-                first = False
-            else:
-                cf = c.elifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swvar)
-                ), True))
-            if isinstance(field, void_type):
-                cf.append(c.linecomment('void condition'))
-            else:
-                if self.optional:
-                    v = c.variable(src.name)
-                else:
-                    v = c.variable(f'{src}.{field}')
-                cf.append(field.enc_line(ret, dest, v))
-            sw.append(cf)
-        if self.has_default:
-            df = c.elsecond()
-            if self.optional:
-                v = c.variable(src.name)
-            else:
-                v = c.variable(f'{src}.{self.default_typ}')
-            df.append(self.default_typ.enc_line(ret, dest, v))
-            sw.append(df)
+                return c.ifcond(swvar, elems)
+            return c.ifcond(c.wrap(swvar, True), elems)
+
+        def body(blk, fields):
+            for member, field in zip(self.members, fields):
+                if field is not None:
+                    blk.extend(case_line(member, field))
+            if not len(blk):
+                blk.append(c.linecomment(empty))
+            return blk
+
+        groups, default, same = self.case_table()
+        sw = c.switch(self.switch_on(swvar, string_type))
+        for keys, fields in groups:
+            if default is not None and same(fields, default):
+                sw.append(c.defaultcase())
+                default = None
+            for caseval in keys[:-1]:
+                sw.append(c.case(self.case_val(caseval), fall=True))
+            sw.append(body(c.case(self.case_val(keys[-1])), fields))
+        if default is not None:
+            sw.append(body(c.defaultcase(), default))
         return sw
 
+    def enc_line(self, ret, dest, src, end = None, fail = None):
+        swvar = c.variable(get_switched_path(self.compare, src.name, self, False))
+        return self._switch(swvar, lambda member, field: [field.enc_line(
+            ret, dest, self._case_var(member, field, src), end, fail
+        )], 'void condition')
+
     def dec_line(self, ret, dest, src):
         swvar = c.variable(get_switched_path(self.compare, dest.name, self))
-        if self.isbool and self.optional:
-            v = c.variable(dest.name)
-            if self.optional_case:
-                return c.ifcond(swvar, (self.fields[0].dec_line(ret, v, src),))
-            else:
-                return c.ifcond(c.wrap(swvar, True), (
-                    self.fields[0].dec_line(ret, v, src),
-                ))
+        return self._switch(swvar, lambda member, field: [field.dec_line(
+            ret, self._case_var(member, field, dest), src
+        )], 'void condition')
 
-        if not self.string_switch:
-            sw = c.switch(swvar)
-            completed_fields = []
-            for caseval, field in self.map.items():
-                for idx, temp in enumerate(completed_fields):
-                    if field == temp:
-                        sw.insert(idx, c.case(caseval, fall=True))
-                        completed_fields.insert(idx, field)
-                        break
-                else:
-                    cf = c.case(caseval)
-                    if isinstance(field, void_type):
-                        cf.append(c.linecomment('void condition'))
-                    else:
-                        if self.optional:
-                            v = c.variable(dest.name)
-                        else:
-                            v = c.variable(f'{dest}.{field}')
-                        cf.append(field.dec_line(ret, v, src))
-                    completed_fields.append(field)
-                    sw.append(cf)
-            if self.has_default:
-                for idx, temp in enumerate(completed_fields):
-                    if self.default_typ == temp:
-                        sw.insert(idx, c.defaultcase())
-                        break
-                else:
-                    df = c.defaultcase()
-                    if self.optional:
-                        v = c.variable(dest.name)
-                    else:
-                        v = c.variable(f'{dest}.{self.default_typ}')
-                    df.append(self.default_typ.dec_line(ret, v, src))
-                    sw.append(df)
-            return sw
-        first = True
-        sw = c.linesequence()
-        for caseval, field in self.map.items():
-            if not self.has_default and isinstance(field, void_type):
-                continue
-            if first:
-                cf = c.nospace_ifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swvar)
-                ), True))
-                first = False
-            else:
-                cf = c.elifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swvar)
-                ), True))
-            if isinstance(field, void_type):
-                cf.append(c.linecomment('void condition'))
-            else:
-                if self.optional:
-                    v = c.variable(dest.name)
-                else:
-                    v = c.variable(f'{dest}.{field}')
-                cf.append(field.dec_line(ret, v, src))
-            sw.append(cf)
-        if self.has_default:
-            df = c.elsecond()
-            if self.optional:
-                v = c.variable(dest.name)
-            else:
-                v = c.variable(f'{dest}.{self.default_typ}')
-            df.append(self.default_typ.dec_line(ret, v, src))
-            sw.append(df)
-        return sw
+    def checked_dec_line(self, dest, src, end, fail):
+        swvar = c.variable(get_switched_path(self.compare, dest.name, self))
+        def case_line(member, field):
+            seq = []
+            generic_checked_dec_func(
+                seq, field, self._case_var(member, field, dest), src, end, fail
+            )
+            return seq
+        return self._switch(swvar, case_line, 'void condition')
+
+    def rand_line(self, dest):
+        swvar = c.variable(get_switched_path(self.compare, dest.name, self))
+        return self._switch(swvar, lambda member, field: [field.rand_line(
+            self._case_var(member, field, dest)
+        )], 'void condition')
+
+    # Only the field of the case that's taken is present, under the switch's
+    # own name, void cases leave it out
+    def topy_line(self, parent, key, src, depth):
+        swvar = c.variable(get_switched_path(self.compare, src.name, self))
+        return self._switch(swvar, lambda member, field: [field.topy_line(
+            parent, key if member is self else member.name,
+            self._case_var(member, field, src), depth
+        )], 'void condition')
+
+    def frompy_line(self, parent, key, dest, depth):
+        swvar = c.variable(get_switched_path(self.compare, dest.name, self))
+        return self._switch(swvar, lambda member, field: [field.frompy_line(
+            parent, key if member is self else member.name,
+            self._case_var(member, field, dest), depth
+        )], 'void condition')
 
     def size_line(self, size, src):
         swpath = get_switched_path(self.compare, src.name, self, False)
-        if self.isbool and self.optional:
-            elems = []
-            generic_size_func(elems, self.fields[0], size, src)
-            if self.optional_case:
-                return c.ifcond(swpath, elems)
-            else:
-                return c.wrap(c.ifcond(swpath, elems), True)
-        if not self.string_switch:
-            sw = c.switch(swpath)
-            completed_fields = []
-            for caseval, field in self.map.items():
-                for idx, temp in enumerate(completed_fields):
-                    if field == temp:
-                        sw.insert(idx, c.case(caseval, fall=True))
-                        completed_fields.insert(idx, field)
-                        break
-                else:
-                    cf = c.case(caseval)
-                    if isinstance(field, void_type):
-                        cf.append(c.linecomment('void condition'))
-                    else:
-                        if self.optional:
-                            v = c.variable(src.name)
-                        else:
-                            v = c.variable(f'{src}.{field}')
-                        generic_size_func(cf, field, size, v)
-                    completed_fields.append(field)
-                    sw.append(cf)
-            if self.has_default:
-                for idx, temp in enumerate(completed_fields):
-                    if self.default_typ == temp:
-                        sw.insert(idx, c.defaultcase())
-                        break
-                else:
-                    df = c.defaultcase()
-                    if self.optional:
-                        v = c.variable(src.name)
-                    else:
-                        v = c.variable(f'{src}.{self.default_typ}')
-                    generic_size_func(df, self.default_typ, size, v)
-                    sw.append(df)
-            return sw
-        first = True
-        sw = c.linesequence()
-        for caseval, field in self.map.items():
-            if not self.has_default and isinstance(field, void_type):
-                continue
-            if first:
-                cf = c.nospace_ifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swpath)
-                ), True))
-                first = False
-            else:
-                cf = c.elifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swpath)
-                ), True))
-            if isinstance(field, void_type):
-                cf.append(c.linecomment('void condition'))
-            else:
-                if self.optional:
-                    v = c.variable(src.name)
+        def case_line(member, field):
+            seq = []
+            generic_size_func(
+                seq, field, size, self._case_var(member, field, src)
+            )
+            return seq
+        return self._switch(swpath, case_line, 'void condition')
+
+    # _switch for the pure Python codecs, an if chain. case_line(member,
+    # field, var) and empty(member, var) return lists of lines, var is the
+    # expression for the member's value
+    def _pyswitch(self, var, scope, case_line, empty):
+        seq = pyf.sequence()
+        if self.leader is not None:
+            return seq
+        def body(fields):
+            lines = []
+            for member, field in zip(self.members, fields):
+                mvar = var if member is self else \
+                    py_access(self.parent, member.name, scope)
+                if field is None:
+                    lines.extend(empty(member, mvar))
                 else:
-                    v = c.variable(f'{src}.{field}')
-                generic_size_func(cf, field, size, v)
-            sw.append(cf)
-        if self.has_default:
-            df = c.elsecond()
-            if self.optional:
-                v = c.variable(src.name)
+                    lines.extend(case_line(member, field, mvar))
+            return lines
+        swvar = py_lookup(self.compare, self, scope)
+        nothing = body((None,) * len(self.members))
+        if self.isbool and self.optional:
+            cond = swvar if self.optional_case else f'not {swvar}'
+            seq.append(pyf.ifcond(
+                cond, body([m.fields[0] for m in self.members])
+            ))
+            if nothing:
+                seq.append(pyf.elsecond(nothing))
+            return seq
+
+        groups, default, same = self.case_table()
+        groups = [
+            (keys, fields) for keys, fields in groups
+            if default is None or not same(fields, default)
+        ]
+        if len(groups) > 1:
+            local = scope.fresh('sw')
+            seq.append(f'{local} = {swvar}')
+            swvar = local
+        for idx, (keys, fields) in enumerate(groups):
+            vals = [repr(str(k) if self.string_switch else k) for k in keys]
+            if len(vals) == 1:
+                cond = f'{swvar} == {vals[0]}'
             else:
-                v = c.variable(f'{src}.{self.default_typ}')
-            generic_size_func(df, self.default_typ, size, v)
-            sw.append(df)
-        return sw
+                cond = f'{swvar} in ({", ".join(vals)})'
+            seq.append((pyf.elifcond if idx else pyf.ifcond)(
+                cond, body(fields)
+            ))
+        rest = nothing if default is None else body(default)
+        if rest and groups:
+            seq.append(pyf.elsecond(rest))
+        elif rest:
+            seq.extend(rest)
+        return seq
+
+    # Only the case that's taken is decoded into the switch's field, it's
+    # None when that's a void case
+    def pydec_line(self, dest, scope):
+        return self._pyswitch(dest, scope,
+            lambda member, field, var: [field.pydec_line(var, scope)],
+            lambda member, var: [f'{var} = None'])
+
+    def pyenc_line(self, src, scope):
+        return self._pyswitch(src, scope,
+            lambda member, field, var: [field.pyenc_line(var, scope)],
+            lambda member, var: [])
+
+    def pysize_line(self, size, src, scope):
+        return self._pyswitch(src, scope,
+            lambda member, field, var: [field.pysize_line(size, var, scope)],
+            lambda member, var: [])
 
     def walk_line(self, ret, src, max_len, size, fail):
-        if self.isbool and self.optional:
-            elems = []
-            generic_walk_func(elems, self.fields[0], ret, src, max_len, size, fail)
-            if self.optional_case:
-                return c.ifcond(self.cp_short, elems)
-            else:
-                return c.ifcond(c.wrap(self.cp_short, True), elems)
+        def case_line(member, field):
+            seq = []
+            generic_walk_func(seq, field, ret, src, max_len, size, fail)
+            return seq
+        return self._switch(
+            self.cp_short, case_line, 'void condition', mc_string_view
+        )
 
-        if not self.string_switch:
-            sw = c.switch(self.cp_short)
-            completed_fields = []
-            for caseval, field in self.map.items():
-                for idx, temp in enumerate(completed_fields):
-                    if field == temp:
-                        sw.insert(idx, c.case(caseval, fall=True))
-                        completed_fields.insert(idx, field)
-                        break
-                else:
-                    cf = c.case(caseval)
-                    if isinstance(field, void_type):
-                        cf.append(c.linecomment('void condition'))
-                    else:
-                        generic_walk_func(cf, field, ret, src, max_len, size, fail)
-                    completed_fields.append(field)
-                    sw.append(cf)
-            if self.has_default:
-                for idx, temp in enumerate(completed_fields):
-                    if self.default_typ == temp:
-                        sw.insert(idx, c.defaultcase())
-                        break
-                else:
-                    df = c.defaultcase()
-                    generic_walk_func(
-                        df, self.default_typ, ret, src, max_len, size, fail
-                    )
-                    sw.append(df)
-            return sw
-        first = True
-        sw = c.linesequence()
-        for caseval, field in self.map.items():
-            if not self.has_default and isinstance(field, void_type):
-                continue
-            if first:
-                cf = c.nospace_ifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', self.cp_short)
-                ), True))
-                first = False
-            else:
-                cf = c.elifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', self.cp_short)
-                ), True))
-            if isinstance(field, void_type):
-                cf.append(c.linecomment('void condition'))
-            else:
-                generic_walk_func(cf, field, ret, src, max_len, size, fail)
-            sw.append(cf)
-        if self.has_default:
-            df = c.elsecond()
-            generic_walk_func(
-                df, self.default_typ, ret, src, max_len, size, fail
-            )
-            sw.append(df)
-        return sw
+    @property
+    def hashable(self):
+        return all(field.hashable for field in self.fields)
 
+    # Whatever the field switched on is, it's already been compared by the
+    # time eq_ gets here, so only a's needs looking at
+    def hash_line(self, hash, src):
+        swpath = get_switched_path(self.compare, src.name, self, False)
+        return self._switch(swpath, lambda member, field: [field.hash_line(
+            hash, self._case_var(member, field, src)
+        )], 'void condition')
+
+    def eq_line(self, a, b):
+        swpath = get_switched_path(self.compare, a.name, self, False)
+        return self._switch(swpath, lambda member, field: [field.eq_line(
+            self._case_var(member, field, a), self._case_var(member, field, b)
+        )], 'void condition')
+
+    # Switch is not a memory type, so if it's getting a free_line call then
+    # one of its fields is a memory type or contains one
     def free_line(self, src):
         swpath = get_switched_path(self.compare, src.name, self, False)
-        # Switch is not a memory type, so if its optional and getting a
-        # free_line call, then that type is a memory type or contains one
-        if self.isbool and self.optional:
-            if self.optional_case:
-                return c.ifcond(swpath, (self.fields[0].free_line(src),))
-            else:
-                return c.ifcond(c.wrap(swpath, True), (
-                    self.fields[0].free_line(src),
-                ))
-
-        if not self.string_switch:
-            sw = c.switch(swpath)
-            completed_fields = []
-            for caseval, field in self.map.items():
-                for idx, temp in enumerate(completed_fields):
-                    if field == temp:
-                        sw.insert(idx, c.case(caseval, fall=True))
-                        completed_fields.insert(idx, field)
-                        break
-                else:
-                    cf = c.case(caseval)
-                    if isinstance(field, memory_type) or (
-                        hasattr(field, 'children') and
-                        check_instance(field.children, memory_type)
-                    ):
-                        if self.optional:
-                            v = c.variable(src.name)
-                        else:
-                            v = c.variable(f'{src}.{field}')
-                        cf.append(field.free_line(v))
-                    else:
-                        cf.append(c.linecomment('No free-able types'))
-                    completed_fields.append(field)
-                    sw.append(cf)
-            if self.has_default:
-                for idx, temp in enumerate(completed_fields):
-                    if self.default_typ == temp:
-                        sw.insert(idx, c.defaultcase())
-                        break
-                else:
-                    df = c.defaultcase()
-                    if isinstance(self.default_typ, memory_type) or (
-                        hasattr(self.default_typ, 'children') and
-                        check_instance(self.default_typ.children, memory_type)
-                    ):
-                        if self.optional:
-                            v = c.variable(src.name)
-                        else:
-                            v = c.variable(f'{src}.{self.default_typ}')
-                        df.append(self.default_typ.free_line(v))
-                    else:
-                        df.append(c.linecomment('No free-able types'))
-                    sw.append(df)
-            return sw
-        first = True
-        sw = c.linesequence()
-        for caseval, field in self.map.items():
-            if not self.has_default and isinstance(field, void_type):
-                continue
-            if first:
-                cf = c.nospace_ifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swpath)
-                ), True))
-                first = False
-            else:
-                cf = c.elifcond(c.wrap(c.fcall(
-                    'sdscmp', 'int', (f'"{caseval}"', swpath)
-                ), True))
+        def case_line(member, field):
             if isinstance(field, memory_type) or (
                 hasattr(field, 'children') and
                 check_instance(field.children, memory_type)
             ):
-                if self.optional:
-                    v = c.variable(src.name)
-                else:
-                    v = c.variable(f'{src}.{field}')
-                cf.append(field.free_line(v))
-            else:
-                cf.append(c.linecomment('No free-able types'))
-            sw.append(cf)
-        if self.has_default:
-            df = c.elsecond()
-            if isinstance(self.default_typ, memory_type) or (
-                hasattr(self.default_typ, 'children') and
-                check_instance(self.default_typ.children, memory_type)
-            ):
-                if self.optional:
-                    v = c.variable(src.name)
-                else:
-                    v = c.variable(f'{src}.{self.default_typ}')
-                df.append(self.default_typ.free_line(v))
-            else:
-                df.append(c.linecomment('No free-able types'))
-            sw.append(df)
-        return sw
+                return [field.free_line(self._case_var(member, field, src))]
+            return []
+        return self._switch(swpath, case_line, 'No free-able types')
 
+# Merges runs of switches on the same value so it's only branched on once
+def merge_switches(fields):
+    leader = None
+    for field in fields:
+        if leader is not None and leader.mergeable(field):
+            leader.merge(field)
+        elif isinstance(field, mc_switch):
+            leader = field
+        else:
+            leader = None
 
 # bitfield is a custom_type instead of complex only because it needs to fully
 # handle itself for walk funcs when it contains a switched fields. Consider
@@ -1406,8 +2870,10 @@ class mc_bitfield(custom_type, numeric_type):
             c.statement(self.name)
         ))
 
-    def enc_line(self, ret, dest, src):
+    def enc_line(self, ret, dest, src, end = None, fail = None):
         seq = c.sequence()
+        if end is not None:
+            seq.append(enc_short_line(dest, end, self.size, fail))
         seq.append(c.statement(c.assign(self.storage.internal.decl, 0)))
         for idx, field in enumerate(self.fields):
             mask, shift = self.mask_shift[idx]
@@ -1431,10 +2897,78 @@ class mc_bitfield(custom_type, numeric_type):
             )))
         return seq
 
+    # Decoding doesn't sign extend, so stay inside the mask to roundtrip
+    def rand_line(self, dest):
+        seq = c.sequence()
+        for idx, field in enumerate(self.fields):
+            v = c.variable(f'{dest}.{field}', field.typename)
+            if field.switch_values:
+                seq.append(field.rand_line(v))
+            else:
+                mask, _ = self.mask_shift[idx]
+                seq.append(c.statement(c.assign(v, f'mc_bench_rand() & {mask}')))
+        return seq
+
+    # Dicts of their members, same as containers
+    topy_line = mc_container.topy_line
+    frompy_val = mc_container.frompy_val
+
+    @property
+    def py_format(self):
+        return self.storage.py_format
+
+    def py_target(self, dest, scope):
+        tmp = scope.fresh('t')
+        members = ', '.join(
+            f"'{field.name}': {tmp} >> {shift} & {mask}"
+            for field, (mask, shift) in zip(self.fields, self.mask_shift)
+        )
+        return tmp, [f'{dest} = {{{members}}}']
+
+    def py_value(self, src):
+        return ' | '.join(
+            f"({src}['{field.name}'] & {mask}) << {shift}"
+            for field, (mask, shift) in zip(self.fields, self.mask_shift)
+        ) or '0'
+
+    pydec_line = numeric_type.pydec_line
+    pyenc_line = numeric_type.pyenc_line
+    pysize_line = generic_type.pysize_line
+    pysize_val = numeric_type.pysize_val
+
+    # Same masks and shifts as py_target, no sign extension either
+    def np_field(self):
+        members = pyf.literal(
+            f"({py_attr(self.name)!r}, '{self.np_format}', [", '])'
+        )
+        for field, (mask, shift) in zip(self.fields, self.mask_shift):
+            members.append(
+                f"({py_attr(field.name)!r}, '{field.py_format}', {shift}, "
+                f"{mask:#x}, 0)"
+            )
+        return members
+
+    soa_fields = mc_container.soa_fields
+
+    # Only the bits that get encoded count
+    def hash_line(self, hash, src):
+        seq = c.sequence()
+        for field, (mask, _) in zip(self.fields, self.mask_shift):
+            seq.append(field.hash_line(hash, f'({src}.{field}&{mask})'))
+        return seq
+
+    def eq_line(self, a, b):
+        seq = c.sequence()
+        for field, (mask, _) in zip(self.fields, self.mask_shift):
+            seq.append(field.eq_line(
+                f'({a}.{field}&{mask})', f'({b}.{field}&{mask})'
+            ))
+        return seq
+
     # Only called if one or more fields are switched on
     def walk_line(self, ret, src, max_len, size, fail):
         seq = c.sequence()
-        seq.append(c.ifcond(c.lth(max_len, self.size), (fail,)))
+        seq.append(walk_short_line(ret, max_len, self.size, fail))
         seq.append(c.statement(self.storage.internal.decl))
         seq.append(c.statement(c.addeq(size, self.size)))
         seq.append(c.statement(c.subeq(max_len, self.size)))
@@ -1464,15 +2998,42 @@ class mc_particledata(memory_type):
     def dec_line(self, ret, dest, src):
         partvar = c.variable(get_switched_path(self.compare, dest.name, self))
         return c.statement(c.assign(ret, c.fcall(
-            f'dec_{self.postfix}', 'char *', (f'&{dest}', src.name, partvar)
+            f'dec_{self.postfix}', 'char *',
+            (f'&{dest}', src.name, partvar, 'arena')
         )))
 
+    def checked_dec_line(self, dest, src, end, fail):
+        partvar = c.variable(get_switched_path(self.compare, dest.name, self))
+        assign = c.wrap(c.assign(src, c.fcall(
+            f'dec_checked_{self.postfix}', 'char *',
+            (f'&{dest}', src, c.subop(end, src), partvar, 'arena')
+        )), True)
+        return c.ifcond(assign, (copy.deepcopy(fail),))
+
     def walk_line(self, ret, src, max_len, fail):
         assign = c.wrap(c.assign(ret, c.fcall(
             f'walk_{self.postfix}', 'int', (src, max_len, self.cp_short)
         )))
         return c.ifcond(c.lth(assign, 0), (fail,))
 
+    def frompy_raw(self, dest):
+        partvar = c.variable(get_switched_path(self.compare, dest.name, self))
+        return c.fcall(f'dec_checked_{self.postfix}', 'char *', (
+            f'&{dest}', 'raw.base', 'raw.len', partvar, 'NULL'
+        ))
+
+    def pydec_line(self, dest, scope):
+        partvar = py_lookup(self.compare, self, scope)
+        return pyf.line(
+            f'{dest}, pos = dec_{self.postfix}(view, pos, {partvar})'
+        )
+
+    def pyenc_line(self, src, scope):
+        partvar = py_lookup(self.compare, self, scope)
+        return pyf.line(
+            f'pos = enc_{self.postfix}(buf, pos, {src}, {partvar})'
+        )
+
 # ToDo: packets are containers with extra steps, we should stop duplicating
 # functionality and extract their common parts into a base class
 class packet:
@@ -1483,6 +3044,9 @@ class packet:
         self.children = self._fields
         self.need_free = check_instance(self._fields, memory_type)
         self.complex = check_instance(self._fields, complex_type)
+        # Field paths to generate peek_ and patch_ functions for, set by run()
+        self.peeks = []
+        self.patches = []
 
     def append(self, field):
         self._fields.append(field)
@@ -1499,6 +3063,31 @@ class packet:
         self.complex = check_instance(fields, complex_type)
         self._fields = fields
 
+    @property
+    def min_size(self):
+        return sum_sizes(self.fields)[0]
+
+    @property
+    def max_size(self):
+        return sum_sizes(self.fields)[1]
+
+    def soa_fields(self):
+        return [m for f in self.fields for m in f.soa_fields(f.name)]
+
+    # dec_batch_ only exists for packets that don't allocate, rest buffers are
+    # left out because they need the length of every packet
+    @property
+    def batchable(self):
+        return (not self.need_free and
+            not check_instance(self.fields, restbuffer_type) and
+            bool(self.soa_fields()))
+
+    # hash_ and eq_ only exist for packets where every field can be compared,
+    # which rules out NBT, slots, metadata and the like
+    @property
+    def hashable(self):
+        return bool(self.fields) and all(f.hashable for f in self.fields)
+
     @classmethod
     def from_proto(cls, state, direction, name, data):
         full_name = '_'.join((state, direction.lower(), name))
@@ -1510,6 +3099,7 @@ class packet:
                 fname = 'anonymous'
                 #print(f'Anonymous field in: {full_name}')
             pckt.append(get_type(field['type'], fname, pckt))
+        merge_switches(pckt.fields)
         # ToDo: This is a stupid hack, should be replaced my instantiating
         # fields in init by passing something like (typ, fname) tuples instead
         # instead of instantiated fields.
@@ -1520,6 +3110,16 @@ class packet:
             elems = [f.struct_line() for f in self.fields]
         ), self.full_name)
 
+    # Caller allocated arrays, nested fields are joined with underscores
+    def gen_soa_struct(self):
+        elems = []
+        for path, typename in self.soa_fields():
+            if typename is None:
+                typename = f'__typeof__((({self.full_name} *) 0)->{path})'
+            name = path.replace('.', '_')
+            elems.append(c.statement(c.variabledecl(f'*{name}', typename)))
+        return c.typedef(c.struct(elems = elems), f'{self.full_name}_soa')
+
     def gen_function_defs(self):
         src = c.variabledecl('*source', 'char')
         dest = c.variabledecl('*dest', 'char')
@@ -1528,24 +3128,75 @@ class packet:
         pak_src = c.variabledecl('source', self.full_name)
         pak_dest = c.variabledecl('*dest', self.full_name)
         totalsize = c.variabledecl('total_size', 'size_t')
-        if check_instance(self.fields, mc_restbuffer):
-            decargs = (pak_dest, src, totalsize)
+        arena = c.variabledecl('*arena', 'mc_arena')
+        cursor = c.variabledecl('*cursor', 'mc_walk_cursor')
+        growbuf = c.variabledecl('*buf', 'mc_growbuf')
+        if check_instance(self.fields, restbuffer_type):
+            decargs = (pak_dest, src, totalsize, arena)
         else:
-            decargs = (pak_dest, src)
+            decargs = (pak_dest, src, arena)
         s = c.sequence([
             c.statement(c.fdecl(
                 f'walk_{self.full_name}', 'int', (src, max_len)
             )),
+            c.statement(c.fdecl(
+                f'walk_resume_{self.full_name}', 'int', (cursor, src, max_len)
+            )),
             c.statement(c.fdecl(f'size_{self.full_name}', 'size_t', (pak,))),
             c.statement(c.fdecl(
                 f'enc_{self.full_name}', 'char *', (dest, pak_src)
             )),
+            c.statement(c.fdecl(
+                f'enc_bounded_{self.full_name}', 'size_t',
+                (dest, max_len, pak_src)
+            )),
+            c.statement(c.fdecl(
+                f'enc_grow_{self.full_name}', 'char *', (growbuf, pak_src)
+            )),
             c.statement(c.fdecl(f'dec_{self.full_name}', 'char *', decargs)),
+            c.statement(c.fdecl(
+                f'dec_checked_{self.full_name}', 'char *',
+                (pak_dest, src, max_len, arena)
+            )),
         ])
         if self.need_free:
             s.append(c.statement(
                 c.fdecl(f'free_{self.full_name}', 'void', (pak,))
             ))
+        for path in self.peeks:
+            _, _, typename = self.peek_target(path)
+            s.append(c.statement(c.fdecl(
+                f'peek_{self.full_name}_{path.replace("/", "_")}', 'int',
+                (c.variabledecl('*dest', typename), src, max_len)
+            )))
+        for path in self.patches:
+            target, _, typename = self.patch_target(path)
+            value = c.variabledecl('value', typename)
+            if isinstance(target, numeric_type):
+                args = (src, max_len, value)
+            else:
+                args = (src, max_len, c.variabledecl('cap', 'size_t'), value)
+            s.append(c.statement(c.fdecl(
+                f'patch_{self.full_name}_{path.replace("/", "_")}', 'int', args
+            )))
+        if self.hashable:
+            s.append(c.statement(
+                c.fdecl(f'hash_{self.full_name}', 'uint64_t', (pak,))
+            ))
+            s.append(c.statement(c.fdecl(
+                f'eq_{self.full_name}', 'int', (
+                    c.variabledecl('a', self.full_name),
+                    c.variabledecl('b', self.full_name),
+                )
+            )))
+        if self.batchable:
+            s.append(c.statement(c.fdecl(
+                f'dec_batch_{self.full_name}', 'void', (
+                    c.variabledecl('*soa', f'{self.full_name}_soa'),
+                    c.variabledecl('**sources', 'char'),
+                    c.variabledecl('count', 'size_t'),
+                )
+            )))
         return s
 
     def gen_walkfunc(self):
@@ -1557,7 +3208,9 @@ class packet:
             return c.linesequence((c.fdecl(
                 f'walk_{self.full_name}', 'int', (src.decl, max_len.decl)
             ), c.block((
-                c.inlineif(c.lth(max_len, total), c.returnval(-1)),
+                c.inlineif(
+                    c.lth(max_len, total), c.returnval('varnum_overrun')
+                ),
                 c.returnval(total)))
             ))
 
@@ -1566,14 +3219,14 @@ class packet:
         #cfile lacks the capability to group variables declarations
         blk = c.block([c.statement(f'{ret.decl}, {c.assign(size, 0)}')])
         to_free = []
-        fail = c.sequence([c.returnval(-1)])
+        fail = c.sequence([c.returnval(ret)])
         position = 0
         endpos = len(self.fields)
         while(position < endpos):
             fail = copy.deepcopy(fail)
             position, total = group_numerics_walk(self.fields, position)
             if total:
-                blk.append(c.ifcond(c.lth(max_len, total), (fail,)))
+                blk.append(walk_short_line(ret, max_len, total, fail))
                 if position < endpos:
                     blk.append(c.statement(c.addeq(size, total)))
                     blk.append(c.statement(c.addeq(src, total)))
@@ -1586,22 +3239,9 @@ class packet:
                 field = self.fields[position]
                 position += 1
                 if field.switched:
-                    blk.append(c.statement(field.internal.decl))
-                    if isinstance(field, numeric_type):
-                        blk.append(c.ifcond(c.lth(max_len, field.size), (fail,)))
-                        blk.append(c.statement(c.addeq(size, field.size)))
-                        blk.append(c.statement(c.subeq(max_len, field.size)))
-                    else:
-                        blk.append(field.walk_line(ret, src, max_len, fail))
-                        blk.append(c.statement(c.addeq(size, ret)))
-                        blk.append(c.statement(c.subeq(max_len, ret)))
-                    if isinstance(field, memory_type):
-                        blk.append(field.walkdec_line(src, field, src, fail))
-                        fail = copy.deepcopy(fail)
-                        fail.insert(0, field.free_line(field))
-                        to_free.append(field)
-                    else:
-                        blk.append(field.dec_line(src, field, src))
+                    fail = walk_switched_field(
+                        blk, field, ret, src, max_len, size, fail, to_free
+                    )
                 elif isinstance(field, custom_type):
                     blk.append(field.walk_line(ret, src, max_len, size, fail))
                     if position >= endpos:
@@ -1614,21 +3254,115 @@ class packet:
                         blk.append(c.statement(c.addeq(size, ret)))
                         blk.append(c.statement(c.addeq(src, ret)))
                         blk.append(c.statement(c.subeq(max_len, ret)))
-        for field in to_free:
-            blk.append(field.free_line(field))
+        if to_free:
+            # Free the switched locals ahead of the final return
+            final = blk.pop() if isinstance(blk[-1], c.returnval) else \
+                c.returnval(size)
+            for field in to_free:
+                blk.append(field.free_line(field))
+            blk.append(final)
 
         return c.linesequence((
             c.fdecl(f'walk_{self.full_name}', 'int', (src.decl, max_len.decl)),
             blk
         ))
 
+    # Same walk as gen_walkfunc, but each field up to the first one a switch
+    # depends on is guarded by the cursor step and checkpoints it on success.
+    # Switched values live in locals, so past that point it always re-walks
+    def gen_resumefunc(self):
+        max_len = c.variable('max_len', 'size_t')
+        src = c.variable('source', 'char *')
+        cursor = c.variable('cursor', 'mc_walk_cursor *')
+        decl = c.fdecl(
+            f'walk_resume_{self.full_name}', 'int',
+            (cursor.decl, src.decl, max_len.decl)
+        )
+
+        if not self.complex:
+            position, total = group_numerics_walk(self.fields, 0)
+            return c.linesequence((decl, c.block((
+                c.ifcond(c.lth(max_len, total), (
+                    c.statement(c.assign('cursor->need', total)),
+                    c.returnval('varnum_overrun'),
+                )),
+                c.returnval(total),
+            ))))
+
+        ret = c.variable('ret', 'int')
+        size = c.variable('size', 'int')
+        blk = c.block([c.statement(
+            f'{ret.decl}, {c.assign(size, "cursor->offset")}'
+        )])
+        blk.append(c.inlineif(
+            c.lth(max_len, 'cursor->need'), c.returnval('varnum_overrun')
+        ))
+        blk.append(c.statement(c.addeq(src, size)))
+        blk.append(c.statement(c.subeq(max_len, size)))
+        to_free = []
+        fail = c.sequence([c.returnval(ret)])
+        fail.resume_size = size
+        resumable = True
+        step = 0
+        position = 0
+        endpos = len(self.fields)
+        while(position < endpos):
+            field = self.fields[position]
+            if resumable and check_switched((field,)):
+                resumable = False
+            app = c.ifcond(c.ltheq('cursor->step', step)) if resumable else blk
+            position, total = group_numerics_walk(self.fields, position)
+            if total:
+                app.append(walk_short_line(ret, max_len, total, fail))
+                app.append(c.statement(c.addeq(size, total)))
+                app.append(c.statement(c.addeq(src, total)))
+                app.append(c.statement(c.subeq(max_len, total)))
+            else:
+                position += 1
+                if field.switched:
+                    fail = walk_switched_field(
+                        app, field, ret, src, max_len, size, fail, to_free
+                    )
+                elif isinstance(field, custom_type):
+                    app.append(field.walk_line(ret, src, max_len, size, fail))
+                else:
+                    app.append(field.walk_line(ret, src, max_len, fail))
+                    app.append(c.statement(c.addeq(size, ret)))
+                    app.append(c.statement(c.addeq(src, ret)))
+                    app.append(c.statement(c.subeq(max_len, ret)))
+            if resumable:
+                step += 1
+                need = sum_sizes(self.fields[position:])[0]
+                app.append(c.statement(c.assign('cursor->offset', size)))
+                app.append(c.statement(c.assign('cursor->step', step)))
+                app.append(c.statement(c.assign(
+                    'cursor->need', c.addop(size, need) if need else size
+                )))
+                blk.append(app)
+        for field in to_free:
+            blk.append(field.free_line(field))
+        blk.append(c.returnval(size))
+
+        return c.linesequence((decl, blk))
+
+    # Packet size bounds for preallocating buffers, the exact size is only
+    # defined for fixed size packets and the max only if there is one
+    def gen_size_defines(self):
+        prefix = self.full_name.upper()
+        seq = c.sequence()
+        seq.append(c.define(f'{prefix}_MIN_SIZE {self.min_size}'))
+        if self.max_size is not None:
+            seq.append(c.define(f'{prefix}_MAX_SIZE {self.max_size}'))
+        if self.min_size == self.max_size:
+            seq.append(c.define(f'{prefix}_SIZE {self.min_size}'))
+        return seq
+
     def gen_sizefunc(self):
         pak = c.variable('packet', self.full_name)
-        if not self.complex:
-            position, total = group_numerics_size(self.fields, 0)
+        if self.min_size == self.max_size:
             return c.linesequence((
                 c.fdecl(f'size_{self.full_name}', 'size_t', (pak.decl,)),
-                c.block((c.returnval(total),))
+                c.block((c.returnval(f'{self.full_name.upper()}_SIZE'),))
             ))
         blk = c.block()
         position = 0
@@ -1657,19 +3391,20 @@ class packet:
         dest = c.variable('packet', self.full_name)
         destptr = c.variable('*packet', self.full_name)
         src = c.variable('source', 'char *')
+        arena = c.variable('*arena', 'mc_arena')
         blk = c.block()
-        if check_instance(self.fields, mc_restbuffer):
+        if check_instance(self.fields, restbuffer_type):
             totalsize = c.variable('total_size', 'size_t')
             endptr = c.variable('endptr', 'char *')
             blk.append(c.statement(c.assign(
                 endptr.decl, c.addop(src, totalsize)
             )))
-            args = (destptr.decl, src.decl, totalsize.decl)
+            args = (destptr.decl, src.decl, totalsize.decl, arena.decl)
         else:
-            args = (destptr.decl, src.decl)
+            args = (destptr.decl, src.decl, arena.decl)
         for field in self.fields:
             v = c.variable(f'{dest}->{field}', field.typename)
-            if isinstance(field, mc_restbuffer):
+            if isinstance(field, restbuffer_type):
                 blk.append(field.dec_line(src, v, src, endptr))
             else:
                 blk.append(field.dec_line(src, v, src))
@@ -1678,6 +3413,49 @@ class packet:
             f'dec_{self.full_name}', 'char *', args
         ), blk))
 
+    # Single pass bounds checked decode, on failure anything already allocated
+    # is released through the free function, which is safe on zeroed packets.
+    # Arena memory is left for the arena's owner to reset
+    def gen_checked_decfunc(self):
+        dest = c.variable('packet', self.full_name)
+        destptr = c.variable('*packet', self.full_name)
+        src = c.variable('source', 'char *')
+        max_len = c.variable('max_len', 'size_t')
+        arena = c.variable('*arena', 'mc_arena')
+        end = c.variable('endptr', 'char *')
+        blk = c.block()
+        blk.append(c.statement(c.assign(end.decl, c.addop(src, max_len))))
+        fail = c.sequence([c.returnval('NULL')])
+        if self.need_free:
+            blk.append(c.statement(c.fcall(
+                'memset', 'void *', (dest, 0, f'sizeof(*{dest})')
+            )))
+            fail.insert(0, c.inlineif('!arena', c.statement(c.fcall(
+                f'free_{self.full_name}', 'void', (f'*{dest}',)
+            ))))
+        position = 0
+        endpos = len(self.fields)
+        while(position < endpos):
+            start = position
+            position, total = group_numerics_size(self.fields, position)
+            if total:
+                blk.append(c.ifcond(c.lth(c.subop(end, src), total), (
+                    copy.deepcopy(fail),
+                )))
+            for field in self.fields[start:position]:
+                v = c.variable(f'{dest}->{field}', field.typename)
+                blk.append(field.dec_line(src, v, src))
+            if position < endpos:
+                field = self.fields[position]
+                position += 1
+                v = c.variable(f'{dest}->{field}', field.typename)
+                blk.append(field.checked_dec_line(v, src, end, fail))
+        blk.append(c.returnval(src))
+        return c.linesequence((c.fdecl(
+            f'dec_checked_{self.full_name}', 'char *',
+            (destptr.decl, src.decl, max_len.decl, arena.decl)
+        ), blk))
+
     def gen_encfunc(self):
         dest = c.variable('dest', 'char *')
         src = c.variable('source', self.full_name)
@@ -1690,10 +3468,290 @@ class packet:
             f'enc_{self.full_name}', 'char *', (dest.decl, src.decl)
         ), blk))
 
+    # Encodes with bounds checks instead of needing a size_ call first. Like
+    # snprintf it returns the packet size either way, if that's more than
+    # max_len nothing useful was written and size_ is only called then
+    def gen_bounded_encfunc(self):
+        dest = c.variable('dest', 'char *')
+        max_len = c.variable('max_len', 'size_t')
+        src = c.variable('source', self.full_name)
+        decl = c.fdecl(
+            f'enc_bounded_{self.full_name}', 'size_t',
+            (dest.decl, max_len.decl, src.decl)
+        )
+        prefix = self.full_name.upper()
+        encode = c.fcall(f'enc_{self.full_name}', 'char *', (dest, src))
+        if self.min_size == self.max_size:
+            return c.linesequence((decl, c.block((
+                c.inlineif(
+                    c.gtheq(max_len, f'{prefix}_SIZE'),
+                    c.statement(encode)
+                ),
+                c.returnval(f'{prefix}_SIZE'),
+            ))))
+        blk = c.block()
+        if self.max_size is not None:
+            blk.append(c.inlineif(
+                c.gtheq(max_len, f'{prefix}_MAX_SIZE'),
+                c.returnval(c.subop(encode, dest))
+            ))
+        start = c.variable('start', 'char *')
+        end = c.variable('end', 'char *')
+        endval = c.addop(dest, max_len)
+        blk.append(c.statement(
+            f'{c.assign(start.decl, dest)}, {c.assign("*end", endval)}'
+        ))
+        fail = c.sequence([c.returnval(
+            c.fcall(f'size_{self.full_name}', 'size_t', (src,))
+        )])
+        bounded_enc_fields(blk, self.fields, dest, dest, src, end, fail)
+        blk.append(c.returnval(c.subop(dest, start)))
+        return c.linesequence((decl, blk))
+
+    def gen_grow_encfunc(self):
+        buf = c.variable('buf', 'mc_growbuf *')
+        src = c.variable('source', self.full_name)
+        size = c.variable('size', 'size_t')
+        dest = c.addop('buf->base', 'buf->len')
+        avail = c.subop('buf->cap', 'buf->len')
+        return c.linesequence((c.fdecl(
+            f'enc_grow_{self.full_name}', 'char *', (buf.decl, src.decl)
+        ), c.block((
+            c.inlineif(c.fcall('mc_growbuf_reserve', 'int', (
+                buf, f'{self.full_name.upper()}_MIN_SIZE'
+            )), c.returnval('NULL')),
+            c.statement(c.assign(size.decl, c.fcall(
+                f'enc_bounded_{self.full_name}', 'size_t', (dest, avail, src)
+            ))),
+            c.ifcond(c.gth(size, avail), (
+                c.inlineif(c.fcall(
+                    'mc_growbuf_reserve', 'int', (buf, size)
+                ), c.returnval('NULL')),
+                c.statement(c.fcall(
+                    f'enc_{self.full_name}', 'char *', (dest, src)
+                )),
+            )),
+            c.statement(c.addeq('buf->len', size)),
+            c.returnval(dest),
+        ))))
+
+    # The top level field a peek_ path names, the bitfield member if it names
+    # one and the type peek_ decodes into. Strings are decoded as views, so
+    # peeking never allocates
+    def peek_target(self, path):
+        tokens = path.split('/')
+        for field in self.fields:
+            if field.name == tokens[0]:
+                break
+        else:
+            raise KeyError(f'{self.full_name} has no field {tokens[0]}')
+        member = None
+        if isinstance(field, mc_bitfield) and len(tokens) == 2:
+            for member in field.fields:
+                if member.name == tokens[1]:
+                    break
+            else:
+                raise KeyError(f'{self.full_name} has no field {path}')
+            return field, member, member.typename
+        if len(tokens) > 1:
+            raise ValueError(
+                f'Can only peek top level fields and bitfield members, not '
+                f'{self.full_name}/{path}'
+            )
+        if isinstance(field, (mc_string, mc_string_view)):
+            return field, member, mc_string_view.typename
+        if isinstance(field, mc_bitfield) or isinstance(field, void_type) or \
+                not isinstance(field, (numeric_type, varnum_type)):
+            raise ValueError(
+                f'Can only peek numerics, varints and strings, not '
+                f'{self.full_name}/{path}'
+            )
+        return field, member, field.typename
+
+    # Same as walk_ up to target, leaving source pointing at it and size the
+    # offset it's at. Returns the fail sequence from there and the switched
+    # locals that need freeing on success
+    def walk_prefix(self, blk, target, ret, src, max_len, size):
+        to_free = []
+        fail = c.sequence([c.returnval(ret)])
+        for endpos, field in enumerate(self.fields):
+            if field is target:
+                break
+        position = 0
+        while(position < endpos):
+            fail = copy.deepcopy(fail)
+            position, total = group_numerics_walk(self.fields[:endpos], position)
+            if total:
+                blk.append(walk_short_line(ret, max_len, total, fail))
+                blk.append(c.statement(c.addeq(size, total)))
+                blk.append(c.statement(c.addeq(src, total)))
+                blk.append(c.statement(c.subeq(max_len, total)))
+            if position < endpos:
+                field = self.fields[position]
+                position += 1
+                if field.switched:
+                    fail = walk_switched_field(
+                        blk, field, ret, src, max_len, size, fail, to_free
+                    )
+                elif isinstance(field, custom_type):
+                    blk.append(field.walk_line(ret, src, max_len, size, fail))
+                else:
+                    blk.append(field.walk_line(ret, src, max_len, fail))
+                    blk.append(c.statement(c.addeq(size, ret)))
+                    blk.append(c.statement(c.addeq(src, ret)))
+                    blk.append(c.statement(c.subeq(max_len, ret)))
+        return copy.deepcopy(fail), to_free
+
+    # Same as walk_ up to the peeked field, which is decoded into dest instead
+    # of walked. Returns the size up to the end of that field or walk_'s error
+    def gen_peekfunc(self, path):
+        target, member, typename = self.peek_target(path)
+        max_len = c.variable('max_len', 'size_t')
+        src = c.variable('source', 'char *')
+        dest = c.variable('*dest', typename)
+        ret = c.variable('ret', 'int')
+        size = c.variable('size', 'int')
+        blk = c.block([c.statement(f'{ret.decl}, {c.assign(size, 0)}')])
+        fail, to_free = self.walk_prefix(blk, target, ret, src, max_len, size)
+        if isinstance(target, numeric_type):
+            blk.append(walk_short_line(ret, max_len, target.size, fail))
+            if member is None:
+                blk.append(target.dec_line(src, dest, src))
+            else:
+                storage = target.storage
+                blk.append(c.statement(storage.internal.decl))
+                blk.append(storage.dec_line(src, storage, src))
+                for field, (mask, shift) in zip(
+                        target.fields, target.mask_shift):
+                    if field is member:
+                        break
+                blk.append(c.statement(c.assign(
+                    dest, f'({storage}>>{shift})&{mask}'
+                )))
+            final = c.returnval(c.addop(size, target.size))
+        else:
+            blk.append(target.walk_line(ret, src, max_len, fail))
+            if isinstance(target, mc_string):
+                target = mc_string_view(target.name, target.parent)
+            blk.append(target.dec_line(src, dest, src))
+            final = c.returnval(c.addop(size, ret))
+        for field in to_free:
+            blk.append(field.free_line(field))
+        blk.append(final)
+        return c.linesequence((c.fdecl(
+            f'peek_{self.full_name}_{path.replace("/", "_")}', 'int',
+            (dest.decl, src.decl, max_len.decl)
+        ), blk))
+
+    # Strings aren't patched and neither is anything the layout of the rest of
+    # the packet depends on
+    def patch_target(self, path):
+        target, member, typename = self.peek_target(path)
+        field = target if member is None else member
+        if isinstance(target, (mc_string, mc_string_view)):
+            raise ValueError(
+                f'Can only patch numerics and varints, not '
+                f'{self.full_name}/{path}'
+            )
+        if field.switched or field.counts:
+            raise ValueError(
+                f'Can\'t patch {self.full_name}/{path}, other fields depend '
+                f'on it'
+            )
+        return target, member, typename
+
+    # Finds the field the same way as peek_ and overwrites it in place. max_len
+    # is how much data there is at source, varints that change size move all
+    # of it along and cap is how much there's room for. Returns the new length
+    # of the data or walk_'s errors, varnum_overrun if cap is too small
+    def gen_patchfunc(self, path):
+        target, member, typename = self.patch_target(path)
+        max_len = c.variable('max_len', 'size_t')
+        cap = c.variable('cap', 'size_t')
+        src = c.variable('source', 'char *')
+        value = c.variable('value', typename)
+        ret = c.variable('ret', 'int')
+        size = c.variable('size', 'int')
+        blk = c.block([c.statement(f'{ret.decl}, {c.assign(size, 0)}')])
+        fail, to_free = self.walk_prefix(blk, target, ret, src, max_len, size)
+        if isinstance(target, numeric_type):
+            args = (src.decl, max_len.decl, value.decl)
+            blk.append(walk_short_line(ret, max_len, target.size, fail))
+            if member is None:
+                blk.append(target.enc_line(src, src, value))
+            else:
+                storage = target.storage
+                for field, (mask, shift) in zip(
+                        target.fields, target.mask_shift):
+                    if field is member:
+                        break
+                blk.append(c.statement(storage.internal.decl))
+                blk.append(storage.dec_line(src, storage, src))
+                blk.append(c.statement(c.assign(storage, (
+                    f'({storage}&~(({storage.typename}){mask}<<{shift}))|'
+                    f'((({storage.typename}){value}&{mask})<<{shift})'
+                ))))
+                blk.append(c.statement(c.subeq(src, target.size)))
+                blk.append(storage.enc_line(src, src, storage))
+        else:
+            args = (src.decl, max_len.decl, cap.decl, value.decl)
+            newlen = c.variable('new_len', 'int')
+            blk.append(target.walk_line(ret, src, max_len, fail))
+            blk.append(c.statement(c.assign(newlen.decl, c.fcall(
+                f'size_{target.postfix}', 'size_t', (value,)
+            ))))
+            blk.append(c.ifcond(f'{newlen} != {ret}', (
+                c.statement(c.assign(ret, c.fcall('mc_splice', 'int',
+                    (src, max_len, c.subop(cap, size), ret, newlen)
+                ))),
+                c.ifcond(c.lth(ret, 0), (copy.deepcopy(fail),)),
+                c.statement(c.assign(max_len, ret)),
+            )))
+            blk.append(target.enc_line(src, src, value))
+        for field in to_free:
+            blk.append(field.free_line(field))
+        blk.append(c.returnval(c.addop(size, max_len)))
+        return c.linesequence((c.fdecl(
+            f'patch_{self.full_name}_{path.replace("/", "_")}', 'int', args
+        ), blk))
+
+    # Each packet is decoded into a local with the same lines as dec_, then
+    # scattered into the arrays. The local never escapes, so the compiler is
+    # free to keep it in registers. It starts zeroed so switch cases that
+    # aren't taken come out as zeros rather than whatever was on the stack
+    def gen_batchfunc(self):
+        soa = c.variable('*soa', f'{self.full_name}_soa')
+        sources = c.variable('**sources', 'char')
+        countvar = c.variable('count', 'size_t')
+        loopvar = c.variable('i', 'size_t')
+        decoded = c.variable('decoded', self.full_name)
+        dest = c.variable('packet', f'{self.full_name} *')
+        src = c.variable('source', 'char *')
+        body = [
+            c.statement(c.assign(decoded.decl, '{0}')),
+            c.statement(c.assign(dest.decl, f'&{decoded}')),
+            c.statement(c.assign(src.decl, f'sources[{loopvar}]')),
+        ]
+        for field in self.fields:
+            v = c.variable(f'{dest}->{field}', field.typename)
+            body.append(field.dec_line(src, v, src))
+        for path, _ in self.soa_fields():
+            body.append(c.statement(c.assign(
+                f'soa->{path.replace(".", "_")}[{loopvar}]', f'{dest}->{path}'
+            )))
+        return c.linesequence((c.fdecl(
+            f'dec_batch_{self.full_name}', 'void',
+            (soa.decl, sources.decl, countvar.decl)
+        ), c.block((
+            c.forloop(c.assign(loopvar.decl, 0), c.lth(loopvar, countvar),
+                c.incop(loopvar), body
+            ),
+        ))))
+
     def gen_freefunc(self):
         pak = c.variable('packet', self.full_name)
         blk = c.block()
-        for field in self.fields:
+        for field in reversed(self.fields):
             if isinstance(field, memory_type) or (
                 hasattr(field, 'children') and
                 check_instance(field.children, memory_type)
@@ -1704,25 +3762,283 @@ class packet:
             c.fdecl(f'free_{self.full_name}', 'void', (pak.decl,)), blk
         ))
 
-    def gen_generic_decode(self):
-        seq = c.sequence()
-        destvar = c.variable('dest', 'void *')
-        srcvar = c.variable('src', 'char *')
-        lenvar = c.variable('len', 'size_t')
-        if check_instance(self.fields, mc_restbuffer):
-            args = (destvar, srcvar, lenvar)
+    # Packets that are eq_ always hash_ the same, so hash_ only looks at what
+    # eq_ compares. For mc_frame_cache, see datautils.h
+    def gen_hashfuncs(self):
+        pak = c.variable('packet', self.full_name)
+        hash = c.variable('hash', 'uint64_t')
+        blk = c.block([c.statement(c.assign(hash.decl, 'MC_HASH_INIT'))])
+        for field in self.fields:
+            v = c.variable(f'{pak}.{field}', field.typename)
+            blk.append(field.hash_line(hash, v))
+        blk.append(c.returnval(hash))
+        hashfunc = c.linesequence((c.fdecl(
+            f'hash_{self.full_name}', 'uint64_t', (pak.decl,)
+        ), blk))
+
+        a = c.variable('a', self.full_name)
+        b = c.variable('b', self.full_name)
+        blk = c.block()
+        for field in self.fields:
+            blk.append(field.eq_line(
+                c.variable(f'{a}.{field}', field.typename),
+                c.variable(f'{b}.{field}', field.typename)
+            ))
+        blk.append(c.returnval(1))
+        eqfunc = c.linesequence((c.fdecl(
+            f'eq_{self.full_name}', 'int', (a.decl, b.decl)
+        ), blk))
+        return c.sequence((hashfunc, c.blank(), eqfunc))
+
+    # Wraps a generated function in one counting its calls into the packet's
+    # protocol_counters entry, the original is kept as a static inline body
+    def gen_counted(self, func, op):
+        decl = func[0]
+        typename = decl.typename
+        call = c.fcall(f'{decl.name}_uncounted', typename, [
+            a.name.lstrip('*') for a in decl.args
+        ])
+        wrapper = c.fdecl(decl.name, typename, decl.args)
+        decl.name = call.name
+        decl.typename = f'static inline {typename}'
+        table = self.full_name[:-len(self.name)] + 'counters'
+        ret = c.variable('ret', typename)
+        blk = c.block([
+            c.statement(c.assign(
+                c.variabledecl('*counters', 'mc_op_counters'),
+                f'&{table}[{self.full_name}_id].{op}'
+            )),
+            c.statement(c.assign(
+                c.variabledecl('start', 'uint64_t'), 'mc_instrument_now()'
+            )),
+        ])
+        if typename == 'void':
+            blk.append(c.statement(call))
+            bytes = 0
         else:
-            args = (destvar, srcvar)
-        seq.append(c.inlineif(
-            c.noteq(c.fcall(f'walk_{self.full_name}', '', (srcvar, lenvar)), lenvar),
-            c.returnval('NULL')
+            blk.append(c.statement(c.assign(ret.decl, call)))
+            bytes = {
+                'walk': ret,
+                'dec': f'{ret} ? {ret} - source : -1',
+                'enc': f'{ret} - dest',
+            }[op]
+        blk.append(c.statement(c.fcall(
+            'mc_count', 'void', ('counters', 'start', bytes)
+        )))
+        if typename != 'void':
+            blk.append(c.returnval(ret))
+        return c.sequence((
+            func, c.blank(), c.linesequence((wrapper, blk))
         ))
-        seq.append(c.inlineif(c.wrap(c.assign(destvar, c.fcall(
-            'malloc', 'void *', (f'sizeof({self.full_name})',)
-        )), True), c.returnval('NULL')))
-        seq.append(c.statement(c.fcall(f'dec_{self.full_name}', '', args)))
+
+    # Fills a packet with random contents for bench_[version].c, dest names
+    # follow the dec_ functions so switches and arrays find their values
+    def gen_randfunc(self):
+        dest = c.variable('packet', self.full_name)
+        blk = c.block()
+        blk.append(c.statement(c.assign(
+            c.variabledecl('*packet', self.full_name), 'dest'
+        )))
+        for field in self.fields:
+            v = c.variable(f'{dest}->{field}', field.typename)
+            blk.append(field.rand_line(v))
+        return c.linesequence((c.fdecl(
+            f'rand_{self.full_name}', 'static void',
+            (c.variabledecl('*dest', 'void'),)
+        ), blk))
+
+    # Conversions to and from a dict for py_[version].c, see pyproto.h
+    def gen_pyfuncs(self):
+        pak = c.variable('packet', self.full_name)
+        scratch = f'*py[{py_depth(self.fields)}]'
+        fields = c.sequence()
+        for field in self.fields:
+            v = c.variable(f'{pak}->{field}', field.typename)
+            fields.append(field.topy_line('dict', field.name, v, 0))
+        decls = [f'{scratch}, ' if 'py[' in str(fields) else '', '*dict']
+        topy = c.linesequence((c.fdecl(
+            f'topy_{self.full_name}', 'static PyObject *',
+            (c.variabledecl('*source', 'void'),)
+        ), c.block([
+            c.statement(c.assign(
+                c.variabledecl('*packet', self.full_name), 'source'
+            )),
+            c.statement(f'PyObject {"".join(decls)} = PyDict_New()'),
+            c.inlineif('!dict', c.returnval('NULL')),
+            fields,
+            c.returnval('dict'),
+            c.line('fail:'),
+            c.statement('Py_DECREF(dict)'),
+            c.returnval('NULL'),
+        ])))
+
+        fields = c.sequence()
+        for field in self.fields:
+            v = c.variable(f'{pak}->{field}', field.typename)
+            fields.append(field.frompy_line('dict', field.name, v, 0))
+        blk = c.block([c.statement(c.assign(
+            c.variabledecl('*packet', self.full_name), 'dest'
+        ))])
+        if 'py[' in str(fields):
+            blk.append(c.statement(f'PyObject {scratch}'))
+        if '&raw)' in str(fields):
+            blk.append(c.statement(c.variabledecl('raw', 'mc_buffer')))
+        blk.extend((
+            fields,
+            c.returnval(0),
+            c.line('fail:'),
+            c.returnval(-1),
+        ))
+        frompy = c.linesequence((c.fdecl(
+            f'frompy_{self.full_name}', 'static int', (
+                c.variabledecl('*dict', 'PyObject'),
+                c.variabledecl('*dest', 'void'),
+            )
+        ), blk))
+        return c.sequence((topy, c.blank(), frompy))
+
+    # NumPy layout for codec_[version].py, None unless every field has one
+    def gen_pylayout(self):
+        fields = np_fields(self.fields)
+        if not fields:
+            return None
+        return pyf.literal(f'layout_{self.full_name} = Layout([', '])', fields)
+
+    # Class, dec_, size_ and enc_ for codec_[version].py, see datautils.py
+    def gen_pycodec(self):
+        name = self.full_name
+        slots = [
+            py_attr(f.name) for f in self.fields
+            if not isinstance(f, void_type)
+        ]
+        cls = pyf.classdef(name, ('Packet',), [
+            f'__slots__ = {tuple(slots)!r}'
+        ])
+        if slots:
+            cls.append(pyf.blank())
+            cls.append(pyf.fdef('__init__', ['self'] + [
+                f'{s}=None' for s in slots
+            ], [f'self.{s} = {s}' for s in slots]))
+
+        scope = pyscope(self)
+        dec = pyf.fdef(f'dec_{name}', ('view', 'pos'), [f'p = new({name})'])
+        py_dec_fields(dec, self.fields, self, scope)
+        dec.append('return p, pos')
+
+        scope = pyscope(self)
+        body = pyf.sequence()
+        fixed = py_size_fields(body, self.fields, self, 'size', scope)
+        if len(body):
+            size = pyf.fdef(f'size_{name}', ('p',), [f'size = {fixed}'])
+            size.append(body)
+            size.append('return size')
+        else:
+            size = pyf.fdef(f'size_{name}', ('p',), [f'return {fixed}'])
+
+        scope = pyscope(self)
+        enc = pyf.fdef(f'enc_{name}', ('p', 'buf', 'pos'))
+        py_enc_fields(enc, self.fields, self, scope)
+        enc.append('return pos')
+        return pyf.sequence((
+            cls, pyf.blank(2), dec, pyf.blank(2), size, pyf.blank(2), enc
+        ))
+
+    # Type-erased wrappers matching the mc_packet_funcs signatures, size/enc/
+    # free take their packet by value so they can't go in the tables directly
+    def gen_generic_funcs(self):
+        pak = c.variable('packet', 'void *')
+        deref = f'*({self.full_name} *) {pak}'
+        dest = c.variable('dest', 'char *')
+        destptr = c.variable('dest', 'void *')
+        src = c.variable('source', 'char *')
+        lenvar = c.variable('len', 'size_t')
+        arena = c.variable('arena', 'mc_arena *')
+        if check_instance(self.fields, restbuffer_type):
+            decargs = (destptr, src, lenvar, arena)
+        else:
+            decargs = (destptr, src, arena)
+        seq = c.sequence()
+        seq.append(c.linesequence((c.fdecl(
+            f'generic_size_{self.full_name}', 'static size_t', (pak.decl,)
+        ), c.block((c.returnval(c.fcall(
+            f'size_{self.full_name}', 'size_t', (deref,)
+        )),)))))
+        seq.append(c.blank())
+        seq.append(c.linesequence((c.fdecl(
+            f'generic_enc_{self.full_name}', 'static char *',
+            (dest.decl, pak.decl)
+        ), c.block((c.returnval(c.fcall(
+            f'enc_{self.full_name}', 'char *', (dest, deref)
+        )),)))))
+        seq.append(c.blank())
+        seq.append(c.linesequence((c.fdecl(
+            f'generic_dec_{self.full_name}', 'static char *',
+            (destptr.decl, src.decl, lenvar.decl, arena.decl)
+        ), c.block((c.returnval(c.fcall(
+            f'dec_{self.full_name}', 'char *', decargs
+        )),)))))
+        seq.append(c.blank())
+        seq.append(c.linesequence((c.fdecl(
+            f'generic_dec_checked_{self.full_name}', 'static char *',
+            (destptr.decl, src.decl, lenvar.decl, arena.decl)
+        ), c.block((c.returnval(c.fcall(
+            f'dec_checked_{self.full_name}', 'char *',
+            (destptr, src, lenvar, arena)
+        )),)))))
+        if self.need_free:
+            seq.append(c.blank())
+            seq.append(c.linesequence((c.fdecl(
+                f'generic_free_{self.full_name}', 'static void', (pak.decl,)
+            ), c.block((c.statement(c.fcall(
+                f'free_{self.full_name}', 'void', (deref,)
+            )),)))))
+        if self.hashable:
+            a = c.variable('a', 'void *')
+            b = c.variable('b', 'void *')
+            seq.append(c.blank())
+            seq.append(c.linesequence((c.fdecl(
+                f'generic_hash_{self.full_name}', 'static uint64_t',
+                (pak.decl,)
+            ), c.block((c.returnval(c.fcall(
+                f'hash_{self.full_name}', 'uint64_t', (deref,)
+            )),)))))
+            seq.append(c.blank())
+            seq.append(c.linesequence((c.fdecl(
+                f'generic_eq_{self.full_name}', 'static int',
+                (a.decl, b.decl)
+            ), c.block((c.returnval(c.fcall(
+                f'eq_{self.full_name}', 'int', (
+                    f'*({self.full_name} *) {a}', f'*({self.full_name} *) {b}'
+                )
+            )),)))))
         return seq
 
+    def gen_table_entry(self):
+        if not self.fields:
+            return c.line(f'[{self.full_name}_id] = {{0}}')
+        prefix = self.full_name.upper()
+        if self.max_size is None:
+            max_size = 'SIZE_MAX'
+        else:
+            max_size = f'{prefix}_MAX_SIZE'
+        entry = c.commablock(elems = [
+            c.line(f'.packet_size = sizeof({self.full_name})'),
+            c.line(f'.min_size = {prefix}_MIN_SIZE'),
+            c.line(f'.max_size = {max_size}'),
+            c.line(f'.walk = walk_{self.full_name}'),
+            c.line(f'.walk_resume = walk_resume_{self.full_name}'),
+            c.line(f'.size = generic_size_{self.full_name}'),
+            c.line(f'.enc = generic_enc_{self.full_name}'),
+            c.line(f'.dec = generic_dec_{self.full_name}'),
+            c.line(f'.dec_checked = generic_dec_checked_{self.full_name}'),
+        ])
+        if self.need_free:
+            entry.append(c.line(f'.free = generic_free_{self.full_name}'))
+        if self.hashable:
+            entry.append(c.line(f'.hash = generic_hash_{self.full_name}'))
+            entry.append(c.line(f'.eq = generic_eq_{self.full_name}'))
+        return c.linesequence((c.line(f'[{self.full_name}_id] ='), entry))
+
 
 
 import minecraft_data
@@ -1739,6 +4055,17 @@ def gen_enums(enums):
                 seq.append(c.blank())
     return seq
 
+def gen_string_switch_tables():
+    seq = c.sequence()
+    for idx, table in enumerate(string_switch_tables):
+        slots = c.commablock(elems = [
+            c.line('NULL' if k is None else c_string(k)) for k in table
+        ])
+        v = c.variabledecl(f'*const strswitch_{idx}[]', 'static const char')
+        seq.append(c.statement(c.assign(v, slots)))
+        seq.append(c.blank())
+    return seq
+
 def gen_stringtables(sub_stringtables):
     seq = c.sequence()
     for state in "handshaking", "status", "login", "play":
@@ -1750,41 +4077,484 @@ def gen_stringtables(sub_stringtables):
                 seq.append(c.blank())
     return seq
 
-def gen_toclient_decode(org_packets):
-    blk = c.block()
-    idvar = c.variable('id', 'int32_t')
+def gen_packet_tables(org_packets):
+    seq = c.sequence()
+    main_table = c.commablock()
+    for state in 'handshaking', 'status', 'login', 'play':
+        for direction in 'toClient', 'toServer':
+            packets = org_packets[state][direction]
+            if not packets:
+                continue
+            direct = direction.lower()
+            table = c.commablock(elems = [p.gen_table_entry() for p in packets])
+            seq.append(c.statement(c.assign(c.variabledecl(
+                f'{state}_{direct}_funcs[{state}_{direct}_max]',
+                'static const mc_packet_funcs'
+            ), table)))
+            seq.append(c.blank())
+            main_table.append(c.line(
+                f'[{state}_id][{direct}_id] = {state}_{direct}_funcs'
+            ))
+    seq.append(c.statement(c.assign(c.variabledecl(
+        '*protocol_funcs[protocol_state_max][protocol_direction_max]',
+        'const mc_packet_funcs'
+    ), main_table)))
+    return seq
+
+def gen_counter_tables(org_packets):
+    seq = c.sequence()
+    main_table = c.commablock()
+    for state in 'handshaking', 'status', 'login', 'play':
+        for direction in 'toClient', 'toServer':
+            if not org_packets[state][direction]:
+                continue
+            direct = direction.lower()
+            seq.append(c.statement(c.variabledecl(
+                f'{state}_{direct}_counters[{state}_{direct}_max]',
+                'static mc_packet_counters'
+            )))
+            main_table.append(c.line(
+                f'[{state}_id][{direct}_id] = {state}_{direct}_counters'
+            ))
+    seq.append(c.statement(c.assign(c.variabledecl(
+        '*protocol_counters[protocol_state_max][protocol_direction_max]',
+        'mc_packet_counters'
+    ), main_table)))
+    return seq
+
+def gen_generic_dispatch():
     statevar = c.variable('state', 'int')
-    destvar = c.variable('dest', 'void *')
+    dirvar = c.variable('direction', 'int')
+    idvar = c.variable('id', 'int32_t')
     srcvar = c.variable('src', 'char *')
     lenvar = c.variable('len', 'size_t')
-    blk.append(c.statement(destvar.decl))
-    statesw = c.switch(statevar)
-    blk.append(statesw)
-    for state in 'status', 'login', 'play':
-        statecase = c.case(f'{state}_id')
-        statesw.append(statecase)
-        idsw = c.switch('id')
-        statecase.append(idsw)
-        for packet in org_packets[state]['toClient']:
-            idsw.append(c.case(
-                f'{packet.full_name}_id', packet.gen_generic_decode()
+    arenavar = c.variable('arena', 'mc_arena *')
+    destvar = c.variable('dest', 'void *')
+    endvar = c.variable('end', 'char *')
+    encdest = c.variable('dest', 'char *')
+    pakvar = c.variable('packet', 'void *')
+    funcs = c.variable('funcs', 'const mc_packet_funcs *')
+    lookup = c.fcall('protocol_lookup', 'const mc_packet_funcs *', (
+        statevar, dirvar, idvar
+    ))
+    getfuncs = c.statement(c.assign(funcs.decl, lookup))
+    seq = c.sequence()
+
+    seq.append(c.linesequence((c.fdecl(
+        'protocol_lookup', 'const mc_packet_funcs *',
+        (statevar.decl, dirvar.decl, idvar.decl)
+    ), c.block((
+        c.inlineif(f'{statevar} < 0 || {statevar} >= protocol_state_max',
+            c.returnval('NULL')),
+        c.inlineif(f'{dirvar} < 0 || {dirvar} >= protocol_direction_max',
+            c.returnval('NULL')),
+        c.inlineif(
+            f'{idvar} < 0 || {idvar} >= protocol_max_ids[{statevar}][{dirvar}]',
+            c.returnval('NULL')
+        ),
+        c.returnval(f'&protocol_funcs[{statevar}][{dirvar}][{idvar}]'),
+    )))))
+    seq.append(c.blank())
+
+    seq.append(c.linesequence((c.fdecl(
+        'generic_decode', 'void *', (
+            statevar.decl, dirvar.decl, idvar.decl, srcvar.decl, lenvar.decl,
+            arenavar.decl
+        )
+    ), c.block((
+        getfuncs,
+        c.statement(destvar.decl),
+        c.statement(endvar.decl),
+        c.inlineif(c.wrap(funcs, True), c.returnval('NULL')),
+        c.linecomment('Fieldless packets have no struct, but NULL still has '
+            'to mean failure'),
+        c.inlineif(c.wrap(f'{funcs}->walk', True),
+            c.returnval(f'{lenvar} ? NULL : mc_alloc({arenavar}, 1)')),
+        c.inlineif(c.wrap(c.assign(destvar, c.fcall(
+            'mc_alloc', 'void *', (arenavar, f'{funcs}->packet_size')
+        )), True), c.returnval('NULL')),
+        c.ifcond(c.wrap(c.assign(endvar, c.fcall(
+            f'{funcs}->dec_checked', 'char *',
+            (destvar, srcvar, lenvar, arenavar)
+        )), True), (
+            c.inlineif(c.wrap(arenavar, True),
+                c.statement(c.fcall('free', 'void', (destvar,)))),
+            c.returnval('NULL'),
+        )),
+        c.ifcond(c.noteq(endvar, c.addop(srcvar, lenvar)), (
+            c.ifcond(c.wrap(arenavar, True), (
+                c.inlineif(f'{funcs}->free', c.statement(c.fcall(
+                    f'{funcs}->free', 'void', (destvar,)
+                ))),
+                c.statement(c.fcall('free', 'void', (destvar,))),
+            )),
+            c.returnval('NULL'),
+        )),
+        c.returnval(destvar),
+    )))))
+    seq.append(c.blank())
+
+    seq.append(c.linesequence((c.fdecl(
+        'generic_size', 'size_t',
+        (statevar.decl, dirvar.decl, idvar.decl, pakvar.decl)
+    ), c.block((
+        getfuncs,
+        c.inlineif(c.wrap(funcs, True), c.returnval(0)),
+        c.linecomment('Fixed size packets, including fieldless ones'),
+        c.inlineif(f'{funcs}->min_size == {funcs}->max_size',
+            c.returnval(f'{funcs}->min_size')),
+        c.returnval(c.fcall(f'{funcs}->size', 'size_t', (pakvar,))),
+    )))))
+    seq.append(c.blank())
+
+    seq.append(c.linesequence((c.fdecl(
+        'generic_encode', 'char *',
+        (statevar.decl, dirvar.decl, idvar.decl, encdest.decl, pakvar.decl)
+    ), c.block((
+        getfuncs,
+        c.inlineif(c.wrap(funcs, True), c.returnval('NULL')),
+        c.inlineif(c.wrap(f'{funcs}->enc', True), c.returnval(encdest)),
+        c.returnval(c.fcall(f'{funcs}->enc', 'char *', (encdest, pakvar))),
+    )))))
+    seq.append(c.blank())
+
+    seq.append(c.linesequence((c.fdecl(
+        'generic_free', 'void',
+        (statevar.decl, dirvar.decl, idvar.decl, pakvar.decl)
+    ), c.block((
+        getfuncs,
+        c.inlineif(f'{funcs} && {funcs}->free',
+            c.statement(c.fcall(f'{funcs}->free', 'void', (pakvar,)))),
+        c.statement(c.fcall('free', 'void', (pakvar,))),
+    )))))
+
+    cachevar = c.variable('cache', 'mc_frame_cache *')
+    seq.append(c.blank())
+    seq.append(c.linesequence((c.fdecl(
+        'generic_encode_cached', 'mc_cached_frame *',
+        (cachevar.decl, statevar.decl, dirvar.decl, idvar.decl, pakvar.decl)
+    ), c.block((
+        getfuncs,
+        c.inlineif(c.wrap(funcs, True), c.returnval('NULL')),
+        c.returnval(c.fcall('mc_frame_cache_get', 'mc_cached_frame *', (
+            cachevar, funcs, idvar, pakvar
+        ))),
+    )))))
+
+    for direct in 'toclient', 'toserver':
+        seq.append(c.blank())
+        seq.append(c.linesequence((c.fdecl(
+            f'generic_{direct}_decode', 'void *',
+            (statevar.decl, idvar.decl, srcvar.decl, lenvar.decl, arenavar.decl)
+        ), c.block((c.returnval(c.fcall('generic_decode', 'void *', (
+            statevar, f'{direct}_id', idvar, srcvar, lenvar, arenavar
+        ))),)))))
+    seq.append(c.blank())
+    seq.append(gen_batch_funcs())
+    return seq
+
+# Frames a batch of packets back to back into one buffer, each packet's body
+# size is computed once and stored in its len
+def gen_batch_funcs():
+    statevar = c.variable('state', 'int')
+    dirvar = c.variable('direction', 'int')
+    destvar = c.variable('dest', 'char *')
+    max_len = c.variable('max_len', 'size_t')
+    endvar = c.variable('end', 'char *')
+    pakvar = c.variable('packets', 'mc_packet *')
+    countvar = c.variable('count', 'size_t')
+    sizevar = c.variable('size', 'size_t')
+    loopvar = c.variable('i', 'size_t')
+    funcs = c.variable('funcs', 'const mc_packet_funcs *')
+    pak = f'{pakvar}[{loopvar}]'
+    seq = c.sequence()
+
+    seq.append(c.linesequence((c.fdecl(
+        'generic_size_batch', 'size_t',
+        (statevar.decl, dirvar.decl, pakvar.decl, countvar.decl)
+    ), c.block((
+        c.statement(c.assign(sizevar.decl, 0)),
+        c.forloop(c.assign(loopvar.decl, 0), c.lth(loopvar, countvar),
+            c.incop(loopvar), (
+                c.statement(c.assign(f'{pak}.len', c.fcall(
+                    'generic_size', 'size_t',
+                    (statevar, dirvar, f'{pak}.id', f'{pak}.data')
+                ))),
+                c.statement(c.addeq(sizevar, c.fcall(
+                    'size_frame', 'size_t', (f'{pak}.id', f'{pak}.len')
+                ))),
+            )
+        ),
+        c.returnval(sizevar),
+    )))))
+    seq.append(c.blank())
+
+    seq.append(c.linesequence((c.fdecl(
+        'generic_encode_batch', 'char *', (
+            statevar.decl, dirvar.decl, destvar.decl, max_len.decl,
+            pakvar.decl, countvar.decl
+        )
+    ), c.block((
+        c.statement(c.assign(endvar.decl, c.addop(destvar, max_len))),
+        c.forloop(c.assign(loopvar.decl, 0), c.lth(loopvar, countvar),
+            c.incop(loopvar), (
+                c.statement(c.assign(funcs.decl, c.fcall(
+                    'protocol_lookup', 'const mc_packet_funcs *',
+                    (statevar, dirvar, f'{pak}.id')
+                ))),
+                c.inlineif(c.wrap(funcs, True), c.returnval('NULL')),
+                c.statement(c.assign(f'{pak}.len',
+                    f'{funcs}->min_size == {funcs}->max_size ? '
+                    f'{funcs}->min_size : {funcs}->size({pak}.data)'
+                )),
+                # Whichever way the size came, the frame has to be one
+                # dec_frame accepts
+                c.inlineif(c.gth(c.addop(
+                    c.fcall('size_varint', 'size_t', (f'{pak}.id',)),
+                    f'{pak}.len'
+                ), 'MC_MAX_FRAME_LEN'), c.returnval('NULL')),
+                c.inlineif(c.lth(f'(size_t) ({endvar} - {destvar})',
+                    c.fcall('size_frame', 'size_t', (f'{pak}.id', f'{pak}.len'))
+                ), c.returnval('NULL')),
+                c.statement(c.assign(destvar, c.fcall(
+                    'enc_frame_header', 'char *',
+                    (destvar, f'{pak}.id', f'{pak}.len')
+                ))),
+                c.inlineif(f'{funcs}->enc', c.statement(c.assign(
+                    destvar, c.fcall(f'{funcs}->enc', 'char *',
+                    (destvar, f'{pak}.data'))
+                ))),
+            )
+        ),
+        c.returnval(destvar),
+    )))))
+    return seq
+
+# Benchmark driver for every packet with fields, built with src/bench.c and
+# linked against the generated protocol, see bench.h
+def gen_bench(version, comment, hdr, org_packets):
+    bench = c.cfile('bench_' + version.replace('.', '_') + '.c')
+    bench.append(comment)
+    bench.append(c.blank())
+    bench.append(c.include('stdlib.h', True))
+    bench.append(c.include('string.h', True))
+    bench.append(c.blank())
+    bench.append(c.include(hdr.path))
+    bench.append(c.include('bench.h'))
+    bench.append(c.blank())
+    # Same tables as the protocol's, random instances switch on them too
+    bench.append(gen_string_switch_tables())
+    table = c.commablock()
+    for state in 'handshaking', 'status', 'login', 'play':
+        for direction in 'toClient', 'toServer':
+            direct = direction.lower()
+            for p in org_packets[state][direction]:
+                if not p.fields:
+                    continue
+                bench.append(c.blank())
+                bench.append(p.gen_randfunc())
+                table.append(c.line(
+                    f'{{"{p.full_name}", {state}_id, {direct}_id, '
+                    f'{p.full_name}_id, rand_{p.full_name}}}'
+                ))
+    bench.append(c.blank())
+    bench.append(c.statement(c.assign(c.variabledecl(
+        'bench_packets[]', 'static const mc_bench_packet'
+    ), table)))
+    bench.append(c.blank())
+    bench.append(c.linesequence((c.fdecl('main', 'int', (
+        c.variabledecl('argc', 'int'), c.variabledecl('**argv', 'char')
+    )), c.block((c.returnval(c.fcall('mc_bench_main', 'int', (
+        'argc', 'argv', 'bench_packets',
+        'sizeof(bench_packets) / sizeof(*bench_packets)', 'protocol_lookup'
+    ))),)))))
+    return bench
+
+# Replays capture files through the generated protocol, built with
+# src/capture.c, see capture.h
+def gen_replay(version, comment, hdr):
+    replay = c.cfile('replay_' + version.replace('.', '_') + '.c')
+    replay.append(comment)
+    replay.append(c.blank())
+    replay.append(c.include(hdr.path))
+    replay.append(c.include('capture.h'))
+    replay.append(c.blank())
+    replay.append(c.linesequence((c.fdecl('main', 'int', (
+        c.variabledecl('argc', 'int'), c.variabledecl('**argv', 'char')
+    )), c.block((c.returnval(c.fcall('mc_replay_main', 'int', (
+        'argc', 'argv', 'protocol_lookup', 'protocol_strings',
+        'protocol_max_ids', 'protocol_state_max'
+    ))),)))))
+    return replay
+
+# CPython extension module converting packets to and from dicts, built with
+# src/pyproto.c, see pyproto.h
+def gen_python(version, comment, hdr, org_packets):
+    name = 'proto_' + version.replace('.', '_')
+    py = c.cfile('py_' + version.replace('.', '_') + '.c')
+    py.append(comment)
+    py.append(c.blank())
+    # Python.h has to come first
+    py.append(c.include('pyproto.h'))
+    py.append(c.include('stdlib.h', True))
+    py.append(c.blank())
+    py.append(c.include(hdr.path))
+    py.append(c.blank())
+    # Same tables as the protocol's, for switches on strings
+    py.append(gen_string_switch_tables())
+    main_table = c.commablock()
+    for state in 'handshaking', 'status', 'login', 'play':
+        for direction in 'toClient', 'toServer':
+            packets = org_packets[state][direction]
+            if not packets:
+                continue
+            direct = direction.lower()
+            table = c.commablock()
+            for p in packets:
+                if not p.fields:
+                    continue
+                py.append(c.blank())
+                py.append(p.gen_pyfuncs())
+                table.append(c.line(
+                    f'[{p.full_name}_id] = '
+                    f'{{topy_{p.full_name}, frompy_{p.full_name}}}'
+                ))
+            py.append(c.blank())
+            py.append(c.statement(c.assign(c.variabledecl(
+                f'{state}_{direct}_py[{state}_{direct}_max]',
+                'static const mc_py_packet'
+            ), table)))
+            main_table.append(c.line(
+                f'[{state}_id][{direct}_id] = {state}_{direct}_py'
             ))
-        idsw.append(c.defaultcase((c.returnval('NULL'),)))
-    statesw.append(c.defaultcase((c.returnval('NULL'),)))
-    blk.append(c.returnval(destvar))
-    return c.linesequence((c.fdecl(
-        f'generic_toclient_decode', 'void *',
-        (statevar.decl, idvar.decl, srcvar.decl, lenvar.decl)
-    ), blk))
-
-def run(version):
+    py.append(c.blank())
+    py.append(c.statement(c.assign(c.variabledecl(
+        '*py_packets[protocol_state_max][protocol_direction_max]',
+        'static const mc_py_packet'
+    ), main_table)))
+    py.append(c.blank())
+    py.append(c.statement(c.assign(
+        c.variabledecl('py_protocol', 'static const mc_py_protocol'),
+        c.commablock(elems = [c.line(v) for v in (
+            f'"{name}"', 'protocol_lookup', 'py_packets', 'protocol_strings',
+            'protocol_max_ids', 'protocol_state_max'
+        )])
+    )))
+    py.append(c.blank())
+    py.append(c.linesequence((
+        c.fdecl(f'PyInit_{name}', 'PyMODINIT_FUNC', ('void',)),
+        c.block((c.returnval(c.fcall(
+            'mc_py_module', 'PyObject *', ('&py_protocol',)
+        )),))
+    )))
+    return py
+
+# Pure Python codec module, needs src/datautils.py next to it. Packets are
+# classes with __slots__ and the codecs unpack runs of numerics with
+# precompiled structs
+# Only the generated lines of the C comment, the flags it lists are about the
+# C build and don't change the pure Python codecs
+def gen_purepython(version, org_packets):
+    mod = pyf.pyfile('codec_' + version.replace('.', '_') + '.py')
+    mod.append(pyf.linecomment('This file was generated by mcd2c.py'))
+    mod.append(pyf.linecomment('It should not be edited by hand'))
+    mod.append(pyf.blank())
+    mod.append('from datautils import *')
+    mod.append(pyf.blank())
+    # Filled in once the packets have been generated and the runs are known
+    structs = pyf.sequence()
+    mod.append(structs)
+    table = pyf.literal('protocol = Protocol({', '}, layouts)')
+    layouts = pyf.literal('layouts = {', '}')
+    for state in 'handshaking', 'status', 'login', 'play':
+        for direction in 'toClient', 'toServer':
+            packets = org_packets[state][direction]
+            if not packets:
+                continue
+            key = f'({state.upper()}, {direction.upper()}): {{'
+            ids = pyf.literal(key, '}')
+            layout_ids = pyf.literal(key, '}')
+            for p in sorted(packets, key = lambda p: p.id):
+                mod.append(pyf.blank(2))
+                mod.append(p.gen_pycodec())
+                name = p.full_name
+                ids.append(
+                    f'{p.id:#04x}: ({name}, dec_{name}, size_{name}, '
+                    f'enc_{name})'
+                )
+                layout = p.gen_pylayout()
+                if layout is not None:
+                    mod.append(pyf.blank())
+                    mod.append(layout)
+                    layout_ids.append(f'{p.id:#04x}: layout_{name}')
+            table.append(ids)
+            if layout_ids:
+                layouts.append(layout_ids)
+    mod.append(pyf.blank(2))
+    mod.append(layouts)
+    mod.append(pyf.blank())
+    mod.append(table)
+    mod.append(pyf.blank())
+    for func in ('decode', 'encode', 'decode_frames', 'decode_array',
+            'packet_name'):
+        mod.append(f'{func} = protocol.{func}')
+    structs.append(pyf.blank())
+    for fmt, name in py_structs.items():
+        structs.append(f"{name} = Struct('>{fmt}')")
+    return mod
+
+# Swapped into mcd_typemap by run(zero_copy = True)
+zero_copy_typemap = {
+    'string': mc_string_view,
+    'buffer': mc_buffer_view,
+    'restBuffer': mc_restbuffer_view,
+}
+
+# Swapped into mcd_typemap by run(lazy_nbt = True)
+lazy_nbt_typemap = {
+    'nbt': mc_lazy_nbt,
+    'optionalNbt': mc_lazy_optnbt,
+    'slot': mc_lazy_slot,
+}
+
+# The typemap swaps only last for the run they're asked for, so runs in the
+# same process don't leak into each other
+def run(version, zero_copy = False, lazy_nbt = False, **kwargs):
+    saved = dict(mcd_typemap)
+    if zero_copy:
+        mcd_typemap.update(zero_copy_typemap)
+    if lazy_nbt:
+        mcd_typemap.update(lazy_nbt_typemap)
+    try:
+        _run(version, zero_copy, lazy_nbt, **kwargs)
+    finally:
+        mcd_typemap.clear()
+        mcd_typemap.update(saved)
+
+def _run(version, zero_copy, lazy_nbt, bench = False, replay = False,
+        instrument = False, python = False, pure_python = False, peek = (),
+        patch = ()):
     data = minecraft_data(version).protocol
+    string_switch_tables.clear()
+    py_structs.clear()
     hdr = c.hfile(version.replace('.', '_') + '_proto.h')
     hdr.guard = 'H_' + hdr.guard
-    comment = c.blockcomment((
+    comment = c.blockcomment([
         c.line('This file was generated by mcd2c.py'),
         c.line('It should not be edited by hand'),
-    ))
+    ])
+    if zero_copy:
+        comment.append(c.line(
+            'Strings and buffers are zero-copy views into the decoded buffer'
+        ))
+    if lazy_nbt:
+        comment.append(c.line(
+            'NBT is kept as raw bytes in the decoded buffer until accessed'
+        ))
+    if instrument:
+        comment.append(c.line(
+            'walk_, dec_, enc_ and free_ calls are counted in protocol_counters'
+        ))
     hdr.append(comment)
     hdr.append(c.blank())
     hdr.append(c.include('stddef.h', True))
@@ -1827,6 +4597,10 @@ def run(version):
                 org_packets[state][direction].append(pak)
             temp = [(packet_id, name) for packet_id, name in enum_map.items()]
             temp.sort(key = operator.itemgetter(0))
+            # Same as the enum values, for the pure Python codecs
+            ids = {name: idx for idx, (_, name) in enumerate(temp)}
+            for pak in org_packets[state][direction]:
+                pak.id = ids[pak.name]
             direct = direction.lower()
             for packet_id, name in temp:
                 enums[state][direction].append(
@@ -1844,6 +4618,14 @@ def run(version):
             )
             enums[state][direction].append(f'{state}_{direct}_max')
 
+    # peek and patch are (packet name, field path) pairs
+    by_name = {pak.full_name: pak for pak in packets}
+    for pairs, attr in (peek, 'peeks'), (patch, 'patches'):
+        for name, path in pairs:
+            if name not in by_name:
+                raise KeyError(f'No packet named {name}')
+            getattr(by_name[name], attr).append(path)
+
     hdr.append(c.statement(c.enum('protocol_direction_id', (
         c.line('toclient_id'),
         c.line('toserver_id'),
@@ -1861,6 +4643,9 @@ def run(version):
     hdr.append(gen_enums(enums))
 
 
+    # Filled in once the packets have been generated and the tables are known
+    switch_tables = c.sequence()
+    impl.append(switch_tables)
     impl.append(gen_stringtables(sub_stringtables))
     impl.append(c.statement(c.assign(c.variabledecl(
         '**protocol_strings[protocol_state_max][protocol_direction_max]', 'const char'
@@ -1869,6 +4654,9 @@ def run(version):
     impl.append(c.statement(c.assign(c.variabledecl(
         'protocol_max_ids[protocol_state_max][protocol_direction_max]', 'const int'
     ), max_table)))
+    if instrument:
+        impl.append(c.blank())
+        impl.append(gen_counter_tables(org_packets))
 
     # ToDo: This is lazy but I'm tired
     hdr.append(c.statement('extern const char *handshaking_toserver_strings[]'))
@@ -1879,30 +4667,76 @@ def run(version):
     hdr.append(c.statement('extern const char *play_toserver_strings[]'))
     hdr.append(c.statement('extern const char **protocol_strings[protocol_state_max][protocol_direction_max]'))
     hdr.append(c.statement('extern const int protocol_max_ids[protocol_state_max][protocol_direction_max]'))
-    hdr.append(c.statement('void *generic_toclient_decode(int state, int32_t id, char * src, size_t len)'))
+    hdr.append(c.statement('extern const mc_packet_funcs *protocol_funcs[protocol_state_max][protocol_direction_max]'))
+    if instrument:
+        hdr.append(c.statement('extern mc_packet_counters *protocol_counters[protocol_state_max][protocol_direction_max]'))
     hdr.append(c.blank())
+    hdr.append(c.statement('const mc_packet_funcs *protocol_lookup(int state, int direction, int32_t id)'))
+    hdr.append(c.statement('void *generic_decode(int state, int direction, int32_t id, char *src, size_t len, mc_arena *arena)'))
+    hdr.append(c.statement('size_t generic_size(int state, int direction, int32_t id, void *packet)'))
+    hdr.append(c.statement('char *generic_encode(int state, int direction, int32_t id, char *dest, void *packet)'))
+    hdr.append(c.statement('void generic_free(int state, int direction, int32_t id, void *packet)'))
+    hdr.append(c.statement('void *generic_toclient_decode(int state, int32_t id, char *src, size_t len, mc_arena *arena)'))
+    hdr.append(c.statement('void *generic_toserver_decode(int state, int32_t id, char *src, size_t len, mc_arena *arena)'))
+    hdr.append(c.statement('size_t generic_size_batch(int state, int direction, mc_packet *packets, size_t count)'))
+    hdr.append(c.statement('char *generic_encode_batch(int state, int direction, char *dest, size_t max_len, mc_packet *packets, size_t count)'))
+    hdr.append(c.statement('mc_cached_frame *generic_encode_cached(mc_frame_cache *cache, int state, int direction, int32_t id, void *packet)'))
+    hdr.append(c.blank())
+
+    def counted(p, func, op):
+        return p.gen_counted(func, op) if instrument else func
 
     for p in packets:
         if p.fields:
             hdr.append(c.blank())
             hdr.append(p.gen_struct())
+            if p.batchable:
+                hdr.append(c.blank())
+                hdr.append(p.gen_soa_struct())
             hdr.append(c.blank())
             hdr.append(p.gen_function_defs())
+            hdr.append(c.blank())
+            hdr.append(p.gen_size_defines())
 
             impl.append(c.blank())
-            impl.append(p.gen_walkfunc())
+            impl.append(counted(p, p.gen_walkfunc(), 'walk'))
+            impl.append(c.blank())
+            impl.append(p.gen_resumefunc())
             impl.append(c.blank())
             impl.append(p.gen_sizefunc())
             impl.append(c.blank())
-            impl.append(p.gen_decfunc())
+            impl.append(counted(p, p.gen_decfunc(), 'dec'))
             impl.append(c.blank())
-            impl.append(p.gen_encfunc())
+            impl.append(counted(p, p.gen_checked_decfunc(), 'dec'))
+            if p.batchable:
+                impl.append(c.blank())
+                impl.append(p.gen_batchfunc())
+            for path in p.peeks:
+                impl.append(c.blank())
+                impl.append(p.gen_peekfunc(path))
+            for path in p.patches:
+                impl.append(c.blank())
+                impl.append(p.gen_patchfunc(path))
+            impl.append(c.blank())
+            impl.append(counted(p, p.gen_encfunc(), 'enc'))
+            impl.append(c.blank())
+            impl.append(p.gen_bounded_encfunc())
+            impl.append(c.blank())
+            impl.append(p.gen_grow_encfunc())
             if p.need_free:
                 impl.append(c.blank())
-                impl.append(p.gen_freefunc())
+                impl.append(counted(p, p.gen_freefunc(), 'free'))
+            if p.hashable:
+                impl.append(c.blank())
+                impl.append(p.gen_hashfuncs())
+            impl.append(c.blank())
+            impl.append(p.gen_generic_funcs())
     hdr.append(c.blank())
+    switch_tables.append(gen_string_switch_tables())
+    impl.append(c.blank())
+    impl.append(gen_packet_tables(org_packets))
     impl.append(c.blank())
-    impl.append(gen_toclient_decode(org_packets))
+    impl.append(gen_generic_dispatch())
     impl.append(c.blank())
 
     fp = open(hdr.path, 'w+')
@@ -1911,3 +4745,23 @@ def run(version):
     fp = open(impl.path, 'w+')
     fp.write(str(impl))
     fp.close()
+    if bench:
+        bench = gen_bench(version, comment, hdr, org_packets)
+        fp = open(bench.path, 'w+')
+        fp.write(str(bench))
+        fp.close()
+    if replay:
+        replay = gen_replay(version, comment, hdr)
+        fp = open(replay.path, 'w+')
+        fp.write(str(replay))
+        fp.close()
+    if python:
+        python = gen_python(version, comment, hdr, org_packets)
+        fp = open(python.path, 'w+')
+        fp.write(str(python))
+        fp.close()
+    if pure_python:
+        pure_python = gen_purepython(version, org_packets)
+        fp = open(pure_python.path, 'w+')
+        fp.write(str(pure_python))
+        fp.close()
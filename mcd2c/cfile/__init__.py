@@ -125,8 +125,12 @@ class sequence(MutableSequence):
             elem.indent = val
         self._indent = val
 
+    # Empty plain sequences are placeholders and don't take up a line
     def __str__(self):
-        return '\n'.join([str(elem) for elem in self.elems])
+        return '\n'.join([
+            str(elem) for elem in self.elems
+            if type(elem) is not sequence or len(elem)
+        ])
 
 
 #Like sequence, but joins on space instead of newline
@@ -0,0 +1,163 @@
+# Python source counterpart to cfile, only as much of it as the generated
+# pure Python codecs need
+
+py_indent_char = '    '
+
+def set_indent_char(char):
+    global py_indent_char
+    py_indent_char = char
+
+
+class blank:
+    def __init__(self, num=1):
+        self.indent = 0 #Irrelevant, kept because it simplifies sequences
+        self.num = num
+
+    def __str__(self):
+        # Same as cfile, sequences already add one line break per element
+        return (self.num - 1) * '\n'
+
+
+class line:
+    def __init__(self, elem, indent=0):
+        self.elem = elem
+        self.indent = indent
+
+    def __str__(self):
+        return f'{py_indent_char * self.indent}{self.elem}'
+
+
+class linecomment(line):
+    def __str__(self):
+        return f'{py_indent_char * self.indent}# {self.elem}'
+
+
+from collections.abc import MutableSequence
+
+# Group of elements at the same indentation level
+class sequence(MutableSequence):
+    def __init__(self, elems=None, indent=0):
+        self.elems = []
+        self._indent = indent
+        for elem in [] if elems is None else elems:
+            self.append(elem)
+
+    def __getitem__(self, key):
+        return self.elems[key]
+
+    def __setitem__(self, key, item):
+        if isinstance(item, str):
+            item = line(item)
+        item.indent = self.indent
+        self.elems[key] = item
+
+    def __delitem__(self, key):
+        del self.elems[key]
+
+    def __len__(self):
+        return len(self.elems)
+
+    def insert(self, key, item):
+        if isinstance(item, str):
+            item = line(item)
+        item.indent = self.indent
+        self.elems.insert(key, item)
+
+    @property
+    def indent(self):
+        return self._indent
+
+    @indent.setter
+    def indent(self, val):
+        for elem in self.elems:
+            elem.indent = val
+        self._indent = val
+
+    # Empty plain sequences are placeholders and don't take up a line
+    def __str__(self):
+        return '\n'.join([
+            str(elem) for elem in self.elems
+            if type(elem) is not sequence or len(elem)
+        ])
+
+
+# Compound statement, header is everything before the colon. An empty body
+# gets a pass so the result always parses
+class block(sequence):
+    def __init__(self, header, elems=None, indent=0):
+        self.header = header
+        super().__init__(elems, indent)
+
+    @property
+    def indent(self):
+        return self._indent
+
+    @indent.setter
+    def indent(self, val):
+        for elem in self.elems:
+            elem.indent = val + 1
+        self._indent = val
+
+    def __setitem__(self, key, item):
+        super().__setitem__(key, item)
+        self.elems[key].indent = self.indent + 1
+
+    def insert(self, key, item):
+        super().insert(key, item)
+        self.elems[key].indent = self.indent + 1
+
+    def __str__(self):
+        i = py_indent_char * self.indent
+        body = super().__str__()
+        if not body:
+            body = f'{py_indent_char * (self.indent + 1)}pass'
+        return f'{i}{self.header}:\n{body}'
+
+
+class ifcond(block):
+    def __init__(self, condition, elems=None, indent=0):
+        super().__init__(f'if {condition}', elems, indent)
+
+class elifcond(block):
+    def __init__(self, condition, elems=None, indent=0):
+        super().__init__(f'elif {condition}', elems, indent)
+
+class elsecond(block):
+    def __init__(self, elems=None, indent=0):
+        super().__init__('else', elems, indent)
+
+class forloop(block):
+    def __init__(self, target, iterable, elems=None, indent=0):
+        super().__init__(f'for {target} in {iterable}', elems, indent)
+
+class fdef(block):
+    def __init__(self, name, args, elems=None, indent=0):
+        super().__init__(f'def {name}({", ".join(args)})', elems, indent)
+
+class classdef(block):
+    def __init__(self, name, bases=(), elems=None, indent=0):
+        header = f'class {name}({", ".join(bases)})' if bases else \
+            f'class {name}'
+        super().__init__(header, elems, indent)
+
+
+# Bracketed literal, one element per line. header is everything up to and
+# including the opening bracket
+class literal(block):
+    def __init__(self, header, close, elems=None, indent=0):
+        self.close = close
+        super().__init__(header, elems, indent)
+
+    def __str__(self):
+        i = py_indent_char * self.indent
+        inner = ''.join(f'{elem},\n' for elem in self.elems)
+        return f'{i}{self.header}\n{inner}{i}{self.close}'
+
+
+class pyfile(sequence):
+    def __init__(self, path, elems=None):
+        self.path = path
+        super().__init__(elems)
+
+    def __str__(self):
+        return super().__str__() + '\n'
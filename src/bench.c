@@ -0,0 +1,276 @@
+#define _POSIX_C_SOURCE 199309L
+#include "bench.h"
+#include "cNBT/nbt.h"
+#include "datautils.h"
+#include "sds.h"
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+static uint64_t bench_state = 0x9E3779B97F4A7C15;
+
+void mc_bench_seed(uint64_t seed) {
+  bench_state = seed ? seed : 0x9E3779B97F4A7C15;
+}
+
+uint64_t mc_bench_rand(void) {
+  bench_state ^= bench_state >> 12;
+  bench_state ^= bench_state << 25;
+  bench_state ^= bench_state >> 27;
+  return bench_state * 0x2545F4914F6CDD1D;
+}
+
+// Spread across every varint length instead of nearly always ten bytes
+void mc_bench_varlong(int64_t *dest) {
+  *dest = (int64_t) (mc_bench_rand() >> (mc_bench_rand() % 64));
+}
+
+void mc_bench_position(mc_position *dest) {
+  dest->x = (int32_t) (mc_bench_rand() << 6) >> 6;
+  dest->y = (int32_t) (mc_bench_rand() << 20) >> 20;
+  dest->z = (int32_t) (mc_bench_rand() << 6) >> 6;
+}
+
+void mc_bench_uuid(mc_uuid *dest) {
+  dest->msb = mc_bench_rand();
+  dest->lsb = mc_bench_rand();
+}
+
+static char bench_pool[] =
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_:"
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_:";
+
+char *mc_bench_view(size_t len) {
+  return bench_pool + mc_bench_rand() % (sizeof(bench_pool) - len);
+}
+
+char *mc_bench_bytes(size_t len) {
+  char *bytes = malloc(len ? len : 1);
+  for(size_t i = 0; i < len; i++)
+    bytes[i] = mc_bench_rand();
+  return bytes;
+}
+
+void mc_bench_string(sds *dest) {
+  size_t len = mc_bench_rand() % MC_BENCH_MAX_LEN;
+  *dest = sdsnewlen(mc_bench_view(len), len);
+}
+
+void mc_bench_string_of(sds *dest, const char *str) {
+  *dest = sdsnew(str);
+}
+
+void mc_bench_strview(mc_strview *dest) {
+  dest->len = mc_bench_rand() % MC_BENCH_MAX_LEN;
+  dest->base = mc_bench_view(dest->len);
+}
+
+void mc_bench_strview_of(mc_strview *dest, const char *str) {
+  dest->len = strlen(str);
+  dest->base = (char *) str;
+}
+
+void mc_bench_buffer(mc_buffer *dest) {
+  dest->len = mc_bench_rand() % MC_BENCH_MAX_LEN;
+  dest->base = mc_bench_bytes(dest->len);
+}
+
+void mc_bench_bufview(mc_buffer *dest) {
+  dest->len = mc_bench_rand() % MC_BENCH_MAX_LEN;
+  dest->base = mc_bench_view(dest->len);
+}
+
+// The NBT types are decoded out of small canned samples, a compound holding
+// a single int, and a slot carrying it
+#define BENCH_NBT TAG_COMPOUND, 0, 0, TAG_INT, 0, 1, 'a', 0, 0, 0, 42, TAG_INVALID
+static char nbt_sample[] = {BENCH_NBT};
+static char slot_sample[] = {0, 1, 2, 0, 3, BENCH_NBT};
+static char smelting_sample[] = {0, 0, 0, 1, 2, 0, 3, BENCH_NBT, 0, 0, 0, 0, 0};
+
+void mc_bench_nbt(nbt_node **dest) {
+  dec_nbt(dest, nbt_sample, NULL);
+}
+
+void mc_bench_optnbt(nbt_node **dest) {
+  dec_optnbt(dest, nbt_sample, NULL);
+}
+
+void mc_bench_slot(mc_slot *dest) {
+  dec_slot(dest, slot_sample, NULL);
+}
+
+void mc_bench_lazynbt(mc_lazy_nbt *dest) {
+  dec_lazynbt(dest, nbt_sample, NULL);
+}
+
+void mc_bench_lazyoptnbt(mc_lazy_nbt *dest) {
+  dec_lazyoptnbt(dest, nbt_sample, NULL);
+}
+
+void mc_bench_lazyslot(mc_lazy_slot *dest) {
+  dec_lazyslot(dest, slot_sample, NULL);
+}
+
+void mc_bench_smelting(mc_smelting *dest) {
+  dec_smelting(dest, smelting_sample, NULL);
+}
+
+void mc_bench_ingredient(mc_ingredient *dest) {
+  memset(dest, 0, sizeof(*dest));
+}
+
+void mc_bench_metadata(mc_metadata *dest) {
+  memset(dest, 0, sizeof(*dest));
+}
+
+void mc_bench_itemtag_array(mc_itemtag_array *dest) {
+  memset(dest, 0, sizeof(*dest));
+}
+
+void mc_bench_particledata(mc_particle *dest) {
+  memset(dest, 0, sizeof(*dest));
+}
+
+// Driver
+
+static volatile size_t bench_sink;
+
+static uint64_t bench_now(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+static void bench_print(uint64_t ns, size_t ops, double bytes) {
+  double per_op = (double) ns / ops;
+  printf(" %8.1f %8.1f", per_op, per_op ? bytes / per_op * 1e3 : 0);
+}
+
+// Everything has to roundtrip before it's worth timing
+static int bench_check(const mc_packet_funcs *funcs, char *buf, size_t len,
+    char *scratch) {
+  if(funcs->walk(buf, len) != (int) len)
+    return -1;
+  void *packet = calloc(1, funcs->packet_size);
+  int ret = -1;
+  if(funcs->dec(packet, buf, len, NULL) == buf + len &&
+      funcs->size(packet) == len &&
+      funcs->enc(scratch, packet) == scratch + len &&
+      !memcmp(scratch, buf, len))
+    ret = 0;
+  if(funcs->free)
+    funcs->free(packet);
+  free(packet);
+  return ret;
+}
+
+static void bench_one(const mc_bench_packet *bench,
+    const mc_packet_funcs *funcs, size_t iterations) {
+  char *samples = calloc(MC_BENCH_SAMPLES, funcs->packet_size);
+  char *decoded = calloc(MC_BENCH_SAMPLES, funcs->packet_size);
+  char *bufs[MC_BENCH_SAMPLES];
+  size_t lens[MC_BENCH_SAMPLES];
+  size_t total = 0, max = 1;
+  for(size_t i = 0; i < MC_BENCH_SAMPLES; i++) {
+    void *sample = samples + i * funcs->packet_size;
+    bench->rand(sample);
+    lens[i] = funcs->size(sample);
+    bufs[i] = malloc(lens[i] ? lens[i] : 1);
+    funcs->enc(bufs[i], sample);
+    total += lens[i];
+    max = lens[i] > max ? lens[i] : max;
+  }
+  char *scratch = malloc(max);
+  double bytes = (double) total / MC_BENCH_SAMPLES;
+  printf("%-48s %8.1f", bench->name, bytes);
+
+  int ok = 1;
+  for(size_t i = 0; ok && i < MC_BENCH_SAMPLES; i++)
+    ok = !bench_check(funcs, bufs[i], lens[i], scratch);
+  if(!ok) {
+    printf("  doesn't roundtrip, skipped\n");
+    goto cleanup;
+  }
+
+  uint64_t start = bench_now();
+  for(size_t i = 0; i < iterations; i++) {
+    size_t idx = i % MC_BENCH_SAMPLES;
+    bench_sink += funcs->walk(bufs[idx], lens[idx]);
+  }
+  bench_print(bench_now() - start, iterations, bytes);
+
+  start = bench_now();
+  for(size_t i = 0; i < iterations; i++) {
+    size_t idx = i % MC_BENCH_SAMPLES;
+    bench_sink += funcs->size(samples + idx * funcs->packet_size);
+  }
+  bench_print(bench_now() - start, iterations, bytes);
+
+  start = bench_now();
+  for(size_t i = 0; i < iterations; i++) {
+    size_t idx = i % MC_BENCH_SAMPLES;
+    bench_sink += (size_t) funcs->enc(scratch,
+        samples + idx * funcs->packet_size);
+  }
+  bench_print(bench_now() - start, iterations, bytes);
+
+  size_t rounds = (iterations + MC_BENCH_SAMPLES - 1) / MC_BENCH_SAMPLES;
+  uint64_t dec_ns = 0, free_ns = 0;
+  for(size_t r = 0; r < rounds; r++) {
+    start = bench_now();
+    for(size_t i = 0; i < MC_BENCH_SAMPLES; i++)
+      funcs->dec(decoded + i * funcs->packet_size, bufs[i], lens[i], NULL);
+    dec_ns += bench_now() - start;
+    if(funcs->free) {
+      start = bench_now();
+      for(size_t i = 0; i < MC_BENCH_SAMPLES; i++)
+        funcs->free(decoded + i * funcs->packet_size);
+      free_ns += bench_now() - start;
+    }
+  }
+  bench_print(dec_ns, rounds * MC_BENCH_SAMPLES, bytes);
+  if(funcs->free)
+    bench_print(free_ns, rounds * MC_BENCH_SAMPLES, bytes);
+  else
+    printf(" %8s %8s", "-", "-");
+  printf("\n");
+
+cleanup:
+  for(size_t i = 0; i < MC_BENCH_SAMPLES; i++) {
+    if(funcs->free)
+      funcs->free(samples + i * funcs->packet_size);
+    free(bufs[i]);
+  }
+  free(scratch);
+  free(decoded);
+  free(samples);
+}
+
+int mc_bench_main(int argc, char **argv, const mc_bench_packet *packets,
+    size_t count,
+    const mc_packet_funcs *(*lookup)(int state, int direction, int32_t id)) {
+  size_t iterations = argc > 1 ? strtoull(argv[1], NULL, 10) : 0;
+  const char *filter = argc > 2 ? argv[2] : NULL;
+  if(!iterations)
+    iterations = MC_BENCH_ITERATIONS;
+  printf("%-48s %8s %17s %17s %17s %17s %17s\n", "packet", "bytes", "walk",
+      "size", "enc", "dec", "free");
+  printf("%-48s %8s", "", "");
+  for(int i = 0; i < 5; i++)
+    printf(" %8s %8s", "ns/op", "MB/s");
+  printf("\n");
+  for(size_t i = 0; i < count; i++) {
+    if(filter && !strstr(packets[i].name, filter))
+      continue;
+    const mc_packet_funcs *funcs = lookup(packets[i].state,
+        packets[i].direction, packets[i].id);
+    if(!funcs || !funcs->enc)
+      continue;
+    // Seeded per packet so filtering doesn't change what gets generated
+    mc_bench_seed(i + 1);
+    bench_one(&packets[i], funcs, iterations);
+  }
+  return 0;
+}
@@ -44,7 +44,8 @@ void buffer_free(struct buffer* b)
 {
     assert(b);
 
-    free(b->data);
+    if(!b->fixed)
+        free(b->data);
 
     b->data = NULL;
     b->len = 0;
@@ -62,6 +63,9 @@ int buffer_reserve(struct buffer* b, size_t reserved_amount)
     if(likely(b->cap >= reserved_amount))
         return 0;
 
+    if(unlikely(b->fixed))
+        return 1;
+
     while(b->cap < reserved_amount)
         b->cap *= 2;
 
@@ -72,8 +72,18 @@ static const void* swapped_memscan(void* dest, const void* src, size_t n)
     return be2ne(dest, n), ret;
 }
 
+/*
+ * Allocations go through `allocator' when parsing with nbt_parse_with, both
+ * macros expect it to be in scope. Memory from a custom allocator is owned by
+ * it, so error paths leave it alone instead of freeing.
+ */
+#define NBT_MALLOC(n) \
+    (allocator ? allocator->alloc(allocator->aux, (n)) : malloc(n))
+
+#define NBT_RELEASE(ptr) do { if(!allocator) free(ptr); } while(0)
+
 #define CHECKED_MALLOC(var, n, on_error) do { \
-    if((var = malloc(n)) == NULL)             \
+    if((var = NBT_MALLOC(n)) == NULL)         \
     {                                         \
         errno = NBT_EMEM;                     \
         on_error;                             \
@@ -86,7 +96,7 @@ static const void* swapped_memscan(void* dest, const void* src, size_t n)
 } while(0)
 
 /* Parses a tag, given a name (may be NULL) and a type. Fills in the payload. */
-static nbt_node* parse_unnamed_tag(nbt_type type, char* name, const char** memory, size_t* length);
+static nbt_node* parse_unnamed_tag(nbt_type type, char* name, const char** memory, size_t* length, const nbt_allocator* allocator);
 
 /*
  * Reads some bytes from the memory stream. This macro will read `n'
@@ -123,7 +133,7 @@ static void bprintf(struct buffer* b, const char* restrict format, ...)
  * Reads a string from memory, moving the pointer and updating the length
  * appropriately. Returns NULL on failure.
  */
-static char* read_string(const char** memory, size_t* length)
+static char* read_string(const char** memory, size_t* length, const nbt_allocator* allocator)
 {
     int16_t string_length;
     char* ret = NULL;
@@ -144,20 +154,20 @@ parse_error:
     if(errno == NBT_OK)
         errno = NBT_ERR;
 
-    free(ret);
+    NBT_RELEASE(ret);
     return NULL;
 }
 
-static nbt_node* parse_named_tag(const char** memory, size_t* length)
+static nbt_node* parse_named_tag(const char** memory, size_t* length, const nbt_allocator* allocator)
 {
   char* name = NULL;
 
   uint8_t type;
   READ_GENERIC(&type, sizeof type, memscan, goto parse_error);
 
-  name = read_string(memory, length);
+  name = read_string(memory, length, allocator);
 
-  nbt_node* ret = parse_unnamed_tag((nbt_type)type, name, memory, length);
+  nbt_node* ret = parse_unnamed_tag((nbt_type)type, name, memory, length, allocator);
   if(ret == NULL) goto parse_error;
 
   return ret;
@@ -166,11 +176,11 @@ parse_error:
   if(errno == NBT_OK)
     errno = NBT_ERR;
 
-  free(name);
+  NBT_RELEASE(name);
   return NULL;
 }
 
-static struct nbt_byte_array read_byte_array(const char** memory, size_t* length)
+static struct nbt_byte_array read_byte_array(const char** memory, size_t* length, const nbt_allocator* allocator)
 {
     struct nbt_byte_array ret;
     ret.data = NULL;
@@ -189,12 +199,12 @@ parse_error:
     if(errno == NBT_OK)
         errno = NBT_ERR;
 
-    free(ret.data);
+    NBT_RELEASE(ret.data);
     ret.data = NULL;
     return ret;
 }
 
-static struct nbt_int_array read_int_array(const char** memory, size_t* length)
+static struct nbt_int_array read_int_array(const char** memory, size_t* length, const nbt_allocator* allocator)
 {
     struct nbt_int_array ret;
     ret.data = NULL;
@@ -218,7 +228,7 @@ parse_error:
     if(errno == NBT_OK)
         errno = NBT_ERR;
 
-    free(ret.data);
+    NBT_RELEASE(ret.data);
     ret.data = NULL;
     return ret;
 }
@@ -256,7 +266,7 @@ static nbt_type list_is_homogenous(const struct nbt_list* list)
     return type;
 }
 
-static struct nbt_list* read_list(const char** memory, size_t* length)
+static struct nbt_list* read_list(const char** memory, size_t* length, const nbt_allocator* allocator)
 {
     uint8_t type;
     int32_t elems;
@@ -281,11 +291,11 @@ static struct nbt_list* read_list(const char** memory, size_t* length)
 
         CHECKED_MALLOC(new, sizeof *new, goto parse_error);
 
-        new->data = parse_unnamed_tag((nbt_type)type, NULL, memory, length);
+        new->data = parse_unnamed_tag((nbt_type)type, NULL, memory, length, allocator);
 
         if(new->data == NULL)
         {
-            free(new);
+            NBT_RELEASE(new);
             goto parse_error;
         }
 
@@ -298,11 +308,11 @@ parse_error:
     if(errno == NBT_OK)
         errno = NBT_ERR;
 
-    nbt_free_list(ret);
+    if(!allocator) nbt_free_list(ret);
     return NULL;
 }
 
-static struct nbt_list* read_compound(const char** memory, size_t* length)
+static struct nbt_list* read_compound(const char** memory, size_t* length, const nbt_allocator* allocator)
 {
     struct nbt_list* ret;
 
@@ -321,20 +331,20 @@ static struct nbt_list* read_compound(const char** memory, size_t* length)
 
         if(type == 0) break; /* TAG_END == 0. We've hit the end of the list when type == TAG_END. */
 
-        name = read_string(memory, length);
+        name = read_string(memory, length, allocator);
         if(name == NULL) goto parse_error;
 
         CHECKED_MALLOC(new_entry, sizeof *new_entry,
-            free(name);
+            NBT_RELEASE(name);
             goto parse_error;
         );
 
-        new_entry->data = parse_unnamed_tag((nbt_type)type, name, memory, length);
+        new_entry->data = parse_unnamed_tag((nbt_type)type, name, memory, length, allocator);
 
         if(new_entry->data == NULL)
         {
-            free(new_entry);
-            free(name);
+            NBT_RELEASE(new_entry);
+            NBT_RELEASE(name);
             goto parse_error;
         }
 
@@ -346,7 +356,7 @@ static struct nbt_list* read_compound(const char** memory, size_t* length)
 parse_error:
     if(errno == NBT_OK)
         errno = NBT_ERR;
-    nbt_free_list(ret);
+    if(!allocator) nbt_free_list(ret);
 
     return NULL;
 }
@@ -354,7 +364,7 @@ parse_error:
 /*
  * Parses a tag, given a name (may be NULL) and a type. Fills in the payload.
  */
-static nbt_node* parse_unnamed_tag(nbt_type type, char* name, const char** memory, size_t* length)
+static nbt_node* parse_unnamed_tag(nbt_type type, char* name, const char** memory, size_t* length, const nbt_allocator* allocator)
 {
     nbt_node* node;
 
@@ -387,19 +397,19 @@ static nbt_node* parse_unnamed_tag(nbt_type type, char* name, const char** memor
         COPY_INTO_PAYLOAD(tag_double);
         break;
     case TAG_BYTE_ARRAY:
-        node->payload.tag_byte_array = read_byte_array(memory, length);
+        node->payload.tag_byte_array = read_byte_array(memory, length, allocator);
         break;
     case TAG_INT_ARRAY:
-        node->payload.tag_int_array = read_int_array(memory, length);
+        node->payload.tag_int_array = read_int_array(memory, length, allocator);
         break;
     case TAG_STRING:
-        node->payload.tag_string = read_string(memory, length);
+        node->payload.tag_string = read_string(memory, length, allocator);
         break;
     case TAG_LIST:
-        node->payload.tag_list = read_list(memory, length);
+        node->payload.tag_list = read_list(memory, length, allocator);
         break;
     case TAG_COMPOUND:
-        node->payload.tag_compound = read_compound(memory, length);
+        node->payload.tag_compound = read_compound(memory, length, allocator);
         break;
 
     default:
@@ -416,7 +426,7 @@ parse_error:
     if(errno == NBT_OK)
         errno = NBT_ERR;
 
-    free(node);
+    NBT_RELEASE(node);
     return NULL;
 }
 
@@ -427,7 +437,7 @@ nbt_node* nbt_parse(const void* mem, size_t len)
     const char** memory = (const char**)&mem;
     size_t* length = &len;
 
-    return parse_named_tag(memory, length);
+    return parse_named_tag(memory, length, NULL);
 }
 
 //rkr needs a way to advance its memory pointer when reading nbt from protocol
@@ -438,7 +448,16 @@ nbt_node* nbt_parse2(const void* mem, size_t len)
 
     size_t* length = &len;
 
-    return parse_named_tag((const char **) mem, length);
+    return parse_named_tag((const char **) mem, length, NULL);
+}
+
+nbt_node* nbt_parse_with(const void* mem, size_t len, const nbt_allocator* allocator)
+{
+    errno = NBT_OK;
+
+    size_t* length = &len;
+
+    return parse_named_tag((const char **) mem, length, allocator);
 }
 
 /* spaces, not tabs ;) */
@@ -779,3 +798,17 @@ struct buffer nbt_dump_binary(const nbt_node* tree)
 
     return ret;
 }
+
+size_t nbt_dump_binary_to(const nbt_node* tree, void* dest, size_t len)
+{
+    errno = NBT_OK;
+
+    if(tree == NULL) return 0;
+
+    struct buffer b = BUFFER_FIXED(dest, len);
+
+    if((errno = __dump_binary(tree, true, &b)) != NBT_OK)
+        return 0;
+
+    return b.len;
+}
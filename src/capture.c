@@ -0,0 +1,418 @@
+#define _POSIX_C_SOURCE 199309L
+#include "capture.h"
+#include "datautils.h"
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <time.h>
+#include <unistd.h>
+
+static const char capture_magic[8] = "MCD2CCAP";
+static const char index_magic[8] = "MCD2CIDX";
+
+uint64_t mc_capture_now(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_REALTIME, &ts);
+  return (uint64_t) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+int mc_capture_create(mc_capture_writer *writer, const char *path) {
+  char header[MC_CAPTURE_HEADER_SIZE];
+  char *ptr = header;
+  memset(writer, 0, sizeof(*writer));
+  memcpy(ptr, capture_magic, sizeof(capture_magic));
+  ptr = enc_be32(ptr + sizeof(capture_magic), MC_CAPTURE_VERSION);
+  enc_be32(ptr, 0);
+  if(!(writer->fp = fopen(path, "wb")))
+    return -1;
+  if(fwrite(header, sizeof(header), 1, writer->fp) != 1) {
+    fclose(writer->fp);
+    writer->fp = NULL;
+    return -1;
+  }
+  writer->offset = sizeof(header);
+  return 0;
+}
+
+int mc_capture_write(mc_capture_writer *writer, int state, int direction,
+    int32_t id, uint64_t timestamp, char *data, size_t len) {
+  char header[MC_CAPTURE_FRAME_SIZE];
+  char *ptr = header;
+  if(len > UINT32_MAX)
+    return -1;
+  if(writer->count == writer->cap) {
+    size_t cap = writer->cap ? writer->cap * 2 : 1024;
+    uint64_t *offsets = realloc(writer->offsets, cap * sizeof(*offsets));
+    if(!offsets)
+      return -1;
+    writer->offsets = offsets;
+    writer->cap = cap;
+  }
+  ptr = enc_be64(ptr, timestamp);
+  ptr = enc_be32(ptr, id);
+  ptr = enc_be32(ptr, len);
+  ptr = enc_byte(ptr, state);
+  enc_byte(ptr, direction);
+  if(fwrite(header, sizeof(header), 1, writer->fp) != 1 ||
+      (len && fwrite(data, len, 1, writer->fp) != 1))
+    return -1;
+  writer->offsets[writer->count++] = writer->offset;
+  writer->offset += sizeof(header) + len;
+  return 0;
+}
+
+int mc_capture_finish(mc_capture_writer *writer) {
+  char buf[4096];
+  int ret = 0;
+  for(size_t i = 0; i < writer->count;) {
+    size_t n = writer->count - i;
+    if(n > sizeof(buf) / 8)
+      n = sizeof(buf) / 8;
+    enc_be64s(buf, writer->offsets + i, n);
+    if(fwrite(buf, n * 8, 1, writer->fp) != 1)
+      ret = -1;
+    i += n;
+  }
+  char *ptr = enc_be64(buf, writer->offset);
+  ptr = enc_be64(ptr, writer->count);
+  memcpy(ptr, index_magic, sizeof(index_magic));
+  if(fwrite(buf, MC_CAPTURE_TRAILER_SIZE, 1, writer->fp) != 1)
+    ret = -1;
+  if(fclose(writer->fp))
+    ret = -1;
+  free(writer->offsets);
+  memset(writer, 0, sizeof(*writer));
+  return ret;
+}
+
+// Trusts the trailer if it describes an index that fits the file, otherwise
+// the capture wasn't finished and the frames have to be scanned for
+static int capture_index(mc_capture *capture) {
+  char *trailer = capture->base + capture->size - MC_CAPTURE_TRAILER_SIZE;
+  uint64_t offset, count;
+  if(capture->size >= MC_CAPTURE_HEADER_SIZE + MC_CAPTURE_TRAILER_SIZE &&
+      !memcmp(trailer + 16, index_magic, sizeof(index_magic))) {
+    dec_be64(&count, dec_be64(&offset, trailer));
+    size_t end = capture->size - MC_CAPTURE_TRAILER_SIZE;
+    if(offset >= MC_CAPTURE_HEADER_SIZE && offset <= end &&
+        count == (end - offset) / 8 && (end - offset) % 8 == 0) {
+      capture->index = capture->base + offset;
+      capture->count = count;
+      return 0;
+    }
+  }
+  size_t cap = 1024;
+  if(!(capture->rebuilt = malloc(cap * 8)))
+    return -1;
+  offset = MC_CAPTURE_HEADER_SIZE;
+  while(capture->size - offset >= MC_CAPTURE_FRAME_SIZE) {
+    uint32_t len;
+    dec_be32(&len, capture->base + offset + 12);
+    if(capture->size - offset - MC_CAPTURE_FRAME_SIZE < len)
+      break;
+    if(capture->count == cap) {
+      char *rebuilt = realloc(capture->rebuilt, cap * 2 * 8);
+      if(!rebuilt)
+        return -1;
+      capture->rebuilt = rebuilt;
+      cap *= 2;
+    }
+    enc_be64(capture->rebuilt + capture->count++ * 8, offset);
+    offset += MC_CAPTURE_FRAME_SIZE + len;
+  }
+  capture->index = capture->rebuilt;
+  return 0;
+}
+
+int mc_capture_open(mc_capture *capture, const char *path) {
+  struct stat st;
+  memset(capture, 0, sizeof(*capture));
+  int fd = open(path, O_RDONLY);
+  if(fd < 0)
+    return -1;
+  if(fstat(fd, &st) || st.st_size < MC_CAPTURE_HEADER_SIZE) {
+    close(fd);
+    return -1;
+  }
+  capture->size = st.st_size;
+  // Private and writable, so nothing decoding does can reach the file
+  capture->base = mmap(NULL, capture->size, PROT_READ | PROT_WRITE,
+      MAP_PRIVATE, fd, 0);
+  close(fd);
+  if(capture->base == MAP_FAILED) {
+    capture->base = NULL;
+    return -1;
+  }
+  uint32_t version;
+  dec_be32(&version, capture->base + sizeof(capture_magic));
+  if(memcmp(capture->base, capture_magic, sizeof(capture_magic)) ||
+      version != MC_CAPTURE_VERSION || capture_index(capture)) {
+    mc_capture_close(capture);
+    return -1;
+  }
+  return 0;
+}
+
+int mc_capture_get(const mc_capture *capture, size_t idx,
+    mc_capture_frame *frame) {
+  uint64_t offset;
+  uint32_t id, len;
+  uint8_t state, direction;
+  if(idx >= capture->count)
+    return -1;
+  dec_be64(&offset, capture->index + idx * 8);
+  if(offset < MC_CAPTURE_HEADER_SIZE || offset > capture->size ||
+      capture->size - offset < MC_CAPTURE_FRAME_SIZE)
+    return -1;
+  char *ptr = capture->base + offset;
+  ptr = dec_be64(&frame->timestamp, ptr);
+  ptr = dec_be32(&id, ptr);
+  ptr = dec_be32(&len, ptr);
+  ptr = dec_byte(&state, ptr);
+  ptr = dec_byte(&direction, ptr);
+  if(capture->size - offset - MC_CAPTURE_FRAME_SIZE < len)
+    return -1;
+  frame->id = id;
+  frame->len = len;
+  frame->state = state;
+  frame->direction = direction;
+  frame->data = ptr;
+  return 0;
+}
+
+void mc_capture_close(mc_capture *capture) {
+  if(capture->base)
+    munmap(capture->base, capture->size);
+  free(capture->rebuilt);
+  memset(capture, 0, sizeof(*capture));
+}
+
+// Replay
+
+// Frames are decoded a chunk at a time into one arena, then encoded back out
+// before it's reset
+#define REPLAY_CHUNK 256
+
+typedef struct {
+  size_t frames;
+  size_t bytes;
+  size_t failed;
+  size_t allocs;
+  size_t allocated;
+  uint64_t walk_ns;
+  uint64_t dec_ns;
+  uint64_t enc_ns;
+} replay_stats;
+
+typedef struct {
+  const mc_packet_funcs *funcs;
+  mc_capture_frame frames[REPLAY_CHUNK];
+  char ok[REPLAY_CHUNK];
+  char *packets;
+  char *scratch;
+  size_t scratch_len;
+  mc_arena arena;
+} replay_state;
+
+static uint64_t replay_now(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+static void replay_print(uint64_t ns, size_t ops, size_t bytes) {
+  double per_op = ops ? (double) ns / ops : 0;
+  printf(" %8.1f %8.1f", per_op, ns ? (double) bytes / ns * 1e3 : 0);
+}
+
+static int replay_scratch(replay_state *rs, size_t len) {
+  if(len <= rs->scratch_len)
+    return 0;
+  char *scratch = realloc(rs->scratch, len);
+  if(!scratch)
+    return -1;
+  rs->scratch = scratch;
+  rs->scratch_len = len;
+  return 0;
+}
+
+// Runs one chunk of same type frames through walk, dec and enc, failures and
+// allocations are only counted when count is set so extra passes don't
+// inflate them
+static void replay_chunk(replay_state *rs, size_t n, replay_stats *stats,
+    int count) {
+  const mc_packet_funcs *funcs = rs->funcs;
+  size_t allocs = rs->arena.allocs, allocated = rs->arena.allocated;
+  uint64_t start = replay_now();
+  for(size_t i = 0; i < n; i++)
+    rs->ok[i] = funcs->walk(rs->frames[i].data, rs->frames[i].len) ==
+        (int) rs->frames[i].len;
+  stats->walk_ns += replay_now() - start;
+
+  start = replay_now();
+  for(size_t i = 0; i < n; i++)
+    if(rs->ok[i])
+      rs->ok[i] = !!funcs->dec(rs->packets + i * funcs->packet_size,
+          rs->frames[i].data, rs->frames[i].len, &rs->arena);
+  stats->dec_ns += replay_now() - start;
+
+  for(size_t i = 0; i < n; i++) {
+    if(count && !rs->ok[i])
+      stats->failed++;
+    if(rs->ok[i] &&
+        replay_scratch(rs, funcs->size(rs->packets + i * funcs->packet_size)))
+      rs->ok[i] = 0;
+  }
+  start = replay_now();
+  for(size_t i = 0; i < n; i++)
+    if(rs->ok[i])
+      funcs->enc(rs->scratch, rs->packets + i * funcs->packet_size);
+  stats->enc_ns += replay_now() - start;
+
+  if(count) {
+    stats->allocs += rs->arena.allocs - allocs;
+    stats->allocated += rs->arena.allocated - allocated;
+  }
+  mc_arena_reset(&rs->arena);
+}
+
+int mc_replay_main(int argc, char **argv,
+    const mc_packet_funcs *(*lookup)(int state, int direction, int32_t id),
+    const char **(*strings)[2], const int (*max_ids)[2], int states) {
+  mc_capture capture;
+  if(argc < 2) {
+    fprintf(stderr, "usage: %s capture [passes]\n", argv[0]);
+    return 1;
+  }
+  if(mc_capture_open(&capture, argv[1])) {
+    fprintf(stderr, "%s: can't read capture %s\n", argv[0], argv[1]);
+    return 1;
+  }
+  size_t passes = argc > 2 ? strtoull(argv[2], NULL, 10) : 1;
+  if(!passes)
+    passes = 1;
+
+  // Packet types are numbered state by state, direction by direction
+  size_t *first = calloc(states * 2 + 1, sizeof(*first));
+  for(int i = 0; i < states * 2; i++)
+    first[i + 1] = first[i] + max_ids[i / 2][i % 2];
+  size_t types = first[states * 2];
+  size_t *type_of = malloc(capture.count * sizeof(*type_of));
+  size_t *start = calloc(types + 1, sizeof(*start));
+  replay_stats *stats = calloc(types, sizeof(*stats));
+  size_t skipped = 0, frames = 0, bytes = 0, packet_size = 0;
+  mc_capture_frame frame;
+  for(size_t i = 0; i < capture.count; i++) {
+    const mc_packet_funcs *funcs = NULL;
+    type_of[i] = types;
+    if(!mc_capture_get(&capture, i, &frame) && frame.state < states &&
+        frame.direction < 2 && frame.id >= 0 &&
+        frame.id < max_ids[frame.state][frame.direction])
+      funcs = lookup(frame.state, frame.direction, frame.id);
+    if(!funcs || !funcs->walk) {
+      skipped++;
+      continue;
+    }
+    type_of[i] = first[frame.state * 2 + frame.direction] + frame.id;
+    stats[type_of[i]].frames++;
+    stats[type_of[i]].bytes += frame.len;
+    frames++;
+    bytes += frame.len;
+    if(funcs->packet_size > packet_size)
+      packet_size = funcs->packet_size;
+  }
+  // Frame indices grouped by type, in capture order within each
+  size_t *order = malloc((frames ? frames : 1) * sizeof(*order));
+  for(size_t t = 0; t < types; t++)
+    start[t + 1] = start[t] + stats[t].frames;
+  size_t *fill = malloc((types + 1) * sizeof(*fill));
+  memcpy(fill, start, (types + 1) * sizeof(*fill));
+  for(size_t i = 0; i < capture.count; i++)
+    if(type_of[i] < types)
+      order[fill[type_of[i]]++] = i;
+
+  replay_state rs = {0};
+  mc_arena_init(&rs.arena, 0);
+  rs.packets = calloc(REPLAY_CHUNK, packet_size ? packet_size : 1);
+  printf("%-48s %8s %8s %17s %17s %17s %8s %8s %6s\n", "packet", "frames",
+      "bytes", "walk", "dec", "enc", "allocs", "alloc'd", "failed");
+  printf("%-48s %8s %8s", "", "", "");
+  for(int i = 0; i < 3; i++)
+    printf(" %8s %8s", "ns/op", "MB/s");
+  printf("\n");
+  for(int s = 0; s < states; s++) {
+    for(int d = 0; d < 2; d++) {
+      for(int32_t id = 0; id < max_ids[s][d]; id++) {
+        size_t t = first[s * 2 + d] + id;
+        if(!stats[t].frames)
+          continue;
+        rs.funcs = lookup(s, d, id);
+        for(size_t pass = 0; pass < passes; pass++) {
+          for(size_t i = start[t]; i < start[t + 1]; i += REPLAY_CHUNK) {
+            size_t n = start[t + 1] - i;
+            n = n > REPLAY_CHUNK ? REPLAY_CHUNK : n;
+            for(size_t j = 0; j < n; j++)
+              mc_capture_get(&capture, order[i + j], &rs.frames[j]);
+            replay_chunk(&rs, n, &stats[t], !pass);
+          }
+        }
+        size_t ops = stats[t].frames * passes;
+        size_t total = stats[t].bytes * passes;
+        printf("%-48s %8zu %8.1f", strings[s][d][id], stats[t].frames,
+            (double) stats[t].bytes / stats[t].frames);
+        replay_print(stats[t].walk_ns, ops, total);
+        replay_print(stats[t].dec_ns, ops, total);
+        replay_print(stats[t].enc_ns, ops, total);
+        printf(" %8.1f %8.1f %6zu\n",
+            (double) stats[t].allocs / stats[t].frames,
+            (double) stats[t].allocated / stats[t].frames, stats[t].failed);
+      }
+    }
+  }
+
+  // Everything again in capture order, the way a connection would see it
+  uint64_t ns = 0;
+  for(size_t pass = 0; pass < passes; pass++) {
+    size_t n = 0;
+    uint64_t begin = replay_now();
+    for(size_t i = 0; i < capture.count; i++) {
+      if(type_of[i] == types)
+        continue;
+      mc_capture_get(&capture, i, &frame);
+      const mc_packet_funcs *funcs = lookup(frame.state, frame.direction,
+          frame.id);
+      if(funcs->walk(frame.data, frame.len) == (int) frame.len &&
+          funcs->dec(rs.packets, frame.data, frame.len, &rs.arena) &&
+          funcs->size(rs.packets) <= rs.scratch_len)
+        funcs->enc(rs.scratch, rs.packets);
+      if(++n == REPLAY_CHUNK) {
+        mc_arena_reset(&rs.arena);
+        n = 0;
+      }
+    }
+    mc_arena_reset(&rs.arena);
+    ns += replay_now() - begin;
+  }
+  printf("%-48s %8zu %8.1f", "in order, walk + dec + enc", frames,
+      frames ? (double) bytes / frames : 0);
+  replay_print(ns, frames * passes, bytes * passes);
+  printf("\n");
+  if(skipped)
+    printf("%zu frames skipped, unknown or without fields\n", skipped);
+
+  mc_arena_free(&rs.arena);
+  free(rs.packets);
+  free(rs.scratch);
+  free(fill);
+  free(order);
+  free(stats);
+  free(start);
+  free(type_of);
+  free(first);
+  mc_capture_close(&capture);
+  return 0;
+}
@@ -4,10 +4,17 @@
 #include "cNBT/nbt.h"
 #include "datautils.h"
 #include "sds.h"
+#include <limits.h>
+#include <stdalign.h>
 #include <stdbool.h>
+#include <stddef.h>
 #include <stdint.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
+#if defined(__BMI2__) || defined(__SSE2__)
+#include <x86intrin.h>
+#endif
 
 // 2^30, when we need a max_len but we're sure we wont overflow
 // What we really need is an "unsafe" version of functions we're passing this
@@ -16,6 +23,105 @@
 
 // Warning: Some deeply monotonous code is in this file.
 
+struct mc_arena_block {
+  mc_arena_block *next;
+  size_t size;
+  size_t used;
+  max_align_t data[];
+};
+
+#define ARENA_ALIGN(x) \
+  (((x) + alignof(max_align_t) - 1) & ~(alignof(max_align_t) - 1))
+
+void mc_arena_init(mc_arena *arena, size_t block_size) {
+  arena->first = arena->cur = NULL;
+  arena->block_size = block_size ? block_size : MC_ARENA_BLOCK_SIZE;
+  arena->allocs = arena->allocated = 0;
+}
+
+void *mc_arena_alloc(mc_arena *arena, size_t size) {
+  size = ARENA_ALIGN(size);
+  mc_arena_block *block = arena->cur;
+  // Blocks past cur are left over from before the last reset, reuse any that
+  // are big enough before asking malloc for another one
+  while(block && block->size - block->used < size) {
+    if(!block->next)
+      break;
+    block = block->next;
+    block->used = 0;
+  }
+  if(!block || block->size - block->used < size) {
+    size_t block_size = size > arena->block_size ? size : arena->block_size;
+    mc_arena_block *new = malloc(sizeof(*new) + block_size);
+    if(!new)
+      return NULL;
+    new->next = NULL;
+    new->size = block_size;
+    new->used = 0;
+    if(block)
+      block->next = new;
+    else
+      arena->first = new;
+    block = new;
+  }
+  arena->cur = block;
+  void *ret = (char *)block->data + block->used;
+  block->used += size;
+  arena->allocs++;
+  arena->allocated += size;
+  return ret;
+}
+
+void mc_arena_reset(mc_arena *arena) {
+  arena->cur = arena->first;
+  if(arena->first)
+    arena->first->used = 0;
+}
+
+void mc_arena_free(mc_arena *arena) {
+  mc_arena_block *next;
+  for(mc_arena_block *block = arena->first; block; block = next) {
+    next = block->next;
+    free(block);
+  }
+  arena->first = arena->cur = NULL;
+}
+
+void *mc_alloc(mc_arena *arena, size_t size) {
+  if(arena)
+    return mc_arena_alloc(arena, size);
+  return malloc(size);
+}
+
+void *mc_calloc(mc_arena *arena, size_t count, size_t size) {
+  if(!arena)
+    return calloc(count, size);
+  if(size && count > SIZE_MAX / size)
+    return NULL;
+  void *ret = mc_arena_alloc(arena, count * size);
+  if(ret)
+    memset(ret, 0, count * size);
+  return ret;
+}
+
+// Adapters to hand arenas to sds and cNBT
+static void *arena_alloc_cb(void *ctx, size_t size) {
+  return mc_arena_alloc(ctx, size);
+}
+
+static sds arena_sdsnewlen(const void *init, size_t len, mc_arena *arena) {
+  if(arena)
+    return sdsnewlenwith(init, len, arena_alloc_cb, arena);
+  return sdsnewlen(init, len);
+}
+
+static nbt_node *arena_nbt_parse(char **source, size_t len, mc_arena *arena) {
+  if(!arena)
+    return nbt_parse2(source, len);
+  nbt_allocator allocator = {arena_alloc_cb, arena};
+  return nbt_parse_with(source, len, &allocator);
+}
+
 // ProtoDef Numeric Types
 char *enc_byte(char *dest, uint8_t source) {
   *dest = source;
@@ -135,13 +241,103 @@ char *dec_lef64(double *dest, char *source) {
   return source + sizeof(*dest);
 }
 
+// Bulk numerics, the loops are kept simple enough for the compiler to
+// vectorize the byteswaps
+char *enc_bytes(char *dest, uint8_t *source, size_t count) {
+  memcpy(dest, source, count);
+  return dest + count;
+}
+
+char *dec_bytes(uint8_t *dest, size_t count, char *source) {
+  memcpy(dest, source, count);
+  return source + count;
+}
+
+char *enc_be16s(char *dest, uint16_t *source, size_t count) {
+  for(size_t i = 0; i < count; i++)
+    memcpy(dest + i * sizeof(*source), &(uint16_t){htobe16(source[i])},
+        sizeof(*source));
+  return dest + count * sizeof(*source);
+}
+
+char *dec_be16s(uint16_t *dest, size_t count, char *source) {
+  memcpy(dest, source, count * sizeof(*dest));
+  for(size_t i = 0; i < count; i++)
+    dest[i] = be16toh(dest[i]);
+  return source + count * sizeof(*dest);
+}
+
+char *enc_be32s(char *dest, uint32_t *source, size_t count) {
+  for(size_t i = 0; i < count; i++)
+    memcpy(dest + i * sizeof(*source), &(uint32_t){htobe32(source[i])},
+        sizeof(*source));
+  return dest + count * sizeof(*source);
+}
+
+char *dec_be32s(uint32_t *dest, size_t count, char *source) {
+  memcpy(dest, source, count * sizeof(*dest));
+  for(size_t i = 0; i < count; i++)
+    dest[i] = be32toh(dest[i]);
+  return source + count * sizeof(*dest);
+}
+
+char *enc_be64s(char *dest, uint64_t *source, size_t count) {
+  for(size_t i = 0; i < count; i++)
+    memcpy(dest + i * sizeof(*source), &(uint64_t){htobe64(source[i])},
+        sizeof(*source));
+  return dest + count * sizeof(*source);
+}
+
+char *dec_be64s(uint64_t *dest, size_t count, char *source) {
+  memcpy(dest, source, count * sizeof(*dest));
+  for(size_t i = 0; i < count; i++)
+    dest[i] = be64toh(dest[i]);
+  return source + count * sizeof(*dest);
+}
+
+char *enc_bef32s(char *dest, float *source, size_t count) {
+  for(size_t i = 0; i < count; i++) {
+    uint32_t n;
+    memcpy(&n, &source[i], sizeof(n));
+    memcpy(dest + i * sizeof(n), &(uint32_t){htobe32(n)}, sizeof(n));
+  }
+  return dest + count * sizeof(*source);
+}
+
+char *dec_bef32s(float *dest, size_t count, char *source) {
+  for(size_t i = 0; i < count; i++) {
+    uint32_t n;
+    memcpy(&n, source + i * sizeof(n), sizeof(n));
+    memcpy(&dest[i], &(uint32_t){be32toh(n)}, sizeof(n));
+  }
+  return source + count * sizeof(*dest);
+}
+
+char *enc_bef64s(char *dest, double *source, size_t count) {
+  for(size_t i = 0; i < count; i++) {
+    uint64_t n;
+    memcpy(&n, &source[i], sizeof(n));
+    memcpy(dest + i * sizeof(n), &(uint64_t){htobe64(n)}, sizeof(n));
+  }
+  return dest + count * sizeof(*source);
+}
+
+char *dec_bef64s(double *dest, size_t count, char *source) {
+  for(size_t i = 0; i < count; i++) {
+    uint64_t n;
+    memcpy(&n, source + i * sizeof(n), sizeof(n));
+    memcpy(&dest[i], &(uint64_t){be64toh(n)}, sizeof(n));
+  }
+  return source + count * sizeof(*dest);
+}
+
 char *enc_buffer(char *dest, mc_buffer source) {
   memcpy(dest, source.base, source.len);
   return dest + source.len;
 }
 
-char *dec_buffer(mc_buffer *dest, char *source, size_t len) {
-  if(!(dest->base = malloc(len)))
+char *dec_buffer(mc_buffer *dest, char *source, size_t len, mc_arena *arena) {
+  if(!(dest->base = mc_alloc(arena, len)))
     return NULL;
   dest->len = len;
   memcpy(dest->base, source, len);
@@ -150,24 +346,86 @@ char *dec_buffer(mc_buffer *dest, char *source, size_t len) {
 
 void free_buffer(mc_buffer buffer) { free(buffer.base); }
 
+char *dec_bufview(mc_buffer *dest, char *source, size_t len) {
+  dest->base = source;
+  dest->len = len;
+  return source + len;
+}
+
 // size_ functions let you know how big a type structure is going to be whe
 // its encoded into a memory buffer
 // walk_ functions let you know how big a currently encoded type is, and
 // will error if the type is invalid, they can't complete the walk, or max_len
 // doesn't have enough room for the calculated size
+// Varints and varlongs are the most common thing on the wire, so whenever 8
+// bytes are known to be readable they're handled a word at a time: the
+// terminator is the first byte with its high bit clear, found with a ctz, and
+// the 7-bit groups are squashed together with PEXT or the shift cascade in
+// varnum_extract. Anything shorter than 8 bytes takes the byte-wise loop.
+#define VARNUM_MSBS 0x8080808080808080ULL
+
+static inline uint64_t load_le64(const char *source) {
+  uint64_t word;
+  memcpy(&word, source, sizeof(word));
+  return le64toh(word);
+}
+
+// Length of the varnum at the start of word, 0 if it's longer than 8 bytes
+static inline int varnum_len(uint64_t word) {
+  uint64_t stops = ~word & VARNUM_MSBS;
+  if(!stops)
+    return 0;
+  return __builtin_ctzll(stops) / 8 + 1;
+}
+
+// Value of the len byte varnum at the start of word
+static inline uint64_t varnum_extract(uint64_t word, int len) {
+  word &= ~0ULL >> (64 - len * 8);
+#ifdef __BMI2__
+  return _pext_u64(word, ~VARNUM_MSBS);
+#else
+  word &= ~VARNUM_MSBS;
+  word = ((word & 0x7F007F007F007F00ULL) >> 1) |
+      (word & 0x007F007F007F007FULL);
+  word = ((word & 0x3FFF00003FFF0000ULL) >> 2) |
+      (word & 0x00003FFF00003FFFULL);
+  return ((word & 0x0FFFFFFF00000000ULL) >> 4) |
+      (word & 0x000000000FFFFFFFULL);
+#endif
+}
+
+// Number of leading single byte varnums in source, up to max. Arrays of
+// varnums are mostly small values, so the bulk functions copy these runs
+// straight out 16 (SSE2) or 8 bytes at a time
+static size_t varnum_short_run(const char *source, size_t max) {
+  size_t run = 0;
+#ifdef __SSE2__
+  for(; max - run >= 16; run += 16) {
+    int mask = _mm_movemask_epi8(
+        _mm_loadu_si128((const __m128i *)(source + run)));
+    if(mask)
+      return run + __builtin_ctz(mask);
+  }
+#endif
+  for(; max - run >= 8; run += 8) {
+    uint64_t mask = load_le64(source + run) & VARNUM_MSBS;
+    if(mask)
+      return run + __builtin_ctzll(mask) / 8;
+  }
+  for(; run < max && !(source[run] & 0x80); run++)
+    ;
+  return run;
+}
+
 size_t size_varint(uint32_t varint) {
-  if(varint < (1 << 7))
-    return 1;
-  if(varint < (1 << 14))
-    return 2;
-  if(varint < (1 << 21))
-    return 3;
-  if(varint < (1 << 28))
-    return 4;
-  return 5;
+  return 1 + (31 - __builtin_clz(varint | 1)) / 7;
 }
 
 int walk_varint(char *source, size_t max_len) {
+  if(max_len >= sizeof(uint64_t)) {
+    int len = varnum_len(load_le64(source));
+    return len && len <= 5 ? len : varnum_invalid;
+  }
   if(!max_len)
     return varnum_overrun;
   int len = 1;
@@ -180,6 +438,23 @@ int walk_varint(char *source, size_t max_len) {
   return len;
 }
 
+int walk_varints(char *source, size_t count, size_t max_len) {
+  char *start = source;
+  char *end = source + max_len;
+  for(;;) {
+    size_t run = varnum_short_run(source, count < (size_t)(end - source) ?
+        count : (size_t)(end - source));
+    source += run;
+    if(!(count -= run))
+      return source - start;
+    int ret = walk_varint(source, end - source);
+    if(ret < 0)
+      return ret;
+    source += ret;
+    count--;
+  }
+}
+
 char *enc_varint(char *dest, uint32_t source) {
   for(; source >= 0x80; dest++, source >>= 7) {
     *dest = 0x80 | (source & 0x7F);
@@ -192,42 +467,68 @@ char *dec_varint(int32_t *dest, char *source) {
   *dest = 0;
   int i = 0;
   for(; *(unsigned char *)source & 0x80; source++, i+=7) {
-    *(uint32_t *)dest |= (*source & 0x7F) << i;
+    *(uint32_t *)dest |= (uint32_t)(*source & 0x7F) << i;
   }
-  *(uint32_t *)dest |= (*source & 0x7F) << i;
+  *(uint32_t *)dest |= (uint32_t)(*source & 0x7F) << i;
   return ++source;
 }
 
+char *dec_checked_varint(int32_t *dest, char *source, size_t max_len) {
+  if(max_len >= sizeof(uint64_t)) {
+    uint64_t word = load_le64(source);
+    int len = varnum_len(word);
+    if(!len || len > 5)
+      return NULL;
+    *dest = (int32_t)(uint32_t)varnum_extract(word, len);
+    return source + len;
+  }
+  uint32_t val = 0;
+  for(size_t i = 0; i < 5 && i < max_len; i++) {
+    val |= (uint32_t)(source[i] & 0x7F) << (7 * i);
+    if(!(source[i] & 0x80)) {
+      *dest = (int32_t)val;
+      return source + i + 1;
+    }
+  }
+  return NULL;
+}
+
+char *dec_checked_varints(int32_t *dest, size_t count, char *source,
+    size_t max_len) {
+  char *end = source + max_len;
+  for(;;) {
+    size_t run = varnum_short_run(source, count < (size_t)(end - source) ?
+        count : (size_t)(end - source));
+    for(size_t i = 0; i < run; i++)
+      dest[i] = (unsigned char)source[i];
+    dest += run;
+    source += run;
+    if(!(count -= run))
+      return source;
+    if(!(source = dec_checked_varint(dest++, source, end - source)))
+      return NULL;
+    count--;
+  }
+}
+
 // Everything past this point isn't part of ProtoDef, just minecraft
 
 size_t size_varlong(uint64_t varint) {
-  if(varint < (1 << 7))
-    return 1;
-  if(varint < (1 << 14))
-    return 2;
-  if(varint < (1 << 21))
-    return 3;
-  if(varint < (1 << 28))
-    return 4;
-  if(varint < (1ULL << 35))
-    return 5;
-  if(varint < (1ULL << 42))
-    return 6;
-  if(varint < (1ULL << 49))
-    return 7;
-  if(varint < (1ULL << 56))
-    return 8;
-  if(varint < (1ULL << 63))
-    return 9;
-  return 10;
+  return 1 + (63 - __builtin_clzll(varint | 1)) / 7;
 }
 
+// Nine and ten byte varlongs (only negative numbers) are left to the loop
 int walk_varlong(char *source, size_t max_len) {
+  if(max_len >= sizeof(uint64_t)) {
+    int len = varnum_len(load_le64(source));
+    if(len)
+      return len;
+  }
   if(!max_len)
     return varnum_overrun;
   int len = 1;
   for(; *(unsigned char *)source & 0x80; source++, len++) {
-    if(len > 8)
+    if(len > 9)
       return varnum_invalid;
     if((size_t)len >= max_len)
       return varnum_overrun;
@@ -235,6 +536,23 @@ int walk_varlong(char *source, size_t max_len) {
   return len;
 }
 
+int walk_varlongs(char *source, size_t count, size_t max_len) {
+  char *start = source;
+  char *end = source + max_len;
+  for(;;) {
+    size_t run = varnum_short_run(source, count < (size_t)(end - source) ?
+        count : (size_t)(end - source));
+    source += run;
+    if(!(count -= run))
+      return source - start;
+    int ret = walk_varlong(source, end - source);
+    if(ret < 0)
+      return ret;
+    source += ret;
+    count--;
+  }
+}
+
 char *enc_varlong(char *dest, uint64_t source) {
   for(; source >= 0x80; dest++, source >>= 7) {
     *dest = 0x80 | (source & 0x7F);
@@ -247,12 +565,50 @@ char *dec_varlong(int64_t *dest, char *source) {
   *dest = 0;
   int i = 0;
   for(; *(unsigned char *)source & 0x80; source++, i+=7) {
-    *(uint64_t *)dest |= (*source & 0x7F) << i;
+    *(uint64_t *)dest |= (uint64_t)(*source & 0x7F) << i;
   }
-  *(uint64_t *)dest |= (*source & 0x7F) << i;
+  *(uint64_t *)dest |= (uint64_t)(*source & 0x7F) << i;
   return ++source;
 }
 
+char *dec_checked_varlong(int64_t *dest, char *source, size_t max_len) {
+  if(max_len >= sizeof(uint64_t)) {
+    uint64_t word = load_le64(source);
+    int len = varnum_len(word);
+    if(len) {
+      *dest = (int64_t)varnum_extract(word, len);
+      return source + len;
+    }
+  }
+  uint64_t val = 0;
+  for(size_t i = 0; i < 10 && i < max_len; i++) {
+    val |= (uint64_t)(source[i] & 0x7F) << (7 * i);
+    if(!(source[i] & 0x80)) {
+      *dest = (int64_t)val;
+      return source + i + 1;
+    }
+  }
+  return NULL;
+}
+
+char *dec_checked_varlongs(int64_t *dest, size_t count, char *source,
+    size_t max_len) {
+  char *end = source + max_len;
+  for(;;) {
+    size_t run = varnum_short_run(source, count < (size_t)(end - source) ?
+        count : (size_t)(end - source));
+    for(size_t i = 0; i < run; i++)
+      dest[i] = (unsigned char)source[i];
+    dest += run;
+    source += run;
+    if(!(count -= run))
+      return source;
+    if(!(source = dec_checked_varlong(dest++, source, end - source)))
+      return NULL;
+    count--;
+  }
+}
+
 // Varint prefixed string
 size_t size_string(sds string) {
   return size_varint(sdslen(string)) + sdslen(string);
@@ -264,8 +620,10 @@ int walk_string(char *source, size_t max_len) {
     return ret;
   int32_t len;
   dec_varint(&len, source);
+  if(len < 0)
+    return varnum_invalid;
   if(max_len < (size_t)ret + len)
-    return -1;
+    return varnum_overrun;
   return ret + len;
 }
 
@@ -274,13 +632,89 @@ char *enc_string(char *dest, sds source) {
   return (char *)memcpy(enc_varint(dest, len), source, len) + len;
 }
 
-char *dec_string(sds *dest, char *source) {
+char *dec_string(sds *dest, char *source, mc_arena *arena) {
   int32_t len;
   source = dec_varint(&len, source);
-  *dest = sdsnewlen(source, (size_t)len);
+  *dest = arena_sdsnewlen(source, (size_t)len, arena);
+  return source + len;
+}
+
+char *dec_checked_string(sds *dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  int32_t len;
+  char *end = source + max_len;
+  *dest = NULL;
+  if(!(source = dec_checked_varint(&len, source, max_len)))
+    return NULL;
+  if(len < 0 || end - source < len)
+    return NULL;
+  if(!(*dest = arena_sdsnewlen(source, (size_t)len, arena)))
+    return NULL;
+  return source + len;
+}
+
+size_t size_strview(mc_strview string) {
+  return size_varint((uint32_t)string.len) + string.len;
+}
+
+char *enc_strview(char *dest, mc_strview source) {
+  dest = enc_varint(dest, (uint32_t)source.len);
+  return (char *)memcpy(dest, source.base, source.len) + source.len;
+}
+
+char *dec_strview(mc_strview *dest, char *source) {
+  int32_t len;
+  source = dec_varint(&len, source);
+  dest->base = source;
+  dest->len = (size_t)len;
+  return source + len;
+}
+
+char *dec_checked_strview(mc_strview *dest, char *source, size_t max_len) {
+  int32_t len;
+  char *end = source + max_len;
+  dest->base = NULL;
+  dest->len = 0;
+  if(!(source = dec_checked_varint(&len, source, max_len)))
+    return NULL;
+  if(len < 0 || end - source < len)
+    return NULL;
+  dest->base = source;
+  dest->len = (size_t)len;
   return source + len;
 }
 
+uint32_t mc_strhash(const char *str, size_t len, uint32_t seed) {
+  uint32_t hash = 0x811C9DC5 ^ seed;
+  for(size_t i = 0; i < len; i++)
+    hash = (hash ^ (unsigned char) str[i]) * 0x01000193;
+  return hash;
+}
+
+int mc_strswitch(const char *str, size_t len, uint32_t seed,
+    const char *const *slots, uint32_t mask) {
+  uint32_t slot = mc_strhash(str, len, seed) & mask;
+  const char *key = slots[slot];
+  if(!key || strlen(key) != len || memcmp(key, str, len))
+    return -1;
+  return slot;
+}
+
+//Multiply and fold the high half back down, so every bit of val reaches the
+//low bits the frame cache picks buckets with
+uint64_t mc_hash_u64(uint64_t hash, uint64_t val) {
+  hash = (hash ^ val) * 0x9E3779B97F4A7C15ULL;
+  return hash ^ (hash >> 32);
+}
+
+uint64_t mc_hash_bytes(uint64_t hash, const void *data, size_t len) {
+  const unsigned char *bytes = data;
+  hash = mc_hash_u64(hash, len);
+  for(size_t i = 0; i < len; i++)
+    hash = (hash ^ bytes[i]) * 0x100000001B3ULL;
+  return mc_hash_u64(hash, 0);
+}
+
 // Big Endian 128-bit uint
 char *enc_uuid(char *dest, mc_uuid source) {
   return enc_be64(enc_be64(dest, source.msb), source.lsb);
@@ -311,7 +745,8 @@ char *dec_position(mc_position *dest, char *source) {
 }
 
 size_t size_nbt_list(nbt_node *node) {
-  size_t size = 0;
+  // Element type and count
+  size_t size = sizeof(uint8_t) + sizeof(int32_t);
   struct list_head *pos;
   list_for_each(pos, &node->payload.tag_list->entry) {
     size += size_unnamed_nbt(list_entry(pos, struct nbt_list, entry)->data);
@@ -349,7 +784,7 @@ size_t size_unnamed_nbt(nbt_node *node) {
     case TAG_DOUBLE:
       return sizeof(double);
     case TAG_BYTE_ARRAY:
-      return sizeof(int32_t) + node->payload.tag_int_array.length;
+      return sizeof(int32_t) + node->payload.tag_byte_array.length;
     case TAG_INT_ARRAY:
       return sizeof(int32_t) +
              node->payload.tag_int_array.length * sizeof(int32_t);
@@ -379,20 +814,22 @@ size_t size_nbt(nbt_node *nbt) {
 int walk_nbt_string(char *source, size_t max_len) {
   uint16_t len;
   if(max_len < sizeof(len))
-    return -1;
+    return varnum_overrun;
   dec_be16(&len, source);
   if(max_len < sizeof(len) + len)
-    return -1;
+    return varnum_overrun;
   return sizeof(len) + len;
 }
 
 int walk_nbt_array(char *source, size_t max_len, size_t type_len) {
   uint32_t len;
   if(max_len < sizeof(len))
-    return -1;
+    return varnum_overrun;
   dec_be32(&len, source);
+  if(len > (INT_MAX - sizeof(len)) / type_len)
+    return varnum_invalid;
   if(max_len < sizeof(len) + (len * type_len))
-    return -1;
+    return varnum_overrun;
   return sizeof(len) + (len * type_len);
 }
 
@@ -401,14 +838,15 @@ int walk_nbt_list(char *source, size_t max_len) {
   int32_t count;
   int size = sizeof(type) + sizeof(count);
   if(max_len < (size_t)size)
-    return -1;
+    return varnum_overrun;
   source = dec_byte(&type, source);
   source = dec_be32((uint32_t *)&count, source);
+  max_len -= size;
   for(int i = 0, step; i < count;
        i++, source += step, max_len -= step, size += step) {
     step = walk_unnamed_nbt(source, type, max_len);
     if(step < 0)
-      return -1;
+      return step;
   }
   return size;
 }
@@ -417,19 +855,19 @@ int walk_nbt_compound(char *source, size_t max_len) {
   for(int tag_size, total_size = 0;;
        source += tag_size, total_size += tag_size, max_len -= tag_size) {
     if(!max_len)
-      return -1;
+      return varnum_overrun;
     uint8_t type;
     source = dec_byte(&type, source);
     total_size += sizeof(type);
     if(!type)
       return total_size;
     if((tag_size = walk_nbt_string(source, --max_len)) < 0)
-      return -1;
+      return tag_size;
     source += tag_size;
     total_size += tag_size;
     max_len -= tag_size;
     if((tag_size = walk_unnamed_nbt(source, type, max_len)) < 0)
-      return -1;
+      return tag_size;
   }
 }
 
@@ -455,77 +893,83 @@ int walk_unnamed_nbt(char *source, nbt_type type, size_t max_len) {
     size = sizeof(double);
     break;
   case TAG_BYTE_ARRAY:
-    if((size = walk_nbt_array(source, max_len, sizeof(char))) < 0)
-      return -1;
+    size = walk_nbt_array(source, max_len, sizeof(char));
     break;
   case TAG_INT_ARRAY:
-    if((size = walk_nbt_array(source, max_len, sizeof(int32_t))) < 0)
-      return -1;
+    size = walk_nbt_array(source, max_len, sizeof(int32_t));
     break;
   case TAG_LONG_ARRAY:
-    if((size = walk_nbt_array(source, max_len, sizeof(int64_t))) < 0)
-      return -1;
+    size = walk_nbt_array(source, max_len, sizeof(int64_t));
     break;
   case TAG_STRING:
-    if((size = walk_nbt_string(source, max_len)) < 0)
-      return -1;
+    size = walk_nbt_string(source, max_len);
     break;
   case TAG_LIST:
-    if((size = walk_nbt_list(source, max_len)) < 0)
-      return -1;
+    size = walk_nbt_list(source, max_len);
     break;
   case TAG_COMPOUND:
-    if((size = walk_nbt_compound(source, max_len)) < 0)
-      return -1;
+    size = walk_nbt_compound(source, max_len);
     break;
   default:
-    return -1;
+    return varnum_invalid;
   }
+  if(size < 0)
+    return size;
   if(max_len < (size_t)size)
-    return -1;
+    return varnum_overrun;
   return size;
 }
 
 int walk_nbt(char *source, size_t max_len) {
   if(!max_len)
-    return -1;
+    return varnum_overrun;
   uint8_t type;
   int size, total = sizeof(type);
   source = dec_byte(&type, source);
   if((size = walk_nbt_string(source, --max_len)) < 0)
-    return -1;
+    return size;
   source += size;
   total += size;
   max_len -= size;
   if((size = walk_unnamed_nbt(source, type, max_len)) < 0)
-    return -1;
+    return size;
   return total + size;
 }
 
-// TODO: Need a nbt_dump_to_buffer method so we don't allocate memory or risk
-// failure here. Our own dest buffer should be big enough based on size_
-// functions so there is really no excuse for an encode to fail.
+// dest is big enough based on size_ functions, so this only fails on trees
+// cNBT can't represent, ie: heterogeneous lists. Then dest comes back as is
+// rather than NULL, enc_ functions chain the result into further writes
 char *enc_nbt(char *dest, nbt_node *source) {
-  struct buffer b = nbt_dump_binary(source);
-  memcpy(dest, b.data, b.len);
-  free(b.data);
-  return dest + b.len;
+  return dest + nbt_dump_binary_to(source, dest, NO_OVERFLOW);
 }
 
-char *dec_nbt(nbt_node **dest, char *source) {
+char *dec_nbt(nbt_node **dest, char *source, mc_arena *arena) {
   // nbt_parse2 is a stupid hack I kludged in order to pass char** to cNBT and
   // advance our source pointer appropriately. Also, max_len shouldn't be
   // a thing since we require the nbt to be walked before parsing.
-  if(!(*dest = nbt_parse2(&source, NO_OVERFLOW)))
+  if(!(*dest = arena_nbt_parse(&source, NO_OVERFLOW, arena)))
     return NULL;
   return source;
 }
 
+// cNBT bounds checks everything it reads, so parsing with the real max_len is
+// already a checked decode
+char *dec_checked_nbt(nbt_node **dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  if(!(*dest = arena_nbt_parse(&source, max_len, arena)))
+    return NULL;
+  return source;
+}
+
+// Absent is a single TAG_End byte, anything else has to be a compound like
+// vanilla reads it
 int walk_optnbt(char *source, size_t max_len) {
   if(!max_len)
-    return -1;
-  if(*source != TAG_COMPOUND)
+    return varnum_overrun;
+  if(*source == TAG_INVALID)
     return sizeof(*source);
+  if(*source != TAG_COMPOUND)
+    return varnum_invalid;
   return walk_nbt(source, max_len);
 }
 
@@ -541,18 +985,104 @@ char *enc_optnbt(char *dest, nbt_node *source) {
   return enc_nbt(dest, source);
 }
 
-char *dec_optnbt(nbt_node **dest, char *source) {
+char *dec_optnbt(nbt_node **dest, char *source, mc_arena *arena) {
   if(*source != TAG_COMPOUND) {
     *dest = NULL;
     return ++source;
   }
-  return dec_nbt(dest, source);
+  return dec_nbt(dest, source, arena);
+}
+
+char *dec_checked_optnbt(nbt_node **dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  *dest = NULL;
+  if(!max_len)
+    return NULL;
+  if(*source == TAG_INVALID)
+    return ++source;
+  if(*source != TAG_COMPOUND)
+    return NULL;
+  return dec_checked_nbt(dest, source, max_len, arena);
+}
+
+// Walking already validated the span, so parsing it can only run out of memory
+nbt_node *get_lazynbt(mc_lazy_nbt *nbt) {
+  if(!nbt->node && nbt->len > 1) {
+    char *source = nbt->base;
+    nbt->node = arena_nbt_parse(&source, nbt->len, nbt->arena);
+  }
+  return nbt->node;
+}
+
+size_t size_lazynbt(mc_lazy_nbt nbt) {
+  if(nbt.node)
+    return size_nbt(nbt.node);
+  return nbt.len ? nbt.len : sizeof(char);
+}
+
+char *enc_lazynbt(char *dest, mc_lazy_nbt source) {
+  if(source.node)
+    return enc_nbt(dest, source.node);
+  if(!source.len)
+    return enc_byte(dest, 0);
+  memcpy(dest, source.base, source.len);
+  return dest + source.len;
+}
+
+static char *lazynbt_span(mc_lazy_nbt *dest, char *source, int len,
+    mc_arena *arena) {
+  dest->node = NULL;
+  dest->arena = arena;
+  if(len < 0) {
+    dest->base = NULL;
+    dest->len = 0;
+    return NULL;
+  }
+  dest->base = source;
+  dest->len = len;
+  return source + len;
+}
+
+char *dec_lazynbt(mc_lazy_nbt *dest, char *source, mc_arena *arena) {
+  return lazynbt_span(dest, source, walk_nbt(source, NO_OVERFLOW), arena);
+}
+
+char *dec_checked_lazynbt(mc_lazy_nbt *dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  return lazynbt_span(dest, source, walk_nbt(source, max_len), arena);
+}
+
+char *dec_lazyoptnbt(mc_lazy_nbt *dest, char *source, mc_arena *arena) {
+  return lazynbt_span(dest, source, walk_optnbt(source, NO_OVERFLOW), arena);
+}
+
+char *dec_checked_lazyoptnbt(mc_lazy_nbt *dest, char *source,
+    size_t max_len, mc_arena *arena) {
+  return lazynbt_span(dest, source, walk_optnbt(source, max_len), arena);
+}
+
+void free_lazynbt(mc_lazy_nbt nbt) {
+  if(!nbt.arena)
+    nbt_free(nbt.node);
 }
 
-// Inventory slot
+// Inventory slot, the item id then if there is an item its count, damage and
+// optional nbt
 int walk_slot(char *source, size_t max_len) {
-  // TO BE IMPLEMENTED FOR 1.8
-  return -1;
+  int16_t item;
+  if(max_len < sizeof(item))
+    return varnum_overrun;
+  source = dec_be16((uint16_t *)&item, source);
+  if(item == -1)
+    return sizeof(item);
+  size_t size = sizeof(item) + ssizeof(mc_slot, count) +
+      ssizeof(mc_slot, damage);
+  if(max_len < size)
+    return varnum_overrun;
+  int ret = walk_optnbt(source + size - sizeof(item), max_len - size);
+  if(ret < 0)
+    return ret;
+  return size + ret;
 }
 
 size_t size_slot(mc_slot slot) {
@@ -583,15 +1113,71 @@ char *enc_slot(char *dest, mc_slot source) {
 }
 
 // dec_nbt allocates memory, this can fail and return NULL
-char *dec_slot(mc_slot *dest, char *source) {
-  // TO BE IMPLEMENTED FOR 1.8
-  return NULL;
+char *dec_slot(mc_slot *dest, char *source, mc_arena *arena) {
+  dest->nbt = NULL;
+  source = dec_be16((uint16_t *)&dest->item, source);
+  if(dest->item == -1)
+    return source;
+  source = dec_byte(&dest->count, source);
+  source = dec_be16((uint16_t *)&dest->damage, source);
+  return dec_optnbt(&dest->nbt, source, arena);
+}
+
+char *dec_checked_slot(mc_slot *dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  dest->nbt = NULL;
+  if(walk_slot(source, max_len) < 0)
+    return NULL;
+  return dec_slot(dest, source, arena);
 }
 
 void free_slot(mc_slot slot) {
   nbt_free(slot.nbt);
 }
 
+size_t size_lazyslot(mc_lazy_slot slot) {
+  if(slot.item == -1)
+    return sizeof(slot.item);
+  return sizeof(slot.item) + sizeof(slot.count) + sizeof(slot.damage) +
+      size_lazynbt(slot.nbt);
+}
+
+char *enc_lazyslot(char *dest, mc_lazy_slot source) {
+  dest = enc_be16(dest, source.item);
+  if(source.item == -1)
+    return dest;
+  dest = enc_byte(dest, source.count);
+  dest = enc_be16(dest, source.damage);
+  return enc_lazynbt(dest, source.nbt);
+}
+
+char *dec_lazyslot(mc_lazy_slot *dest, char *source, mc_arena *arena) {
+  dest->nbt = (mc_lazy_nbt) {.arena = arena};
+  source = dec_be16((uint16_t *)&dest->item, source);
+  if(dest->item == -1)
+    return source;
+  source = dec_byte(&dest->count, source);
+  source = dec_be16((uint16_t *)&dest->damage, source);
+  return dec_lazyoptnbt(&dest->nbt, source, arena);
+}
+
+char *dec_checked_lazyslot(mc_lazy_slot *dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  dest->nbt = (mc_lazy_nbt) {.arena = arena};
+  size_t size = sizeof(dest->item);
+  if(max_len < size)
+    return NULL;
+  source = dec_be16((uint16_t *)&dest->item, source);
+  if(dest->item == -1)
+    return source;
+  size += sizeof(dest->count) + sizeof(dest->damage);
+  if(max_len < size)
+    return NULL;
+  source = dec_byte(&dest->count, source);
+  source = dec_be16((uint16_t *)&dest->damage, source);
+  return dec_checked_lazyoptnbt(&dest->nbt, source, max_len - size, arena);
+}
+
 // Varint prefixed array of slots
 int walk_ingredient(char *source, size_t max_len) {
   int ret = walk_varint(source, max_len);
@@ -601,7 +1187,7 @@ int walk_ingredient(char *source, size_t max_len) {
   max_len -= ret;
   int32_t len;
   source = dec_varint(&len, source);
-  for(int i = 0; i < len; i++, size += ret, max_len -= ret) {
+  for(int i = 0; i < len; i++, source += ret, size += ret, max_len -= ret) {
     if((ret = walk_slot(source, max_len)) < 0)
       return ret;
   }
@@ -624,10 +1210,33 @@ char *enc_ingredient(char *dest, mc_ingredient source) {
   return dest;
 }
 
-char *dec_ingredient(mc_ingredient *dest, char *source) {
+char *dec_ingredient(mc_ingredient *dest, char *source, mc_arena *arena) {
   source = dec_varint(&dest->count, source);
   for(int i = 0; i < dest->count; i++) {
-    if(!(source = dec_slot(&dest->items[i], source)))
+    if(!(source = dec_slot(&dest->items[i], source, arena)))
+      return NULL;
+  }
+  return source;
+}
+
+char *dec_checked_ingredient(mc_ingredient *dest, char *source,
+    size_t max_len, mc_arena *arena) {
+  int32_t count;
+  char *end = source + max_len;
+  dest->count = 0;
+  dest->items = NULL;
+  if(!(source = dec_checked_varint(&count, source, max_len)) || count < 0)
+    return NULL;
+  // Every slot is at least its 2 byte item id, reject counts that can't fit
+  // before allocating for them
+  if((size_t)count > (size_t)(end - source) / 2)
+    return NULL;
+  if(!(dest->items = mc_calloc(arena, count, sizeof(*dest->items))) && count)
+    return NULL;
+  dest->count = count;
+  for(int i = 0; i < count; i++) {
+    if(!(source = dec_checked_slot(&dest->items[i], source, end - source,
+             arena)))
       return NULL;
   }
   return source;
@@ -658,8 +1267,8 @@ int walk_smelting(char *source, size_t max_len) {
   source += ret;
   max_len -= ret;
   if(max_len < ssizeof(mc_smelting, experience))
-    return -1;
-  size += ret;
+    return varnum_overrun;
+  size += ssizeof(mc_smelting, experience);
   source += ssizeof(mc_smelting, experience);
   max_len -= ssizeof(mc_smelting, experience);
   if((ret = walk_varint(source, max_len)) < 0)
@@ -684,14 +1293,33 @@ char *enc_smelting(char *dest, mc_smelting source) {
   return enc_varint(dest, source.cooking_time);
 }
 
-char *dec_smelting(mc_smelting *dest, char *source) {
-  source = dec_string(&dest->group, source);
-  source = dec_ingredient(&dest->ingredient, source);
-  source = dec_slot(&dest->result, source);
+char *dec_smelting(mc_smelting *dest, char *source, mc_arena *arena) {
+  source = dec_string(&dest->group, source, arena);
+  source = dec_ingredient(&dest->ingredient, source, arena);
+  source = dec_slot(&dest->result, source, arena);
   source = dec_bef32(&dest->experience, source);
   return dec_varint(&dest->cooking_time, source);
 }
 
+char *dec_checked_smelting(mc_smelting *dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  char *end = source + max_len;
+  memset(dest, 0, sizeof(*dest));
+  if(!(source = dec_checked_string(&dest->group, source, end - source,
+           arena)))
+    return NULL;
+  if(!(source = dec_checked_ingredient(&dest->ingredient, source,
+           end - source, arena)))
+    return NULL;
+  if(!(source = dec_checked_slot(&dest->result, source, end - source,
+           arena)))
+    return NULL;
+  if(end - source < (ptrdiff_t)sizeof(dest->experience))
+    return NULL;
+  source = dec_bef32(&dest->experience, source);
+  return dec_checked_varint(&dest->cooking_time, source, end - source);
+}
+
 void free_smelting(mc_smelting smelting) {
   free_string(smelting.group);
   free_ingredient(smelting.ingredient);
@@ -701,7 +1329,7 @@ void free_smelting(mc_smelting smelting) {
 int walk_particledata(char *source, size_t max_len, particle_type type) {
   int ret = walk_varint(source, max_len);
   if(ret < 0)
-    return -1;
+    return ret;
   int size = ret;
   source += ret;
   max_len -= ret;
@@ -714,12 +1342,14 @@ int walk_particledata(char *source, size_t max_len, particle_type type) {
       break;
     case particle_dust:
       if(max_len < sizeof(float) * 4)
-        return -1;
+        return varnum_overrun;
       size += sizeof(float) * 4;
+      break;
     case particle_item:
       if((ret = walk_slot(source, max_len)) < 0)
         return ret;
       size += ret;
+      break;
     default:
       // Makes compilers happy
       break;
@@ -761,7 +1391,8 @@ char *enc_particledata(char *dest, mc_particle source) {
   }
 }
 
-char *dec_particledata(mc_particle *dest, char *source, particle_type type) {
+char *dec_particledata(mc_particle *dest, char *source, particle_type type,
+    mc_arena *arena) {
   dest->type = type;
   switch(type) {
     case particle_block:
@@ -775,13 +1406,34 @@ char *dec_particledata(mc_particle *dest, char *source, particle_type type) {
       return dec_bef32(&dest->scale, source);
       break;
     case particle_item:
-      return dec_slot(&dest->item, source);
+      return dec_slot(&dest->item, source, arena);
       break;
     default:
       return source;
   }
 }
 
+char *dec_checked_particledata(mc_particle *dest, char *source, size_t max_len,
+    particle_type type, mc_arena *arena) {
+  dest->type = type;
+  switch(type) {
+    case particle_block:
+    case particle_falling_dust:
+      return dec_checked_varint(&dest->block_state, source, max_len);
+    case particle_dust:
+      if(max_len < sizeof(float) * 4)
+        return NULL;
+      source = dec_bef32(&dest->red, source);
+      source = dec_bef32(&dest->green, source);
+      source = dec_bef32(&dest->blue, source);
+      return dec_bef32(&dest->scale, source);
+    case particle_item:
+      return dec_checked_slot(&dest->item, source, max_len, arena);
+    default:
+      return source;
+  }
+}
+
 void free_particledata(mc_particle particle) {
   if(particle.type == particle_item)
     free_slot(particle.item);
@@ -808,9 +1460,9 @@ char *enc_particle(char *dest, mc_particle source) {
   dest = enc_varint(dest, source.type);
   return enc_particledata(dest, source);
 }
-char *dec_particle(mc_particle *dest, char *source) {
+char *dec_particle(mc_particle *dest, char *source, mc_arena *arena) {
   source = dec_varint(&dest->type, source);
-  return dec_particledata(dest, source, dest->type);
+  return dec_particledata(dest, source, dest->type, arena);
 }
 
 
@@ -820,7 +1472,7 @@ char *dec_particle(mc_particle *dest, char *source) {
 // can side-step this insanity. Raw char * is just asking for pain.
 int walk_metadata(char *source, size_t max_len) {
   // TO BE IMPLEMENTED FOR 1.8
-  return -1;
+  return varnum_invalid;
 }
 
 // TODO: counting metatags takes almost as long as decoding them
@@ -932,11 +1584,21 @@ char *enc_metadata(char *dest, mc_metadata source) {
   return enc_byte(dest, 0x7f);
 }
 
-char *dec_metadata(mc_metadata *dest, char *source) {
+char *dec_metadata(mc_metadata *dest, char *source, mc_arena *arena) {
   // TO BE IMPLEMENTED FOR 1.8
   return NULL;
 }
 
+// Falls back to walk then decode until metadata is implemented for 1.8
+char *dec_checked_metadata(mc_metadata *dest, char *source, size_t max_len,
+    mc_arena *arena) {
+  dest->len = 0;
+  dest->tags = NULL;
+  if(walk_metadata(source, max_len) < 0)
+    return NULL;
+  return dec_metadata(dest, source, arena);
+}
+
 void free_metadata(mc_metadata metadata) {
   for(size_t i = 0; i < metadata.len; i++) {
     switch(metadata.tags[i].type) {
@@ -954,7 +1616,7 @@ void free_metadata(mc_metadata metadata) {
 
 int walk_itemtag_array(char *source, size_t max_len) {
   if(!max_len)
-    return -1;
+    return varnum_overrun;
   int ret = walk_varint(source, max_len);
   if(ret < 0)
     return ret;
@@ -973,10 +1635,13 @@ int walk_itemtag_array(char *source, size_t max_len) {
     max_len -= ret;
     size += ret;
     source = dec_varint(&varint, source);
-    for(int k = 0; k < varint; k++, size += ret, max_len -= ret) {
-      if((ret = walk_varint(source, max_len)) < 0)
-        return ret;
-    }
+    if(varint < 0)
+      return varnum_invalid;
+    if((ret = walk_varints(source, varint, max_len)) < 0)
+      return ret;
+    max_len -= ret;
+    source += ret;
+    size += ret;
   }
   return size;
 }
@@ -1005,15 +1670,16 @@ char *enc_itemtag_array(char *dest, mc_itemtag_array source) {
   return dest;
 }
 
-char *dec_itemtag_array(mc_itemtag_array *dest, char *source) {
+char *dec_itemtag_array(mc_itemtag_array *dest, char *source,
+    mc_arena *arena) {
   source = dec_varint(&dest->len, source);
-  if(!(dest->tags = malloc(dest->len * sizeof(*dest->tags))))
+  if(!(dest->tags = mc_alloc(arena, dest->len * sizeof(*dest->tags))))
     return NULL;
   for(int i = 0; i < dest->len; i++) {
-    source = dec_string(&dest->tags[i].name, source);
+    source = dec_string(&dest->tags[i].name, source, arena);
     source = dec_varint(&dest->tags[i].len, source);
-    if(!(dest->tags[i].entries =
-              malloc(dest->tags[i].len * sizeof(*dest->tags[i].entries))))
+    if(!(dest->tags[i].entries = mc_alloc(arena,
+              dest->tags[i].len * sizeof(*dest->tags[i].entries))))
       return NULL;
     for(int j = 0; j < dest->tags[i].len; j++) {
       source = dec_varint(&dest->tags[i].entries[j], source);
@@ -1022,6 +1688,39 @@ char *dec_itemtag_array(mc_itemtag_array *dest, char *source) {
   return source;
 }
 
+char *dec_checked_itemtag_array(mc_itemtag_array *dest, char *source,
+    size_t max_len, mc_arena *arena) {
+  int32_t len;
+  char *end = source + max_len;
+  dest->len = 0;
+  dest->tags = NULL;
+  if(!(source = dec_checked_varint(&len, source, max_len)) || len < 0)
+    return NULL;
+  // A tag is at least a 1 byte name length and a 1 byte entry count, an entry
+  // at least 1 byte of varint
+  if((size_t)len > (size_t)(end - source) / 2)
+    return NULL;
+  if(!(dest->tags = mc_calloc(arena, len, sizeof(*dest->tags))) && len)
+    return NULL;
+  dest->len = len;
+  for(int i = 0; i < dest->len; i++) {
+    mc_itemtag *tag = &dest->tags[i];
+    if(!(source = dec_checked_string(&tag->name, source, end - source,
+             arena)))
+      return NULL;
+    if(!(source = dec_checked_varint(&len, source, end - source)) || len < 0 ||
+        (size_t)len > (size_t)(end - source))
+      return NULL;
+    if(!(tag->entries = mc_calloc(arena, len, sizeof(*tag->entries))) && len)
+      return NULL;
+    tag->len = len;
+    if(!(source = dec_checked_varints(tag->entries, len, source,
+             end - source)))
+      return NULL;
+  }
+  return source;
+}
+
 void free_itemtag_array(mc_itemtag_array array) {
   for(int i = 0; i < array.len; i++) {
     sdsfree(array.tags[i].name);
@@ -1030,3 +1729,358 @@ void free_itemtag_array(mc_itemtag_array array) {
   free(array.tags);
 }
 
+
+// Packet framing
+int dec_frame(mc_frame *frame, char *source, size_t max_len) {
+  int32_t len;
+  int ret = walk_varint(source, max_len);
+  if(ret < 0)
+    return ret;
+  source = dec_varint(&len, source);
+  if(len < 1 || len > MC_MAX_FRAME_LEN)
+    return varnum_invalid;
+  if(max_len - ret < (size_t)len)
+    return varnum_overrun;
+  // The id has to fit in the frame, anything else is garbage
+  int id_len = walk_varint(source, len);
+  if(id_len < 0)
+    return varnum_invalid;
+  frame->body = dec_varint(&frame->id, source);
+  frame->len = len - id_len;
+  return ret + len;
+}
+
+size_t size_frame(int32_t id, size_t body_len) {
+  size_t len = size_varint(id) + body_len;
+  return size_varint(len) + len;
+}
+
+char *enc_frame_header(char *dest, int32_t id, size_t body_len) {
+  dest = enc_varint(dest, size_varint(id) + body_len);
+  return enc_varint(dest, id);
+}
+
+void mc_stream_init(mc_stream *stream, char *buf, size_t size) {
+  stream->buf = buf;
+  stream->size = size;
+  stream->start = stream->end = 0;
+}
+
+char *mc_stream_space(mc_stream *stream, size_t *avail) {
+  if(stream->start) {
+    memmove(stream->buf, stream->buf + stream->start,
+        stream->end - stream->start);
+    stream->end -= stream->start;
+    stream->start = 0;
+  }
+  *avail = stream->size - stream->end;
+  if(!*avail)
+    return NULL;
+  return stream->buf + stream->end;
+}
+
+void mc_stream_commit(mc_stream *stream, size_t len) {
+  stream->end += len;
+}
+
+int mc_stream_next(mc_stream *stream, mc_frame *frame) {
+  int ret = dec_frame(frame, stream->buf + stream->start,
+      stream->end - stream->start);
+  if(ret > 0)
+    stream->start += ret;
+  return ret;
+}
+
+int mc_stream_next_compressed(mc_stream *stream, mc_compression *comp,
+    mc_frame *frame, char *dest, size_t dest_len, mc_arena *arena) {
+  int ret = dec_compressed_frame(comp, frame, stream->buf + stream->start,
+      stream->end - stream->start, dest, dest_len, arena);
+  if(ret > 0)
+    stream->start += ret;
+  return ret;
+}
+
+int mc_compression_init(mc_compression *comp, size_t threshold, int level) {
+  memset(comp, 0, sizeof(*comp));
+  comp->threshold = threshold;
+  int ret = deflateInit(&comp->deflate, level);
+  if(ret != Z_OK)
+    return ret;
+  if((ret = inflateInit(&comp->inflate)) != Z_OK)
+    deflateEnd(&comp->deflate);
+  return ret;
+}
+
+void mc_compression_free(mc_compression *comp) {
+  deflateEnd(&comp->deflate);
+  inflateEnd(&comp->inflate);
+}
+
+// Anything that doesn't inflate to exactly len bytes is garbage
+static int inflate_exact(z_stream *strm, char *dest, size_t len, char *source,
+    size_t max_len) {
+  inflateReset(strm);
+  strm->next_in = (Bytef *)source;
+  strm->avail_in = max_len;
+  strm->next_out = (Bytef *)dest;
+  strm->avail_out = len;
+  if(inflate(strm, Z_FINISH) != Z_STREAM_END || strm->avail_out)
+    return -1;
+  return 0;
+}
+
+int dec_compressed_frame(mc_compression *comp, mc_frame *frame, char *source,
+    size_t max_len, char *dest, size_t dest_len, mc_arena *arena) {
+  int32_t len, data_len;
+  int ret = walk_varint(source, max_len);
+  if(ret < 0)
+    return ret;
+  source = dec_varint(&len, source);
+  if(len < 1 || len > MC_MAX_FRAME_LEN)
+    return varnum_invalid;
+  if(max_len - ret < (size_t)len)
+    return varnum_overrun;
+  int data_len_len = walk_varint(source, len);
+  if(data_len_len < 0)
+    return varnum_invalid;
+  source = dec_varint(&data_len, source);
+  size_t rest = len - data_len_len;
+  char *data;
+  if(!data_len) {
+    data = source;
+    data_len = rest;
+  } else {
+    if(data_len < 0 || (size_t)data_len < comp->threshold ||
+        data_len > MC_MAX_DATA_LEN)
+      return varnum_invalid;
+    if(dest_len >= (size_t)data_len)
+      data = dest;
+    else if(!arena || !(data = mc_arena_alloc(arena, data_len)))
+      return varnum_invalid;
+    if(inflate_exact(&comp->inflate, data, data_len, source, rest))
+      return varnum_invalid;
+  }
+  int id_len = walk_varint(data, data_len);
+  if(id_len < 0)
+    return varnum_invalid;
+  frame->body = dec_varint(&frame->id, data);
+  frame->len = data_len - id_len;
+  return ret + len;
+}
+
+size_t size_compressed_frame(mc_compression *comp, int32_t id,
+    size_t body_len) {
+  size_t data_len = size_varint(id) + body_len;
+  if(data_len < comp->threshold)
+    return size_varint(data_len + 1) + 1 + data_len;
+  // The length prefix is at most 3 bytes, see MC_MAX_FRAME_LEN
+  return 3 + size_varint(data_len) + deflateBound(&comp->deflate, data_len);
+}
+
+char *enc_compressed_frame(mc_compression *comp, char *dest, size_t max_len,
+    int32_t id, char *body, size_t body_len) {
+  char id_buf[5];
+  size_t id_len = enc_varint(id_buf, id) - id_buf;
+  size_t data_len = id_len + body_len;
+  if(data_len < comp->threshold) {
+    size_t head_len = size_varint(data_len + 1) + 1;
+    if(max_len < head_len + data_len)
+      return NULL;
+    memcpy(dest + head_len + id_len, body, body_len);
+    dest = enc_varint(dest, data_len + 1);
+    *dest++ = 0;
+    memcpy(dest, id_buf, id_len);
+    return dest + data_len;
+  }
+  // Compress past the longest possible header then close the gap once the
+  // real one is known
+  size_t head_len = 3 + size_varint(data_len);
+  if(max_len < head_len)
+    return NULL;
+  z_stream *strm = &comp->deflate;
+  deflateReset(strm);
+  strm->next_out = (Bytef *)dest + head_len;
+  strm->avail_out = max_len - head_len;
+  strm->next_in = (Bytef *)id_buf;
+  strm->avail_in = id_len;
+  if(deflate(strm, Z_NO_FLUSH) != Z_OK)
+    return NULL;
+  strm->next_in = (Bytef *)body;
+  strm->avail_in = body_len;
+  if(deflate(strm, Z_FINISH) != Z_STREAM_END)
+    return NULL;
+  size_t comp_len = (char *)strm->next_out - (dest + head_len);
+  size_t len = size_varint(data_len) + comp_len;
+  if(len > MC_MAX_FRAME_LEN)
+    return NULL;
+  char *start = dest + head_len;
+  dest = enc_varint(dest, len);
+  dest = enc_varint(dest, data_len);
+  memmove(dest, start, comp_len);
+  return dest + comp_len;
+}
+
+int mc_growbuf_reserve(mc_growbuf *buf, size_t size) {
+  if(buf->base && buf->cap - buf->len >= size)
+    return 0;
+  size_t cap = buf->cap ? buf->cap : MC_GROWBUF_MIN_SIZE;
+  while(cap - buf->len < size)
+    cap *= 2;
+  char *base = realloc(buf->base, cap);
+  if(!base)
+    return -1;
+  buf->base = base;
+  buf->cap = cap;
+  return 0;
+}
+
+void mc_growbuf_free(mc_growbuf *buf) {
+  free(buf->base);
+  buf->base = NULL;
+  buf->len = buf->cap = 0;
+}
+
+int mc_splice(char *buf, size_t len, size_t cap, size_t old_len,
+    size_t new_len) {
+  if(len - old_len + new_len > cap)
+    return varnum_overrun;
+  memmove(buf + new_len, buf + old_len, len - old_len);
+  return len - old_len + new_len;
+}
+
+int mc_frame_cache_init(mc_frame_cache *cache, size_t max_frames) {
+  size_t nbuckets = 16;
+  while(nbuckets < max_frames)
+    nbuckets <<= 1;
+  if(!(cache->buckets = calloc(nbuckets, sizeof(*cache->buckets))))
+    return -1;
+  cache->mask = nbuckets - 1;
+  cache->lru_head = cache->lru_tail = NULL;
+  cache->count = 0;
+  cache->max_frames = max_frames;
+  cache->hits = cache->misses = 0;
+  return 0;
+}
+
+static void lru_unlink(mc_frame_cache *cache, mc_cached_frame *frame) {
+  if(frame->lru_prev)
+    frame->lru_prev->lru_next = frame->lru_next;
+  else
+    cache->lru_head = frame->lru_next;
+  if(frame->lru_next)
+    frame->lru_next->lru_prev = frame->lru_prev;
+  else
+    cache->lru_tail = frame->lru_prev;
+  frame->lru_prev = frame->lru_next = NULL;
+}
+
+static void destroy_frame(mc_cached_frame *frame) {
+  if(frame->packet && frame->funcs->free)
+    frame->funcs->free(frame->packet);
+  free(frame->packet);
+  free(frame->frame);
+  free(frame);
+}
+
+static void evict_frame(mc_frame_cache *cache, mc_cached_frame *frame) {
+  mc_cached_frame **link = &cache->buckets[frame->hash & cache->mask];
+  while(*link != frame)
+    link = &(*link)->next;
+  *link = frame->next;
+  lru_unlink(cache, frame);
+  cache->count--;
+  destroy_frame(frame);
+}
+
+//The packet is decoded back out of the frame to compare later lookups
+//against. If that doesn't come out equal to what was encoded, ie: a bitfield
+//member out of range, the frame is handed out uncached
+mc_cached_frame *mc_frame_cache_get(mc_frame_cache *cache,
+    const mc_packet_funcs *funcs, int32_t id, void *packet) {
+  if(!funcs->hash || !funcs->eq)
+    return NULL;
+  uint64_t hash = mc_hash_u64(funcs->hash(packet), id);
+  mc_cached_frame **bucket = &cache->buckets[hash & cache->mask];
+  for(mc_cached_frame *frame = *bucket; frame; frame = frame->next) {
+    if(frame->hash != hash || frame->funcs != funcs || frame->id != id ||
+        !funcs->eq(frame->packet, packet))
+      continue;
+    if(!frame->refs)
+      lru_unlink(cache, frame);
+    frame->refs++;
+    cache->hits++;
+    return frame;
+  }
+  cache->misses++;
+
+  mc_cached_frame *frame = calloc(1, sizeof(*frame));
+  if(!frame)
+    return NULL;
+  frame->funcs = funcs;
+  frame->body_len = funcs->size(packet);
+  frame->len = size_frame(id, frame->body_len);
+  if(!(frame->frame = malloc(frame->len))) {
+    free(frame);
+    return NULL;
+  }
+  frame->body = enc_frame_header(frame->frame, id, frame->body_len);
+  funcs->enc(frame->body, packet);
+  if(!(frame->packet = calloc(1, funcs->packet_size)) ||
+      !funcs->dec_checked(frame->packet, frame->body, frame->body_len,
+      NULL)) {
+    destroy_frame(frame);
+    return NULL;
+  }
+  frame->hash = hash;
+  frame->id = id;
+  frame->refs = 1;
+  if(funcs->eq(frame->packet, packet)) {
+    frame->cached = 1;
+    frame->next = *bucket;
+    *bucket = frame;
+    cache->count++;
+  }
+  return frame;
+}
+
+void mc_frame_cache_release(mc_frame_cache *cache, mc_cached_frame *frame) {
+  if(--frame->refs)
+    return;
+  if(!frame->cached) {
+    destroy_frame(frame);
+    return;
+  }
+  frame->lru_prev = cache->lru_tail;
+  if(cache->lru_tail)
+    cache->lru_tail->lru_next = frame;
+  else
+    cache->lru_head = frame;
+  cache->lru_tail = frame;
+  while(cache->count > cache->max_frames && cache->lru_head)
+    evict_frame(cache, cache->lru_head);
+}
+
+void mc_frame_cache_free(mc_frame_cache *cache) {
+  for(size_t i = 0; i <= cache->mask; i++) {
+    mc_cached_frame *frame = cache->buckets[i];
+    while(frame) {
+      mc_cached_frame *next = frame->next;
+      destroy_frame(frame);
+      frame = next;
+    }
+  }
+  free(cache->buckets);
+  cache->buckets = NULL;
+  cache->lru_head = cache->lru_tail = NULL;
+  cache->count = 0;
+}
+
+uint64_t mc_instrument_clock(void) {
+#ifdef __x86_64__
+  return __rdtsc();
+#else
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+#endif
+}
@@ -0,0 +1,517 @@
+# Runtime for the pure Python codecs generated with --pure-python, the
+# counterpart of datautils.c. It has to be importable as datautils next to the
+# generated codec_[version].py, which pulls everything in with a star import.
+#
+# Decoders take a memoryview and an offset and return the value and the offset
+# after it, encoders take a writable buffer and an offset and return the offset
+# after what they wrote. Nothing is bounds checked on the way in beyond what
+# struct and indexing do, Protocol.decode turns all of those failures into
+# DecodeError
+
+from struct import Struct, error, pack_into, unpack_from
+
+# Only needed for Layout and Protocol.decode_array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = [
+    'DecodeError', 'Packet', 'Protocol', 'Struct', 'new', 'index_frames',
+    'Layout', 'POSITION',
+    'HANDSHAKING', 'STATUS', 'LOGIN', 'PLAY', 'TOCLIENT', 'TOSERVER',
+    'dec_varint', 'enc_varint', 'size_varint', 'dec_varints',
+    'dec_string', 'enc_string', 'size_string',
+    'dec_bytes', 'enc_bytes', 'dec_rest', 'enc_rest',
+    'dec_numerics', 'enc_numerics', 'dec_position', 'enc_position',
+    'dec_nbt', 'enc_nbt', 'dec_optnbt', 'enc_optnbt', 'dec_slot', 'enc_slot',
+    'dec_ingredient', 'enc_ingredient', 'dec_smelting', 'enc_smelting',
+    'dec_itemtag_array', 'enc_itemtag_array', 'dec_metadata', 'enc_metadata',
+    'dec_particledata', 'enc_particledata',
+]
+
+# Same order as the generated protocol_state_id and protocol_direction_id
+HANDSHAKING, STATUS, LOGIN, PLAY = range(4)
+TOCLIENT, TOSERVER = range(2)
+
+# Same as MC_MAX_FRAME_LEN
+MAX_FRAME_LEN = 2097151
+
+class DecodeError(ValueError):
+    pass
+
+# Packets are plain classes with __slots__, one per packet, decoders fill them
+# in without running __init__
+class Packet:
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ', '.join(
+            f'{name}={getattr(self, name, None)!r}' for name in self.__slots__
+        )
+        return f'{type(self).__name__}({fields})'
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(
+            getattr(self, name, None) == getattr(other, name, None)
+            for name in self.__slots__
+        )
+
+new = object.__new__
+
+# All varints are varlongs, same as the generated C. Up to ten bytes,
+# reinterpreted as a signed 64-bit value
+def dec_varint(view, pos):
+    byte = view[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    val = byte & 0x7F
+    for shift in range(7, 70, 7):
+        pos += 1
+        byte = view[pos]
+        val |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            val &= 0xFFFFFFFFFFFFFFFF
+            return val - (val >> 63 << 64), pos + 1
+    raise DecodeError('varint is longer than ten bytes')
+
+def dec_varints(view, pos, count):
+    vals = []
+    for _ in range(count):
+        val, pos = dec_varint(view, pos)
+        vals.append(val)
+    return vals, pos
+
+def _varint_bits(val):
+    if val < 0:
+        val += 1 << 64
+    if val >> 64:
+        raise OverflowError(f'{val} is out of range for a varint')
+    return val
+
+def enc_varint(buf, pos, val):
+    val = _varint_bits(val)
+    while val >= 0x80:
+        buf[pos] = val & 0x7F | 0x80
+        val >>= 7
+        pos += 1
+    buf[pos] = val
+    return pos + 1
+
+def size_varint(val):
+    if 0 <= val < 0x80:
+        return 1
+    return (_varint_bits(val).bit_length() + 6) // 7
+
+def _len(view, pos):
+    length, pos = dec_varint(view, pos)
+    if length < 0:
+        raise DecodeError('negative length')
+    end = pos + length
+    if end > len(view):
+        raise DecodeError('length runs past the end of the data')
+    return pos, end
+
+def dec_string(view, pos):
+    pos, end = _len(view, pos)
+    return str(view[pos:end], 'utf-8'), end
+
+def enc_string(buf, pos, val):
+    return enc_bytes(buf, enc_varint(buf, pos, size_string(val, False)),
+        val.encode())
+
+# size_string(val) is the whole encoded size, with prefix False just the
+# length of the UTF-8
+def size_string(val, prefix = True):
+    length = len(val) if val.isascii() else len(val.encode())
+    return size_varint(length) + length if prefix else length
+
+# count bytes, the count has already been decoded by the generated code
+def dec_bytes(view, pos, count):
+    if count < 0:
+        raise DecodeError('negative length')
+    end = pos + count
+    if end > len(view):
+        raise DecodeError('length runs past the end of the data')
+    return bytes(view[pos:end]), end
+
+def enc_bytes(buf, pos, val):
+    end = pos + len(val)
+    buf[pos:end] = val
+    return end
+
+def dec_rest(view, pos):
+    return bytes(view[pos:]), len(view)
+
+enc_rest = enc_bytes
+
+# Arrays of plain numbers in one go, code is a struct format character. The
+# struct module caches the compiled formats
+def dec_numerics(code, size, count, view, pos):
+    if count < 0:
+        raise DecodeError('negative count')
+    return list(unpack_from(f'>{count}{code}', view, pos)), pos + count * size
+
+def enc_numerics(code, size, buf, pos, vals):
+    pack_into(f'>{len(vals)}{code}', buf, pos, *vals)
+    return pos + len(vals) * size
+
+# From MSB to LSB x: 26-bits, y: 12-bits, z: 26-bits, each is an independent
+# signed 2-complement integer. Positions are (x, y, z) tuples
+def dec_position(val):
+    x = val >> 38
+    y = val >> 26 & 0xFFF
+    z = val & 0x3FFFFFF
+    return (
+        x - (1 << 26) if x >= 1 << 25 else x,
+        y - (1 << 12) if y >= 1 << 11 else y,
+        z - (1 << 26) if z >= 1 << 25 else z,
+    )
+
+def enc_position(val):
+    x, y, z = val
+    return (x & 0x3FFFFFF) << 38 | (y & 0xFFF) << 26 | z & 0x3FFFFFF
+
+# Runtime types without a natural Python equivalent are kept as their encoded
+# bytes, the walk functions find where they end. They raise DecodeError for
+# anything that isn't a valid encoding, running out of data included
+
+_be16 = Struct('>H')
+_be32 = Struct('>i')
+
+def _need(view, end):
+    if end > len(view):
+        raise DecodeError('ran out of data')
+    return end
+
+def walk_varint(view, pos):
+    return dec_varint(view, pos)[1]
+
+def walk_string(view, pos):
+    return _len(view, pos)[1]
+
+def walk_nbt_string(view, pos):
+    _need(view, pos + 2)
+    return _need(view, pos + 2 + _be16.unpack_from(view, pos)[0])
+
+def walk_nbt_array(view, pos, size):
+    _need(view, pos + 4)
+    count = _be32.unpack_from(view, pos)[0]
+    if count < 0:
+        raise DecodeError('negative nbt array length')
+    return _need(view, pos + 4 + count * size)
+
+def walk_nbt_list(view, pos):
+    _need(view, pos + 5)
+    tag = view[pos]
+    count = _be32.unpack_from(view, pos + 1)[0]
+    pos += 5
+    for _ in range(count):
+        pos = walk_unnamed_nbt(view, pos, tag)
+    return pos
+
+def walk_nbt_compound(view, pos):
+    while True:
+        _need(view, pos + 1)
+        tag = view[pos]
+        if not tag:
+            return pos + 1
+        pos = walk_unnamed_nbt(view, walk_nbt_string(view, pos + 1), tag)
+
+# TAG_Byte through TAG_Double are fixed size
+_nbt_sizes = {1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8}
+
+def walk_unnamed_nbt(view, pos, tag):
+    if tag in _nbt_sizes:
+        return _need(view, pos + _nbt_sizes[tag])
+    if tag == 7:
+        return walk_nbt_array(view, pos, 1)
+    if tag == 8:
+        return walk_nbt_string(view, pos)
+    if tag == 9:
+        return walk_nbt_list(view, pos)
+    if tag == 10:
+        return walk_nbt_compound(view, pos)
+    if tag == 11:
+        return walk_nbt_array(view, pos, 4)
+    if tag == 12:
+        return walk_nbt_array(view, pos, 8)
+    raise DecodeError(f'invalid nbt tag {tag}')
+
+def walk_nbt(view, pos):
+    _need(view, pos + 1)
+    return walk_unnamed_nbt(view, walk_nbt_string(view, pos + 1), view[pos])
+
+# Same as walk_optnbt in datautils.c, absent is a single TAG_End byte and
+# anything else has to be a compound
+def walk_optnbt(view, pos):
+    _need(view, pos + 1)
+    if not view[pos]:
+        return pos + 1
+    if view[pos] != 10:
+        raise DecodeError(f'invalid optional nbt tag {view[pos]}')
+    return walk_nbt(view, pos)
+
+def walk_slot(view, pos):
+    _need(view, pos + 2)
+    if _be16.unpack_from(view, pos)[0] == 0xFFFF:
+        return pos + 2
+    return walk_optnbt(view, _need(view, pos + 5))
+
+def walk_ingredient(view, pos):
+    count, pos = dec_varint(view, pos)
+    for _ in range(count):
+        pos = walk_slot(view, pos)
+    return pos
+
+def walk_smelting(view, pos):
+    pos = walk_slot(view, walk_ingredient(view, walk_string(view, pos)))
+    return walk_varint(view, _need(view, pos + 4))
+
+def walk_itemtag_array(view, pos):
+    count, pos = dec_varint(view, pos)
+    for _ in range(count):
+        entries, pos = dec_varint(view, walk_string(view, pos))
+        if entries < 0:
+            raise DecodeError('negative tag entry count')
+        for _ in range(entries):
+            pos = walk_varint(view, pos)
+    return pos
+
+# Same as walk_metadata in datautils.c
+def walk_metadata(view, pos):
+    raise DecodeError('entity metadata is not supported')
+
+# Values of particle_block, particle_falling_dust, particle_dust and
+# particle_item in datautils.h
+def walk_particledata(view, pos, particle):
+    pos = walk_varint(view, pos)
+    if particle in (3, 20):
+        return walk_varint(view, pos)
+    if particle == 11:
+        return _need(view, pos + 16)
+    if particle == 27:
+        return walk_slot(view, pos)
+    return pos
+
+# Encoding checks the bytes are a single valid encoding of the type, the same
+# as decoding them would
+def _raw_codec(walk):
+    def dec(view, pos, *args):
+        end = walk(view, pos, *args)
+        return bytes(view[pos:end]), end
+    def enc(buf, pos, val, *args):
+        try:
+            valid = walk(memoryview(val), 0, *args) == len(val)
+        except (IndexError, error, ValueError):
+            valid = False
+        if not valid:
+            raise ValueError(f'invalid {walk.__name__[5:]}')
+        return enc_bytes(buf, pos, val)
+    return dec, enc
+
+dec_nbt, enc_nbt = _raw_codec(walk_nbt)
+dec_optnbt, enc_optnbt = _raw_codec(walk_optnbt)
+dec_slot, enc_slot = _raw_codec(walk_slot)
+dec_ingredient, enc_ingredient = _raw_codec(walk_ingredient)
+dec_smelting, enc_smelting = _raw_codec(walk_smelting)
+dec_itemtag_array, enc_itemtag_array = _raw_codec(walk_itemtag_array)
+dec_metadata, enc_metadata = _raw_codec(walk_metadata)
+dec_particledata, enc_particledata = _raw_codec(walk_particledata)
+
+# Same as dec_frame in datautils.c, returns the id, where the body starts and
+# where the frame ends, or None if view doesn't hold all of it yet
+def dec_frame(view, pos):
+    try:
+        length, body = dec_varint(view, pos)
+    except IndexError:
+        # More data can only complete a length shorter than 5 bytes
+        if len(view) - pos < 5:
+            return None
+        raise DecodeError(f'malformed frame at offset {pos}') from None
+    if body - pos > 5 or not 0 < length <= MAX_FRAME_LEN:
+        raise DecodeError(f'malformed frame at offset {pos}')
+    end = body + length
+    if end > len(view):
+        return None
+    try:
+        packet_id, start = dec_varint(view[:end], body)
+    except IndexError:
+        raise DecodeError(f'malformed frame at offset {pos}') from None
+    if start - body > 5:
+        raise DecodeError(f'malformed frame at offset {pos}')
+    return packet_id, start, end
+
+# Where the body of every complete frame in data starts, grouped by packet id,
+# and where the first incomplete frame starts. The offsets are what
+# Protocol.decode_array takes
+def index_frames(data):
+    view = memoryview(data)
+    offsets = {}
+    pos = 0
+    while pos < len(view):
+        frame = dec_frame(view, pos)
+        if frame is None:
+            break
+        packet_id, start, pos = frame
+        offsets.setdefault(packet_id, []).append(start)
+    return offsets, pos
+
+# Fixed size packets as NumPy structured arrays. fields is a list of
+# (name, format) for numerics, (name, fields) for containers and
+# (name, format, members) for bitfields, members being (name, format, shift,
+# mask, sign) where sign is the sign bit to extend from, or 0. Numerics keep
+# the big-endian wire format, bitfield members are native integers. The dtypes
+# are only built when first used, so numpy is only needed by decode_array
+class Layout:
+    def __init__(self, fields):
+        self.fields = fields
+        self._dtypes = None
+
+    @property
+    def raw(self):
+        return self.dtypes[0]
+
+    @property
+    def dtype(self):
+        return self.dtypes[1]
+
+    # The wire layout and the one with bitfields expanded
+    @property
+    def dtypes(self):
+        if self._dtypes is None:
+            if numpy is None:
+                raise ImportError('decoding to arrays needs numpy')
+            self._dtypes = (
+                numpy.dtype(_np_fields(self.fields, False)),
+                numpy.dtype(_np_fields(self.fields, True)),
+            )
+        return self._dtypes
+
+    # Decodes the packet bodies starting at offsets in buf into one array
+    def decode(self, buf, offsets):
+        raw, dtype = self.dtypes
+        data = numpy.frombuffer(buf, numpy.uint8)
+        offsets = numpy.asarray(offsets, numpy.intp)
+        if len(offsets) and (offsets.min() < 0 or
+                offsets.max() > len(data) - raw.itemsize):
+            raise DecodeError('packet runs past the end of the buffer')
+        # One gather copies every body into consecutive rows, which then
+        # reinterpret as the wire layout
+        rows = data[offsets[:, None] + numpy.arange(raw.itemsize)]
+        packed = rows.view(raw).reshape(len(offsets))
+        if raw == dtype:
+            return packed
+        out = numpy.empty(len(offsets), dtype)
+        _np_expand(self.fields, packed, out)
+        return out
+
+# x, y and z of a position, same as dec_position
+POSITION = [
+    ('x', 'i4', 38, 0x3FFFFFF, 1 << 25),
+    ('y', 'i2', 26, 0xFFF, 1 << 11),
+    ('z', 'i4', 0, 0x3FFFFFF, 1 << 25),
+]
+
+def _np_fields(fields, expand):
+    spec = []
+    for name, fmt, *members in fields:
+        if not isinstance(fmt, str):
+            spec.append((name, _np_fields(fmt, expand)))
+        elif members and expand:
+            spec.append((name, [member[:2] for member in members[0]]))
+        else:
+            spec.append((name, fmt))
+    return spec
+
+def _np_expand(fields, src, dest):
+    for name, fmt, *members in fields:
+        if not isinstance(fmt, str):
+            _np_expand(fmt, src[name], dest[name])
+        elif members:
+            # Signed so the shifts don't go through floats on uint64, the
+            # masks drop anything the sign brought in
+            val = src[name].astype(numpy.int64)
+            for member, _, shift, mask, sign in members[0]:
+                bits = val >> shift & mask
+                dest[name][member] = (bits ^ sign) - sign if sign else bits
+        else:
+            dest[name] = src[name]
+
+# packets maps (state, direction) to a dict of packet id to (class, dec_,
+# size_, enc_) and layouts the same way to the Layout of fixed size packets,
+# the generated module binds the methods of one of these as its module
+# functions
+class Protocol:
+    def __init__(self, packets, layouts=None):
+        self.packets = packets
+        self.layouts = {} if layouts is None else layouts
+
+    def lookup(self, state, direction, packet_id):
+        try:
+            return self.packets[state, direction][packet_id]
+        except KeyError:
+            raise ValueError(f'no packet {packet_id} in state {state}, '
+                f'direction {direction}') from None
+
+    # Decodes a packet body, without its length or id
+    def decode(self, state, direction, packet_id, data):
+        return self._decode(self.lookup(state, direction, packet_id)[1],
+            memoryview(data))
+
+    def _decode(self, dec, view):
+        try:
+            packet, pos = dec(view, 0)
+        except (IndexError, error, ValueError) as err:
+            raise DecodeError(f'invalid packet: {err}') from err
+        if pos != len(view):
+            raise DecodeError('invalid packet: trailing bytes')
+        return packet
+
+    # Encodes a packet into a body, without its length or id
+    def encode(self, state, direction, packet_id, packet):
+        _, _, size, enc = self.lookup(state, direction, packet_id)
+        buf = bytearray(size(packet))
+        try:
+            enc(packet, buf, 0)
+        except error as err:
+            raise ValueError(str(err)) from err
+        return bytes(buf)
+
+    # Decodes every complete frame in data into (id, packet) tuples, or (id,
+    # None) for packets that can't be decoded, and returns them with where the
+    # first incomplete frame starts
+    def decode_frames(self, state, direction, data):
+        view = memoryview(data)
+        packets = []
+        table = self.packets.get((state, direction), {})
+        pos = 0
+        while pos < len(view):
+            frame = dec_frame(view, pos)
+            if frame is None:
+                break
+            packet_id, start, pos = frame
+            packet = None
+            if packet_id in table:
+                try:
+                    packet = self._decode(table[packet_id][1], view[start:pos])
+                except DecodeError:
+                    pass
+            packets.append((packet_id, packet))
+        return packets, pos
+
+    # Decodes the bodies of packets of a single fixed size type into a NumPy
+    # structured array, see index_frames for the offsets
+    def decode_array(self, state, direction, packet_id, data, offsets):
+        self.lookup(state, direction, packet_id)
+        try:
+            layout = self.layouts[state, direction][packet_id]
+        except KeyError:
+            raise ValueError(f'packet {packet_id} in state {state}, '
+                f'direction {direction} is not fixed size') from None
+        return layout.decode(data, offsets)
+
+    def packet_name(self, state, direction, packet_id):
+        return self.lookup(state, direction, packet_id)[0].__name__
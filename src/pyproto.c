@@ -0,0 +1,358 @@
+#include "pyproto.h"
+#include "datautils.h"
+#include "sds.h"
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+// Set once by mc_py_module, an extension only ever wraps one protocol
+static const mc_py_protocol *protocol;
+
+// Conversion helpers
+
+int mc_py_set(PyObject *dict, const char *key, PyObject *val) {
+  if(!val)
+    return -1;
+  int ret = PyDict_SetItemString(dict, key, val);
+  Py_DECREF(val);
+  return ret;
+}
+
+int mc_py_item(PyObject *list, Py_ssize_t idx, PyObject *val) {
+  if(!val)
+    return -1;
+  PyList_SET_ITEM(list, idx, val);
+  return 0;
+}
+
+PyObject *mc_py_get(PyObject *dict, const char *key) {
+  if(!PyDict_Check(dict)) {
+    PyErr_Format(PyExc_TypeError, "expected a dict holding '%s', not %.100s",
+        key, Py_TYPE(dict)->tp_name);
+    return NULL;
+  }
+  PyObject *val = PyDict_GetItemString(dict, key);
+  if(!val)
+    PyErr_Format(PyExc_KeyError, "missing field '%s'", key);
+  return val;
+}
+
+PyObject *mc_py_none(void) {
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+int64_t mc_py_int(PyObject *obj, int64_t min, int64_t max) {
+  long long val = PyLong_AsLongLong(obj);
+  if(val == -1 && PyErr_Occurred())
+    return -1;
+  if(val < min || val > max) {
+    PyErr_Format(PyExc_OverflowError, "%lld is out of range %lld to %lld",
+        val, (long long) min, (long long) max);
+    return -1;
+  }
+  return val;
+}
+
+uint64_t mc_py_uint(PyObject *obj, uint64_t max) {
+  unsigned long long val = PyLong_AsUnsignedLongLong(obj);
+  if(val == (unsigned long long) -1 && PyErr_Occurred())
+    return -1;
+  if(val > max) {
+    PyErr_Format(PyExc_OverflowError, "%llu is out of range 0 to %llu",
+        val, (unsigned long long) max);
+    return -1;
+  }
+  return val;
+}
+
+int mc_py_list(PyObject *obj, Py_ssize_t len) {
+  if(!PyList_Check(obj)) {
+    PyErr_Format(PyExc_TypeError, "expected a list, not %.100s",
+        Py_TYPE(obj)->tp_name);
+    return -1;
+  }
+  if(len >= 0 && PyList_GET_SIZE(obj) != len) {
+    PyErr_Format(PyExc_ValueError, "expected a list of %zd items, not %zd",
+        len, PyList_GET_SIZE(obj));
+    return -1;
+  }
+  return 0;
+}
+
+int mc_py_bytes(PyObject *obj, mc_buffer *dest) {
+  char *base;
+  Py_ssize_t len;
+  if(PyBytes_AsStringAndSize(obj, &base, &len))
+    return -1;
+  dest->base = base;
+  dest->len = len;
+  return 0;
+}
+
+int mc_py_buffer(PyObject *obj, mc_buffer *dest) {
+  mc_buffer view;
+  if(mc_py_bytes(obj, &view))
+    return -1;
+  if(!(dest->base = malloc(view.len ? view.len : 1))) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  memcpy(dest->base, view.base, view.len);
+  dest->len = view.len;
+  return 0;
+}
+
+int mc_py_strview(PyObject *obj, mc_strview *dest) {
+  Py_ssize_t len;
+  const char *base = PyUnicode_AsUTF8AndSize(obj, &len);
+  if(!base)
+    return -1;
+  dest->base = (char *) base;
+  dest->len = len;
+  return 0;
+}
+
+int mc_py_string(PyObject *obj, sds *dest) {
+  mc_strview view;
+  if(mc_py_strview(obj, &view))
+    return -1;
+  if(!(*dest = sdsnewlen(view.base, view.len))) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  return 0;
+}
+
+PyObject *mc_py_from_uuid(mc_uuid uuid) {
+  char bytes[16];
+  enc_uuid(bytes, uuid);
+  return PyBytes_FromStringAndSize(bytes, sizeof(bytes));
+}
+
+int mc_py_uuid(PyObject *obj, mc_uuid *dest) {
+  mc_buffer view;
+  if(mc_py_bytes(obj, &view))
+    return -1;
+  if(view.len != 16) {
+    PyErr_SetString(PyExc_ValueError, "a UUID is 16 bytes");
+    return -1;
+  }
+  dec_uuid(dest, view.base);
+  return 0;
+}
+
+int mc_py_invalid(const char *type) {
+  PyErr_Format(PyExc_ValueError, "invalid %s", type);
+  return -1;
+}
+
+// Module functions
+
+static const mc_packet_funcs *py_lookup(int state, int direction, int32_t id,
+    const mc_py_packet **packet) {
+  const mc_packet_funcs *funcs = NULL;
+  if(state >= 0 && state < protocol->states && direction >= 0 &&
+      direction < 2)
+    funcs = protocol->lookup(state, direction, id);
+  if(!funcs)
+    return NULL;
+  *packet = &protocol->packets[state][direction][id];
+  return funcs;
+}
+
+static PyObject *py_unknown(int state, int direction, int32_t id) {
+  PyErr_Format(PyExc_ValueError, "no packet %d in state %d, direction %d", id,
+      state, direction);
+  return NULL;
+}
+
+// Fieldless packets have no struct, they decode to an empty dict
+static PyObject *py_decode_body(const mc_packet_funcs *funcs,
+    const mc_py_packet *conv, char *data, size_t len, mc_arena *arena) {
+  if(!funcs->walk) {
+    if(len)
+      goto invalid;
+    return PyDict_New();
+  }
+  void *packet = mc_alloc(arena, funcs->packet_size);
+  if(!packet)
+    return PyErr_NoMemory();
+  if(funcs->dec_checked(packet, data, len, arena) != data + len)
+    goto invalid;
+  return conv->topy(packet);
+
+invalid:
+  mc_py_invalid("packet");
+  return NULL;
+}
+
+static PyObject *py_decode(PyObject *self, PyObject *args) {
+  int state, direction;
+  int32_t id;
+  Py_buffer data;
+  if(!PyArg_ParseTuple(args, "iiiy*", &state, &direction, &id, &data))
+    return NULL;
+  const mc_py_packet *conv;
+  const mc_packet_funcs *funcs = py_lookup(state, direction, id, &conv);
+  PyObject *ret;
+  if(funcs) {
+    mc_arena arena;
+    mc_arena_init(&arena, MC_ARENA_BLOCK_SIZE);
+    ret = py_decode_body(funcs, conv, data.buf, data.len, &arena);
+    mc_arena_free(&arena);
+  } else {
+    ret = py_unknown(state, direction, id);
+  }
+  PyBuffer_Release(&data);
+  return ret;
+}
+
+static PyObject *py_encode(PyObject *self, PyObject *args) {
+  int state, direction;
+  int32_t id;
+  PyObject *dict;
+  if(!PyArg_ParseTuple(args, "iiiO!", &state, &direction, &id, &PyDict_Type,
+      &dict))
+    return NULL;
+  const mc_py_packet *conv;
+  const mc_packet_funcs *funcs = py_lookup(state, direction, id, &conv);
+  if(!funcs)
+    return py_unknown(state, direction, id);
+  if(!funcs->enc)
+    return PyBytes_FromStringAndSize(NULL, 0);
+  // Views in the packet point into dict's values, which outlive the call
+  void *packet = calloc(1, funcs->packet_size);
+  if(!packet)
+    return PyErr_NoMemory();
+  PyObject *ret = NULL;
+  if(!conv->frompy(dict, packet) &&
+      (ret = PyBytes_FromStringAndSize(NULL, funcs->size(packet))))
+    funcs->enc(PyBytes_AS_STRING(ret), packet);
+  if(funcs->free)
+    funcs->free(packet);
+  free(packet);
+  return ret;
+}
+
+// Unknown packets and bodies that don't decode come back as None rather than
+// failing the whole batch, a malformed frame does since nothing after it can
+// be found
+static PyObject *py_decode_frames(PyObject *self, PyObject *args) {
+  int state, direction;
+  Py_buffer data;
+  if(!PyArg_ParseTuple(args, "iiy*", &state, &direction, &data))
+    return NULL;
+  PyObject *list = PyList_New(0);
+  if(!list) {
+    PyBuffer_Release(&data);
+    return NULL;
+  }
+  mc_arena arena;
+  mc_arena_init(&arena, MC_ARENA_BLOCK_SIZE);
+  char *ptr = data.buf;
+  size_t left = data.len;
+  mc_frame frame;
+  int ret = 0;
+  while(left && (ret = dec_frame(&frame, ptr, left)) > 0) {
+    const mc_py_packet *conv;
+    const mc_packet_funcs *funcs = py_lookup(state, direction, frame.id,
+        &conv);
+    PyObject *packet = NULL;
+    if(funcs)
+      packet = py_decode_body(funcs, conv, frame.body, frame.len, &arena);
+    if(!packet) {
+      if(funcs && !PyErr_ExceptionMatches(PyExc_ValueError))
+        goto fail;
+      PyErr_Clear();
+      packet = mc_py_none();
+    }
+    PyObject *item = Py_BuildValue("(iN)", frame.id, packet);
+    if(!item || PyList_Append(list, item)) {
+      Py_XDECREF(item);
+      goto fail;
+    }
+    Py_DECREF(item);
+    ptr += ret;
+    left -= ret;
+    mc_arena_reset(&arena);
+  }
+  if(ret == varnum_invalid) {
+    PyErr_Format(PyExc_ValueError, "malformed frame at offset %zd",
+        ptr - (char *) data.buf);
+    goto fail;
+  }
+  mc_arena_free(&arena);
+  PyObject *result = Py_BuildValue("(Nn)", list, ptr - (char *) data.buf);
+  PyBuffer_Release(&data);
+  return result;
+
+fail:
+  mc_arena_free(&arena);
+  Py_DECREF(list);
+  PyBuffer_Release(&data);
+  return NULL;
+}
+
+static PyObject *py_packet_name(PyObject *self, PyObject *args) {
+  int state, direction;
+  int32_t id;
+  if(!PyArg_ParseTuple(args, "iii", &state, &direction, &id))
+    return NULL;
+  if(state < 0 || state >= protocol->states || direction < 0 ||
+      direction > 1 || id < 0 || id >= protocol->max_ids[state][direction])
+    return py_unknown(state, direction, id);
+  return PyUnicode_FromString(protocol->strings[state][direction][id]);
+}
+
+static PyMethodDef py_methods[] = {
+  {"decode", py_decode, METH_VARARGS,
+      "decode(state, direction, id, data) -> dict\n\n"
+      "Decodes a packet body, without its length or id."},
+  {"encode", py_encode, METH_VARARGS,
+      "encode(state, direction, id, packet) -> bytes\n\n"
+      "Encodes a packet dict into a body, without its length or id."},
+  {"decode_frames", py_decode_frames, METH_VARARGS,
+      "decode_frames(state, direction, data) -> (list, consumed)\n\n"
+      "Decodes every complete frame in data into (id, dict) tuples, or\n"
+      "(id, None) for packets that can't be decoded. consumed is where the\n"
+      "first incomplete frame starts."},
+  {"packet_name", py_packet_name, METH_VARARGS,
+      "packet_name(state, direction, id) -> str"},
+  {NULL, NULL, 0, NULL},
+};
+
+static struct PyModuleDef py_module = {
+  PyModuleDef_HEAD_INIT,
+  .m_size = -1,
+  .m_methods = py_methods,
+};
+
+// Same order as the generated protocol_state_id and protocol_direction_id
+static const struct {
+  const char *name;
+  int value;
+} py_constants[] = {
+  {"HANDSHAKING", 0},
+  {"STATUS", 1},
+  {"LOGIN", 2},
+  {"PLAY", 3},
+  {"TOCLIENT", 0},
+  {"TOSERVER", 1},
+};
+
+PyObject *mc_py_module(const mc_py_protocol *proto) {
+  protocol = proto;
+  py_module.m_name = proto->name;
+  PyObject *module = PyModule_Create(&py_module);
+  if(!module)
+    return NULL;
+  for(size_t i = 0; i < sizeof(py_constants) / sizeof(*py_constants); i++) {
+    if(PyModule_AddIntConstant(module, py_constants[i].name,
+        py_constants[i].value)) {
+      Py_DECREF(module);
+      return NULL;
+    }
+  }
+  return module;
+}
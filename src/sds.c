@@ -86,7 +86,8 @@ static inline char sdsReqType(size_t string_size) {
  * You can print the string with printf() as there is an implicit \0 at the
  * end of the string. However the string is binary safe and can contain
  * \0 characters in the middle, as the length is stored in the sds header. */
-sds sdsnewlen(const void *init, size_t initlen) {
+static inline sds _sdsnewlen(const void *init, size_t initlen,
+        void *(*alloc)(void *ctx, size_t size), void *ctx) {
     void *sh;
     sds s;
     char type = sdsReqType(initlen);
@@ -96,7 +97,7 @@ sds sdsnewlen(const void *init, size_t initlen) {
     int hdrlen = sdsHdrSize(type);
     unsigned char *fp; /* flags pointer. */
 
-    sh = s_malloc(hdrlen+initlen+1);
+    sh = alloc ? alloc(ctx, hdrlen+initlen+1) : s_malloc(hdrlen+initlen+1);
     if (init==SDS_NOINIT)
         init = NULL;
     else if (!init)
@@ -144,6 +145,19 @@ sds sdsnewlen(const void *init, size_t initlen) {
     return s;
 }
 
+sds sdsnewlen(const void *init, size_t initlen) {
+    return _sdsnewlen(init, initlen, NULL, NULL);
+}
+
+/* Like sdsnewlen(), but the memory is obtained by calling alloc(ctx, size)
+ * instead of s_malloc, for example from an arena. The string is owned by
+ * that allocator, so it must never be passed to sdsfree() or to any function
+ * that may reallocate it, such as sdscat(). */
+sds sdsnewlenwith(const void *init, size_t initlen,
+        void *(*alloc)(void *ctx, size_t size), void *ctx) {
+    return _sdsnewlen(init, initlen, alloc, ctx);
+}
+
 /* Create an empty (zero length) sds string. Even in this case the string
  * always has an implicit null term. */
 sds sdsempty(void) {
@@ -0,0 +1,40 @@
+#include <stdio.h>
+#include "datautils.h"
+
+// Counts far larger than the bytes left after them. The checked decoders have
+// to reject these before allocating room for the elements
+static int check(const char *name, char *ret, mc_arena *arena) {
+  if(ret || arena->allocated > 4096) {
+    printf("%s: returned %p after allocating %zu bytes\n", name, (void *)ret,
+        arena->allocated);
+    return 1;
+  }
+  return 0;
+}
+
+int main(void) {
+  int failed = 0;
+  mc_arena arena;
+
+  char count[] = {0x80, 0x80, 0x80, 0x60, 0x00};
+  mc_ingredient ingredient;
+  mc_arena_init(&arena, MC_ARENA_BLOCK_SIZE);
+  failed |= check("ingredient", dec_checked_ingredient(&ingredient, count,
+      sizeof(count), &arena), &arena);
+  mc_arena_free(&arena);
+
+  mc_itemtag_array tags;
+  mc_arena_init(&arena, MC_ARENA_BLOCK_SIZE);
+  failed |= check("itemtag_array", dec_checked_itemtag_array(&tags, count,
+      sizeof(count), &arena), &arena);
+  mc_arena_free(&arena);
+
+  // One tag with an empty name and too many entries
+  char entries[] = {0x01, 0x00, 0x80, 0x80, 0x80, 0x60};
+  mc_arena_init(&arena, MC_ARENA_BLOCK_SIZE);
+  failed |= check("itemtag entries", dec_checked_itemtag_array(&tags, entries,
+      sizeof(entries), &arena), &arena);
+  mc_arena_free(&arena);
+
+  return failed;
+}
@@ -0,0 +1,62 @@
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import sysconfig
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INCLUDE = os.path.join(ROOT, 'include')
+SRC = os.path.join(ROOT, 'src')
+CNBT = os.path.join(SRC, 'cNBT')
+
+# The C runtime every generated protocol links against
+RUNTIME = [os.path.join(SRC, f) for f in ('datautils.c', 'sds.c')] + [
+    os.path.join(CNBT, f) for f in sorted(os.listdir(CNBT))
+    if f.endswith('.c')
+]
+
+@pytest.fixture(scope = 'session')
+def cc():
+    compiler = os.environ.get('CC') or shutil.which('cc') or \
+        shutil.which('gcc')
+    if compiler is None:
+        pytest.skip('no C compiler')
+    return compiler
+
+# Compiles sources together with the runtime into out, extra args go before
+# the libraries
+@pytest.fixture(scope = 'session')
+def build(cc):
+    def build(out, sources, *args):
+        cmd = [cc, '-std=gnu11', '-O1', '-fcommon', f'-I{INCLUDE}', *args,
+            '-o', str(out), *map(str, sources), *RUNTIME, '-lz', '-lm']
+        subprocess.run(cmd, check = True)
+        return out
+    return build
+
+VERSION = '1.12.2'
+
+# The generated extension and pure Python codec for VERSION, loaded from a
+# scratch directory
+@pytest.fixture(scope = 'session')
+def backends(build, tmp_path_factory):
+    pytest.importorskip('minecraft_data')
+    out = tmp_path_factory.mktemp('proto')
+    name = VERSION.replace('.', '_')
+    subprocess.run([sys.executable, os.path.join(ROOT, 'mcd2c.py'), VERSION,
+        '--python', '--pure-python'], cwd = out, check = True,
+        stdout = subprocess.DEVNULL)
+    shutil.copy(os.path.join(SRC, 'datautils.py'), out)
+    build(out / f'proto_{name}{sysconfig.get_config_var("EXT_SUFFIX")}',
+        [out / f'py_{name}.c', out / f'{name}_proto.c',
+        os.path.join(SRC, 'pyproto.c')], '-shared', '-fPIC',
+        f'-I{sysconfig.get_paths()["include"]}')
+    sys.path.insert(0, str(out))
+    try:
+        return (importlib.import_module(f'proto_{name}'),
+            importlib.import_module(f'codec_{name}'))
+    finally:
+        sys.path.remove(str(out))
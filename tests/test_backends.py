@@ -0,0 +1,52 @@
+import pytest
+
+# The C extension and the pure Python codec have to agree on everything,
+# errors included
+def outcome(func, *args):
+    try:
+        return func(*args)
+    except ValueError as err:
+        return ValueError, str(err)
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\xff\xff\xff\xff',
+    b'\xff\xff\xff\xff\xff',
+    b'\xff\xff\xff\xff\xff\xff',
+    b'\x02\x00\x00\xff\xff\xff\xff\xff\xff',
+])
+def test_decode_frames_lengths(backends, data):
+    ext, codec = backends
+    expected = outcome(ext.decode_frames, ext.PLAY, ext.TOCLIENT, data)
+    assert outcome(codec.decode_frames, codec.PLAY, codec.TOCLIENT, data) == \
+        expected
+
+def test_index_frames_rejects_long_length(backends):
+    _, codec = backends
+    with pytest.raises(ValueError, match = 'malformed frame at offset 0'):
+        codec.index_frames(b'\xff' * 6)
+
+# set_slot bodies, window 0 and slot 36, then the item and what decoding and
+# encoding it again gives, None for invalid
+SLOTS = [
+    (b'\xff\xff', b'\xff\xff'),
+    (b'\x00\x01\x01\x00\x00\x00', b'\x00\x01\x01\x00\x00\x00'),
+    (b'\x00\x01\x01\x00\x00\x0a\x00\x00\x01\x00\x01a\x05\x00',
+        b'\x00\x01\x01\x00\x00\x0a\x00\x00\x01\x00\x01a\x05\x00'),
+    (b'\x00\x01\x01\x00\x00\x05', None),
+]
+
+@pytest.mark.parametrize('item, expected', SLOTS)
+def test_slot_nbt(backends, item, expected):
+    body = b'\x00\x00\x24' + item
+    packet_id = 0x16
+    results = []
+    for mod in backends:
+        try:
+            packet = mod.decode(mod.PLAY, mod.TOCLIENT, packet_id, body)
+        except ValueError:
+            results.append(None)
+            continue
+        results.append(mod.encode(mod.PLAY, mod.TOCLIENT, packet_id,
+            packet)[3:])
+    assert results == [expected, expected]
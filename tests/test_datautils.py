@@ -0,0 +1,10 @@
+import os
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def test_checked_decode_rejects_oversized_counts(build, tmp_path):
+    exe = build(tmp_path / 'checked_decode',
+        [os.path.join(HERE, 'checked_decode.c')])
+    result = subprocess.run([str(exe)], capture_output = True, text = True)
+    assert result.returncode == 0, result.stdout